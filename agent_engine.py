@@ -0,0 +1,224 @@
+"""
+The agent loop, run on an asyncio event loop of its own rather than on the Streamlit script thread.
+
+For each question, the agent asks the LLM for a response, runs the query it chose, hands the LLM the result
+and asks again, until it gives an answer or asks the user something. render_app used to run all of that
+inline, so the script thread was blocked for the whole turn, and any rerun (e.g. a sidebar click) killed
+the turn halfway through.
+
+AgentEngine runs one event loop in a background thread, shared by every session. submit() starts a turn on
+it and returns straight away. As the turn goes on, its tokens, responses and query results are put on the
+session's event queue, which the UI polls. The blocking work - starting and streaming predictions, running
+queries - happens in threads, so one session's query runs while another's response streams, and a query
+starts as soon as its response is complete, while the response is still being logged and displayed.
+
+Nothing here depends on Streamlit: benchmarks and the batch evaluator drive the same loop with run().
+"""
+import os
+import queue
+import asyncio
+import threading
+from traceback import format_exc
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils import choose_next_action, start_query, query_manager, is_query_error, SPECULATIVE_QUERIES, \
+    generate_logging_uuid, log_llm_call, log_response, log_action, log_query_result
+from llm_backends import stream_response
+from candidates import generate_candidates
+from context_window import fit_prompt
+from prompt_tools import Conversation, generate_relevant_preprompt, generate_system_prompt
+
+AGENT_ENGINE_THREADS = int(os.environ.get('AGENT_ENGINE_THREADS', default=64)) # predictions streaming and queries running at once, across all sessions
+PRINT_PROMPTS = os.environ.get('PRINT_PROMPTS', default='0') != '0' # print each prompt, its token counts and the candidates' metrics
+
+DEFAULT_SETTINGS = {
+    'llm':'',
+    'candidate_llms':None, # models to write parallel candidates with. None uses llm alone
+    'n_candidates':1,
+    'temperature':0.1,
+    'top_p':0.9,
+    'max_seq_len':512,
+    'query_follow_up':True, # pass query results back to the LLM to explain them
+    'max_steps':None, # LLM calls allowed per question. None keeps going until the LLM stops
+    'stream_tokens':True, # put each token on the event queue. Headless callers that don't read it can turn this off
+}
+
+
+class AgentSession:
+    """One chat session: its conversation, its settings and the events of its turns, for the UI to poll.
+
+       Events are dicts with a 'type':
+           token           the response so far, while it streams ('text')
+           response        a complete response, added to the conversation ('text')
+           query_result    a query result, added to the conversation ('markdown', 'is_error')
+           context_report  the tokens used by each part of the prompt just sent ('report')
+           error           the turn failed ('message')
+           done            the turn is over ('steps', 'cancelled')
+       Events about a message carry 'message_index', its position in conversation.chat_dialogue, so a UI
+       that has already drawn the conversation up to some point can skip the events before it.
+       """
+
+    def __init__(self, db_file, pre_prompt, settings=None, system_prompt=None):
+        self.db_file = db_file
+        self.conversation = Conversation(pre_prompt)
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.system_prompt = system_prompt if system_prompt is not None else generate_system_prompt()
+        self.session_uuid = generate_logging_uuid() # groups the session's LLM calls together in the logs
+        self.llm_call_uuid = None # the latest LLM call, for feedback on it
+        self.context_report = None # tokens used by each part of the latest prompt, from fit_prompt
+        self.events = queue.SimpleQueue()
+        self.lock = threading.Lock() # held while the conversation changes, so the UI never reads it halfway
+        self.turn = None # Future of the running turn
+        self.prediction = None # the prediction being streamed, so it can be cancelled
+
+    @property
+    def busy(self):
+        return self.turn is not None and not self.turn.done()
+
+    def emit(self, type, **fields):
+        self.events.put({'type':type, **fields})
+
+    def drain_events(self):
+        """All the events since the last call"""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def chat_dialogue(self):
+        """A copy of the messages so far, safe to read while a turn is running"""
+        with self.lock:
+            return list(self.conversation.chat_dialogue)
+
+    def questions(self):
+        return [message["content"] for message in self.chat_dialogue() if message["role"] == "user"]
+
+
+class AgentEngine:
+    """Runs the agent loop of any number of sessions on one shared event loop"""
+
+    def __init__(self, backend, threads=AGENT_ENGINE_THREADS):
+        self.backend = backend
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=threads, thread_name_prefix='agent-engine-worker'))
+        self.thread = threading.Thread(target=self.loop.run_forever, name='agent-engine', daemon=True)
+        self.thread.start()
+
+    def submit(self, session, question):
+        """Add a question to the session's conversation and start answering it.
+           Returns a concurrent.futures.Future of the number of LLM calls it took"""
+        if session.busy:
+            raise RuntimeError('This session is still answering the previous question')
+        with session.lock:
+            session.conversation.add_message("user", question)
+        session.turn = asyncio.run_coroutine_threadsafe(self.answer(session), self.loop)
+        return session.turn
+
+    def run(self, session, question):
+        """Answer a question and wait until it's done. For driving the agent headlessly"""
+        return self.submit(session, question).result()
+
+    def cancel(self, session):
+        """Stop the session's turn, if it has one running"""
+        prediction = session.prediction # before the turn clears it
+        if session.busy:
+            session.turn.cancel()
+        if prediction is not None:
+            prediction.cancel() # otherwise its thread streams on to the end
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def answer(self, session):
+        """The agent loop for the latest question"""
+        steps = 0
+        cancelled = False
+        try:
+            # for wide databases, only the schema of the tables relevant to the questions asked so far
+            pre_prompt = await asyncio.to_thread(generate_relevant_preprompt, session.db_file, session.questions())
+            with session.lock:
+                session.conversation.set_pre_prompt(pre_prompt)
+            next_action = 'send_user_text_to_assistant'
+            while next_action != None:
+                steps += 1
+                next_action = await self.step(session)
+                if session.settings['max_steps'] and steps >= session.settings['max_steps']:
+                    break
+            return steps
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            print(format_exc())
+            session.emit('error', message=str(e))
+            raise
+        finally:
+            session.prediction = None
+            session.emit('done', steps=steps, cancelled=cancelled)
+
+    async def step(self, session):
+        """One LLM call, and the query it asks for. Returns the next action"""
+        settings = dict(session.settings) # changes in the sidebar apply from the next step
+        # the whole conversation, unless it has to be trimmed to fit the model's context window
+        string_dialogue, session.context_report = await asyncio.to_thread(fit_prompt, session.conversation, session.db_file,
+            settings['llm'], session.system_prompt, settings['max_seq_len'])
+        session.emit('context_report', report=session.context_report)
+        if PRINT_PROMPTS:
+            print(string_dialogue)
+            print(session.context_report)
+        llm_call_input_dict = {"prompt": string_dialogue + "Assistant: ",
+                               "system_prompt": session.system_prompt,
+                               "max_length": session.context_report['max_new_tokens'], # what's left of the context window
+                               "temperature": settings['temperature'],
+                               "top_p": settings['top_p'],
+                               "max_new_tokens": session.context_report['max_new_tokens'],
+                               "repetition_penalty": 1}
+        message_index = len(session.conversation.chat_dialogue)
+        query_future = None
+        if settings['n_candidates'] > 1:
+            session.emit('token', message_index=message_index, text=f"*Writing {settings['n_candidates']} candidate responses...*")
+            # each candidate is logged as a call of its own, and the winner's query has already been run
+            winner, candidate_metrics = await asyncio.to_thread(generate_candidates, self.backend, settings['candidate_llms'] or [settings['llm']],
+                llm_call_input_dict, session.db_file, settings['n_candidates'], session.session_uuid)
+            if PRINT_PROMPTS:
+                print(candidate_metrics)
+            session.llm_call_uuid = winner.call_uuid
+            full_response, next_action, next_action_input = winner.response, winner.next_action, winner.next_action_input
+            if winner.query_result is not None:
+                query_future = Future()
+                query_future.set_result(winner.query_result)
+        else:
+            session.llm_call_uuid = generate_logging_uuid()
+            log_llm_call(settings['llm'], llm_call_input_dict, session.llm_call_uuid, session.session_uuid)
+            session.prediction = await asyncio.to_thread(self.backend.create, settings['llm'], llm_call_input_dict)
+            on_update = (lambda response: session.emit('token', message_index=message_index, text=response)) if settings['stream_tokens'] else None
+            full_response = await asyncio.to_thread(stream_response, session.prediction, on_update)
+            session.prediction = None
+            # the query is complete once the stream stops, so check it and start running it while the response is logged and displayed
+            next_action, next_action_input = choose_next_action(full_response)
+            if next_action == 'query' and SPECULATIVE_QUERIES:
+                query_future = start_query(session.db_file, next_action_input)
+            log_response(full_response, session.llm_call_uuid, session.session_uuid)
+
+        with session.lock:
+            session.conversation.add_message("assistant", full_response)
+        session.emit('response', message_index=message_index, text=full_response)
+        log_action(next_action, next_action_input, session.llm_call_uuid, session.session_uuid)
+
+        if next_action == 'query':
+            if query_future is not None:
+                query_result_string, query_result_markdown = await asyncio.wrap_future(query_future)
+            else:
+                query_result_string, query_result_markdown = await asyncio.to_thread(query_manager, session.db_file, next_action_input)
+            log_query_result(query_result_string, query_result_markdown, session.llm_call_uuid, session.session_uuid)
+            with session.lock:
+                session.conversation.add_query_result(query_result_string, query_result_markdown)
+            session.emit('query_result', message_index=message_index + 1, markdown=query_result_markdown, is_error=is_query_error(query_result_string))
+            if not settings['query_follow_up']:
+                # if we don't want to pass the query result back to the LLM, then stop
+                # unless there was an error in the query
+                if not is_query_error(query_result_string):
+                    next_action = None
+        return next_action
@@ -0,0 +1,67 @@
+"""
+Throughput of the agent loop with many sessions asking questions at once: each session's turn run to the
+end before the next one starts, the way Streamlit script threads queue up behind a blocking loop, compared
+with all of them submitted to one shared AgentEngine.
+
+Responses are played back from the interaction log by ReplayBackend, at a realistic streaming rate and time
+to first token, and queries run against the database as usual.
+
+Run from the repo root:
+    python benchmarks/bench_agent_engine.py --sessions 16 --tokens-per-second 40 --first-token-latency 0.5
+"""
+import os
+import sys
+import time
+import argparse
+import contextlib
+import io
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from llm_backends import ReplayBackend
+from agent_engine import AgentEngine, AgentSession
+from prompt_tools import generate_preprompt
+from utils import configure_interaction_log, LOG_FILE
+from query_cache import query_result_cache
+import utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', default='./db_files/tpch/tpch.duckdb', help='DuckDB file to run queries against')
+parser.add_argument('--log', default=LOG_FILE, help='Interaction log to replay responses from')
+parser.add_argument('--sessions', default=16, type=int, help='Sessions asking a question at the same time')
+parser.add_argument('--max-steps', default=4, type=int, help='LLM calls allowed per question')
+parser.add_argument('--tokens-per-second', default=40, type=float, help='Replay rate, 0 for as fast as possible')
+parser.add_argument('--first-token-latency', default=0.5, type=float, help='Seconds before each prediction starts streaming')
+
+
+def new_sessions(args):
+    pre_prompt, _ = generate_preprompt(args.db)
+    settings = {'llm':'replay/offline:0', 'max_steps':args.max_steps, 'stream_tokens':False}
+    return [AgentSession(args.db, pre_prompt, settings) for _ in range(args.sessions)]
+
+def one_at_a_time(engine, sessions):
+    return [engine.run(session, f'question {i}') for i, session in enumerate(sessions)]
+
+def all_at_once(engine, sessions):
+    turns = [engine.submit(session, f'question {i}') for i, session in enumerate(sessions)]
+    return [turn.result() for turn in turns]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_interaction_log(os.path.join(tmp, 'interaction_log.log')) # keep the benchmark's calls out of the real log
+        print(f'{args.sessions} sessions, up to {args.max_steps} steps each, {args.tokens_per_second:g} tokens/s, '
+              f'{args.first_token_latency:g} s to first token')
+        for name, drive in [('one turn at a time', one_at_a_time), ('shared AgentEngine', all_at_once)]:
+            # a fresh backend each time, so both hand out the same responses in the same order
+            engine = AgentEngine(ReplayBackend(args.log, args.tokens_per_second or None, args.first_token_latency))
+            query_result_cache.clear() # both start cold
+            with contextlib.redirect_stdout(io.StringIO()): # silence the debug prints along the way
+                sessions = new_sessions(args)
+                start = time.perf_counter()
+                steps = drive(engine, sessions)
+                elapsed = time.perf_counter() - start
+            engine.close()
+            print(f'  {name:<20} {elapsed:7.2f} s for {sum(steps)} LLM calls, {sum(steps) / elapsed:6.2f} calls/s')
+        utils.log_writer.stop() # write out the benchmark's records before tmp goes away
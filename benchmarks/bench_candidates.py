@@ -0,0 +1,91 @@
+"""
+Latency and retries to get a working response for an agent step: the serial loop, which sends each query
+error back to the model and asks again, compared with racing several candidates at once with candidates.py.
+
+Responses are played back from the interaction log by ReplayBackend, at a realistic streaming rate and
+time to first token, so the logged queries that fail against the database play the part of broken
+first attempts. A step is done once a response is not a query, or its query runs without an error.
+
+Run from the repo root:
+    python benchmarks/bench_candidates.py --steps 30 --candidates 3 --tokens-per-second 40 --first-token-latency 0.5
+"""
+import os
+import sys
+import time
+import argparse
+import contextlib
+import io
+import statistics
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from llm_backends import ReplayBackend, stream_response
+from candidates import Candidate, generate_candidates
+from utils import choose_next_action, preflight_query, query_manager, configure_interaction_log, generate_logging_uuid, LOG_FILE
+from query_cache import query_result_cache
+import utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', default='./db_files/tpch/tpch.duckdb', help='DuckDB file to run queries against')
+parser.add_argument('--log', default=LOG_FILE, help='Interaction log to replay responses from')
+parser.add_argument('--steps', default=30, type=int, help='Agent steps to measure')
+parser.add_argument('--candidates', default=3, type=int, help='Candidates raced per step')
+parser.add_argument('--max-calls', default=9, type=int, help='LLM calls allowed per step before giving up')
+parser.add_argument('--tokens-per-second', default=40, type=float, help='Replay rate, 0 for as fast as possible')
+parser.add_argument('--first-token-latency', default=0.5, type=float, help='Seconds before each prediction starts streaming')
+
+
+def step_input(step):
+    # a prompt that isn't in the log, so the backend hands out the logged responses in order
+    return {"prompt": f"benchmark step {step}\n\nAssistant: ", "system_prompt": "", "temperature": 0.1}
+
+def serial_step(backend, db_file, step, max_calls):
+    """Ask again after every query error, like the chat loop. Returns (LLM calls, valid)"""
+    for call in range(1, max_calls + 1):
+        candidate = Candidate(0, 'replay/offline:0', step_input(step))
+        candidate.response = stream_response(backend.create(candidate.llm, candidate.input))
+        candidate.next_action, candidate.next_action_input = choose_next_action(candidate.response)
+        if candidate.next_action == 'query':
+            candidate.query_result = preflight_query(db_file, candidate.next_action_input) \
+                or query_manager(db_file, candidate.next_action_input)
+        if candidate.valid:
+            return call, True
+    return max_calls, False
+
+def parallel_step(backend, db_file, step, max_calls, n_candidates):
+    """Race n_candidates at a time until one works. Returns (LLM calls started, valid)"""
+    calls = 0
+    while calls < max_calls:
+        winner, metrics = generate_candidates(backend, ['replay/offline:0'], step_input(step), db_file, n_candidates, generate_logging_uuid())
+        calls += n_candidates
+        if winner.valid:
+            return calls, True
+    return calls, False
+
+def run(step_function, args):
+    """Returns the latency of each step, the LLM calls it took, and the number of steps that gave up"""
+    backend = ReplayBackend(args.log, args.tokens_per_second or None, args.first_token_latency)
+    query_result_cache.clear() # both loops start cold
+    latencies, calls, failures = [], [], 0
+    with contextlib.redirect_stdout(io.StringIO()): # silence the debug prints along the way
+        for step in range(args.steps):
+            start = time.perf_counter()
+            n_calls, valid = step_function(backend, step)
+            latencies.append(time.perf_counter() - start)
+            calls.append(n_calls)
+            failures += not valid
+    return latencies, calls, failures
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_interaction_log(os.path.join(tmp, 'interaction_log.log')) # keep the benchmark's calls out of the real log
+        print(f'{args.steps} steps, {args.tokens_per_second:g} tokens/s, {args.first_token_latency:g} s to first token')
+        for name, step_function in [
+                ('serial retries', lambda backend, step: serial_step(backend, args.db, step, args.max_calls)),
+                (f'{args.candidates} parallel candidates', lambda backend, step: parallel_step(backend, args.db, step, args.max_calls, args.candidates))]:
+            latencies, calls, failures = run(step_function, args)
+            print(f'  {name:<24} {statistics.mean(latencies):6.2f} s mean, {statistics.median(latencies):6.2f} s median, '
+                  f'{max(latencies):6.2f} s max per step, {statistics.mean(calls):5.2f} LLM calls per step, {failures} steps gave up')
+        utils.log_writer.stop() # write out the benchmark's records before tmp goes away
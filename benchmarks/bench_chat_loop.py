@@ -0,0 +1,70 @@
+"""
+Measure end-to-end throughput of the chat loop offline, using ReplayBackend to play back
+responses from the interaction log instead of calling Replicate.
+
+Each turn follows the same steps as render_app: build the prompt, stream the prediction through
+the stop detection, choose the next action and run any query against the database.
+
+Run from the repo root:
+    python benchmarks/bench_chat_loop.py --turns 50 --tokens-per-second 0
+"""
+import os
+import sys
+import time
+import argparse
+import contextlib
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from llm_backends import ReplayBackend
+from utils import StopConditionScanner, clean_up_response_formatting, choose_next_action, query_manager, LOG_FILE
+from prompt_tools import generate_preprompt, generate_system_prompt, Conversation
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', default='./db_files/tpch/tpch.duckdb', help='DuckDB file to run queries against')
+parser.add_argument('--log', default=LOG_FILE, help='Interaction log to replay responses from')
+parser.add_argument('--turns', default=50, type=int, help='Number of LLM calls to make')
+parser.add_argument('--tokens-per-second', default=0, type=float, help='Replay rate, 0 for as fast as possible')
+
+
+def run_turn(backend, db_file, prompt, system_prompt):
+    """Run one LLM call plus its query, if any. Return (response, number of tokens, query result string and markdown)"""
+    prediction = backend.create('replay/offline:0', {"prompt": prompt + "Assistant: ", "system_prompt": system_prompt})
+    stop_scanner = StopConditionScanner()
+    full_response = ''
+    n_tokens = 0
+    for item in prediction.iter_tokens():
+        n_tokens += 1
+        full_response += item
+        stop_index = stop_scanner.feed(item)
+        if stop_index:
+            prediction.cancel()
+            full_response = clean_up_response_formatting(full_response[:stop_index])
+            break
+    next_action, next_action_input = choose_next_action(full_response)
+    query_result_string, query_result_markdown = None, None
+    if next_action == 'query':
+        query_result_string, query_result_markdown = query_manager(db_file, next_action_input)
+    return full_response, n_tokens, query_result_string, query_result_markdown
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    backend = ReplayBackend(args.log, args.tokens_per_second or None)
+    pre_prompt, _ = generate_preprompt(args.db)
+    system_prompt = generate_system_prompt()
+
+    conversation = Conversation(pre_prompt)
+    total_tokens = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # silence the debug prints along the way
+        for turn in range(args.turns):
+            response, n_tokens, query_result_string, query_result_markdown = run_turn(backend, args.db, conversation.prompt(), system_prompt)
+            total_tokens += n_tokens
+            conversation.add_message('assistant', response)
+            if query_result_string is not None:
+                conversation.add_query_result(query_result_string, query_result_markdown)
+    elapsed = time.perf_counter() - start
+
+    print(f'{args.turns} turns, {total_tokens} tokens in {elapsed:.2f} s')
+    print(f'  {args.turns / elapsed:.1f} turns/s, {total_tokens / elapsed:.0f} tokens/s')
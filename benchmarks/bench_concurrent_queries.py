@@ -0,0 +1,69 @@
+"""
+Run many queries at once against one database file, the way concurrent Streamlit sessions do,
+and compare the pooled cursors from db_manager with every session opening its own connection.
+
+Run from the repo root:
+    python benchmarks/bench_concurrent_queries.py --sessions 32 --queries 10
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import duckdb
+from db_manager import get_pool, checkout
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', default='./db_files/tpch/tpch.duckdb', help='DuckDB file to query')
+parser.add_argument('--sessions', default=32, type=int, help='Number of simultaneous sessions')
+parser.add_argument('--queries', default=10, type=int, help='Queries per session')
+
+QUERIES = [
+    "SELECT n_name, count(*) AS suppliers FROM supplier JOIN nation ON s_nationkey = n_nationkey GROUP BY n_name ORDER BY suppliers DESC;",
+    "SELECT o_orderpriority, count(*) AS orders FROM orders WHERE o_orderdate >= DATE '1994-01-01' GROUP BY o_orderpriority;",
+    "SELECT sum(l_extendedprice * (1 - l_discount)) AS revenue FROM lineitem WHERE l_quantity < 24;",
+    "SELECT p_name, p_retailprice FROM part ORDER BY p_retailprice DESC LIMIT 10;",
+    "SELECT * FROM lineitem LIMIT 30;",
+]
+
+
+def pooled_session(db_file, n_queries, session):
+    results = []
+    for i in range(n_queries):
+        with checkout(db_file) as db:
+            results.append(db.sql(QUERIES[(session + i) % len(QUERIES)]).df())
+    return results
+
+
+def private_connection_session(db_file, n_queries, session):
+    """What every session did before db_manager: open its own connection"""
+    db = duckdb.connect(db_file, read_only=True)
+    results = []
+    for i in range(n_queries):
+        results.append(db.sql(QUERIES[(session + i) % len(QUERIES)]).df())
+    db.close()
+    return results
+
+
+def run_sessions(session_fn, db_file, n_sessions, n_queries):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+        futures = [executor.submit(session_fn, db_file, n_queries, session) for session in range(n_sessions)]
+        results = [future.result() for future in futures] # re-raises any exception from a session
+    return time.perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    total_queries = args.sessions * args.queries
+
+    pooled_time, _ = run_sessions(pooled_session, args.db, args.sessions, args.queries)
+    pool = get_pool(args.db)
+    print(f'pooled cursors:      {total_queries} queries from {args.sessions} sessions in {pooled_time:.2f} s '
+          f'({total_queries / pooled_time:.0f} queries/s), {len(pool._idle_cursors)} cursors opened (cap {pool.max_cursors})')
+
+    private_time, _ = run_sessions(private_connection_session, args.db, args.sessions, args.queries)
+    print(f'private connections: {total_queries} queries from {args.sessions} sessions in {private_time:.2f} s '
+          f'({total_queries / private_time:.0f} queries/s)')
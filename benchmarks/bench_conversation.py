@@ -0,0 +1,100 @@
+"""
+Time spent building the LLM prompt over a long conversation: rebuilding it from the whole chat history
+at every agent step, the way render_app used to, compared with the incremental Conversation.
+
+Conversations are synthetic: each turn is a user question followed by agent steps that each add an
+assistant response and a query result, sized like the ones in the interaction log.
+
+Run from the repo root:
+    python benchmarks/bench_conversation.py --turns 50 --conversations 20
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from prompt_tools import Conversation
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--turns', default=50, type=int, help='User questions per conversation')
+parser.add_argument('--steps', default=3, type=int, help='Agent steps (LLM calls) per question')
+parser.add_argument('--conversations', default=20, type=int, help='Number of conversations to average over')
+parser.add_argument('--pre-prompt-chars', default=3000, type=int, help='Size of the schema preprompt')
+
+
+def synthetic_text(rng, n_chars):
+    words = ['SELECT', 'FROM', 'lineitem', 'orders', 'the', 'total', 'price', 'customer', '|', '1234.5', 'Thought.', '\n']
+    text = []
+    length = 0
+    while length < n_chars:
+        word = rng.choice(words)
+        text.append(word)
+        length += len(word) + 1
+    return ' '.join(text)
+
+def synthetic_conversation(seed, turns, steps):
+    """A list of ('user'|'assistant', text) and ('🦆', (string_out, md_out)) messages"""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(turns):
+        messages.append(('user', synthetic_text(rng, 100)))
+        for _ in range(steps):
+            messages.append(('assistant', synthetic_text(rng, rng.randint(200, 1000))))
+            result = synthetic_text(rng, rng.randint(100, 2000))
+            messages.append(('🦆', (result, '```\n' + result + '\n```')))
+    return messages
+
+
+def rebuild_each_step(pre_prompt, messages):
+    """The original render_app: re-render the whole history before every LLM call"""
+    chat_dialogue = []
+    query_response_mapper = {}
+    prompts = []
+    for role, content in messages:
+        if role == '🦆':
+            query_response_mapper[content[1]] = content[0]
+            chat_dialogue.append({"role": role, "content": content[1]})
+            continue
+        chat_dialogue.append({"role": role, "content": content})
+        if role == 'user':
+            continue
+        string_dialogue = pre_prompt
+        for dict_message in chat_dialogue[:-1]: # the LLM call happens before its own response is added
+            if dict_message["role"] == '🦆':
+                string_dialogue = string_dialogue + 'Query result:\n' + query_response_mapper[dict_message["content"]] + "\n\n"
+            else:
+                role_name = dict_message["role"][0].upper() + dict_message["role"][1:]
+                string_dialogue = string_dialogue + role_name + ": " + dict_message["content"] + "\n\n"
+        prompts.append(string_dialogue)
+    return prompts
+
+def incremental(pre_prompt, messages):
+    conversation = Conversation(pre_prompt)
+    prompts = []
+    for role, content in messages:
+        if role == '🦆':
+            conversation.add_query_result(*content)
+            continue
+        if role == 'assistant':
+            prompts.append(conversation.prompt()) # the LLM call happens before its own response is added
+        conversation.add_message(role, content)
+    return prompts
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    pre_prompt = synthetic_text(random.Random(0), args.pre_prompt_chars)
+    conversations = [synthetic_conversation(seed, args.turns, args.steps) for seed in range(args.conversations)]
+    assert rebuild_each_step(pre_prompt, conversations[0]) == incremental(pre_prompt, conversations[0])
+
+    n_calls = args.turns * args.steps
+    print(f'{args.turns} turns x {args.steps} steps = {n_calls} LLM calls per conversation, '
+          f'final prompt {len(incremental(pre_prompt, conversations[0])[-1]) / 1000:.0f} kB')
+    for name, build in [('rebuild every step', rebuild_each_step), ('Conversation', incremental)]:
+        start = time.perf_counter()
+        for messages in conversations:
+            build(pre_prompt, messages)
+        elapsed = (time.perf_counter() - start) / args.conversations
+        print(f'  {name:<20} {1000 * elapsed:8.2f} ms per conversation, {1e6 * elapsed / n_calls:8.1f} us per LLM call')
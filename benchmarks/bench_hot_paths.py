@@ -0,0 +1,205 @@
+"""
+Benchmarks of the pure-Python hot paths of the chat loop, to catch regressions in per-token, per-turn and
+per-query cost:
+
+    per token   StopConditionScanner.feed, as each streamed token arrives
+    per turn    check_for_stop_conditions, choose_next_action and clean_up_response_formatting on a whole
+                response, building the prompt (Conversation, fit_prompt) and the schema (list_table_schemas)
+    per query   format_query_result and query_manager, uncached and cached
+
+Fixtures are drawn from the recorded interaction log (responses and the queries the LLM wrote) and from the
+databases: responses at their recorded size and padded out to longer Thoughts, query results of a few sizes
+from the largest table of each database, and conversations of a few lengths.
+
+Each case reports the time per token, turn or query, from the fastest of --repeat timings. --save writes the
+results to a JSON file, and --compare checks them against a saved baseline: the run exits with an error if a
+case got slower by more than --threshold.
+
+Run from the repo root:
+    python benchmarks/bench_hot_paths.py --save baseline.json
+    python benchmarks/bench_hot_paths.py --compare baseline.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+import math
+import contextlib
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pandas as pd
+from utils import StopConditionScanner, check_for_stop_conditions, choose_next_action, clean_up_response_formatting, \
+    fetch_head_and_tail, format_query_result, query_manager, is_query_error, read_log_records, LOG_FILE
+from llm_backends import split_into_tokens
+from db_manager import checkout
+from prompt_tools import Conversation, get_schema, list_table_schemas
+from context_window import fit_prompt
+from schema_catalog import column_hints
+from db_specific_prompts import db_specific_prompts
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', nargs='+', default=['./db_files/tpch/tpch.duckdb', './db_files/lfu/lfu.duckdb'], help='DuckDB files to draw fixtures from')
+parser.add_argument('--log', default=LOG_FILE, help='Interaction log to draw responses and queries from')
+parser.add_argument('--repeat', default=5, type=int, help='Timings of each case to take the fastest of')
+parser.add_argument('--save', default=None, help='Write the results to this JSON file')
+parser.add_argument('--compare', default=None, help='Compare with the results saved in this JSON file')
+parser.add_argument('--threshold', default=1.5, type=float, help='Slowdown relative to the baseline that counts as a regression')
+
+RESPONSE_SIZES = [1, 4, 16] # responses at their recorded size, and with their Thought padded to this many times as long
+RESULT_ROWS = [1, 20, 10000] # rows in the query results formatted. Larger results are cut to their first and last rows
+CONVERSATION_TURNS = [5, 25, 100]
+MIN_TIMING_SECONDS = 0.05
+ACTION_RE = re.compile(r'query:|ask user:|docs:|topic:|explain:|final answer:|/end|```', re.IGNORECASE)
+
+
+#### fixtures
+
+def logged_values(log_path, key):
+    return [record['value'] for record in read_log_records(log_path) if record['key'] == key and record['value'].strip()]
+
+def pad_response(response, factor):
+    """The response with the Thought before its action repeated, so it's about factor times as long"""
+    match = ACTION_RE.search(response)
+    thought, action = (response[:match.start()], response[match.start():]) if match else (response, '')
+    return thought * factor + action
+
+def result_queries(db_file):
+    """Queries returning RESULT_ROWS rows, wide and narrow, from the database's largest table"""
+    with checkout(db_file) as db:
+        schema, table = db.execute('SELECT schema_name, table_name FROM duckdb_tables() ORDER BY estimated_size DESC LIMIT 1').fetchone()
+        columns = [row[0] for row in db.execute(f'DESCRIBE "{schema}"."{table}"').fetchall()]
+    narrow = ', '.join(f'"{column}"' for column in columns[:3])
+    # keyed by the kind of select, as on a table of 3 columns or fewer the two are the same width
+    return {f'{kind} ({width} cols) {n_rows} rows':f'SELECT {select} FROM "{schema}"."{table}" LIMIT {n_rows}'
+            for kind, width, select in [('select *', len(columns), '*'), ('narrow', len(columns[:3]), narrow)] for n_rows in RESULT_ROWS}
+
+def synthetic_conversation(pre_prompt, responses, results, n_turns):
+    """A conversation of n_turns questions, each answered with a query and its result.
+       The prompt is built before each LLM call, as in the chat loop"""
+    conversation = Conversation(pre_prompt)
+    for turn in range(n_turns):
+        conversation.add_message('user', f'Question {turn} about the data?')
+        conversation.prompt()
+        conversation.add_message('assistant', responses[turn % len(responses)])
+        conversation.add_query_result(*results[turn % len(results)])
+        conversation.prompt()
+    return conversation
+
+
+#### measurement
+
+def measure(run, n_units, repeat):
+    """Seconds per unit, from the fastest of repeat timings. Like timeit, each timing calls run enough
+       times to take at least MIN_TIMING_SECONDS, so that short cases aren't lost in timer and scheduling noise"""
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()): # silence the debug prints along the way
+        start = time.perf_counter()
+        run()
+        loops = max(1, math.ceil(MIN_TIMING_SECONDS / (time.perf_counter() - start)))
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(loops):
+                run()
+            timings.append((time.perf_counter() - start) / loops / n_units)
+    return min(timings)
+
+def scan_tokens(token_lists):
+    for tokens in token_lists:
+        scanner = StopConditionScanner()
+        for token in tokens:
+            if scanner.feed(token):
+                break
+
+def for_each(function, inputs):
+    def run():
+        for x in inputs:
+            function(x)
+    return run
+
+
+def run_cases(args):
+    """Returns {case name: (unit, seconds per unit)}"""
+    results = {}
+    def case(name, unit, run, n_units):
+        results[name] = (unit, measure(run, n_units, args.repeat))
+        print(f'  {name:<58} {1e6 * results[name][1]:10.2f} us per {unit}')
+
+    responses = logged_values(args.log, 'response')
+    logged_queries = logged_values(args.log, 'next_action_input')
+    print(f'{len(responses)} responses and {len(logged_queries)} queries from {args.log}\n')
+
+    for factor in RESPONSE_SIZES:
+        sized = [pad_response(response, factor) for response in responses]
+        size = f'responses x{factor} ({statistics.mean(map(len, sized)):.0f} chars)'
+        token_lists = [split_into_tokens(response) for response in sized]
+        case(f'StopConditionScanner.feed, {size}', 'token', lambda: scan_tokens(token_lists), sum(map(len, token_lists)))
+        case(f'check_for_stop_conditions, {size}', 'turn', for_each(check_for_stop_conditions, sized), len(sized))
+        case(f'choose_next_action, {size}', 'turn', for_each(choose_next_action, sized), len(sized))
+        case(f'clean_up_response_formatting, {size}', 'turn', for_each(clean_up_response_formatting, sized), len(sized))
+
+    for db_file in args.db:
+        if not os.path.exists(db_file):
+            print(f'\n{db_file} not found, skipping its cases')
+            continue
+        name = os.path.basename(db_file)
+        print()
+        schema = get_schema(db_file)
+        df = pd.DataFrame(schema['tables'])
+        db_specific = db_specific_prompts.get(schema['database_name'], '')
+        hints = column_hints(db_file)
+        case(f'list_table_schemas, {name} ({len(df)} tables)', 'turn', lambda: list_table_schemas(df, db_specific, hints), 1)
+
+        formatted = []
+        for size, query in result_queries(db_file).items():
+            with checkout(db_file) as db:
+                result_df, row_count = fetch_head_and_tail(db, query)
+            case(f'format_query_result, {name} {size}', 'query', lambda: format_query_result(result_df, row_count), 1)
+            case(f'query_manager uncached, {name} {size}', 'query', lambda: query_manager(db_file, query, use_cache=False), 1)
+            formatted.append(format_query_result(result_df, row_count))
+        with contextlib.redirect_stdout(io.StringIO()):
+            queries = [query for query in logged_queries if not is_query_error(query_manager(db_file, query)[0])] # and now they're cached
+        if queries:
+            case(f'query_manager cached, {name} {len(queries)} logged queries', 'query', for_each(lambda query: query_manager(db_file, query), queries), len(queries))
+
+        pre_prompt = list_table_schemas(df, db_specific, hints)
+        for n_turns in CONVERSATION_TURNS:
+            case(f'Conversation, {name} {n_turns} turns', 'turn', lambda: synthetic_conversation(pre_prompt, responses, formatted, n_turns), n_turns)
+            conversation = synthetic_conversation(pre_prompt, responses, formatted, n_turns)
+            case(f'fit_prompt, {name} {n_turns} turns, 4096 token window', 'turn',
+                 lambda: fit_prompt(conversation, db_file, 'llama', '', 512), 1)
+    return results
+
+
+def compare(results, baseline_path, threshold):
+    """Print each case's change from the baseline. Returns the names of the cases that regressed"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = []
+    print(f'\nCompared with {baseline_path}:')
+    for name, (unit, seconds) in results.items():
+        if name not in baseline:
+            print(f'  {name:<58} new')
+            continue
+        ratio = seconds / baseline[name]['seconds']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'  {name:<58} {ratio:6.2f}x{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = run_cases(args)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({name:{'unit':unit, 'seconds':seconds} for name, (unit, seconds) in results.items()}, f, indent=1)
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            sys.exit(f'{len(regressions)} cases more than {args.threshold:g}x slower than the baseline')
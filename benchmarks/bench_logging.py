@@ -0,0 +1,86 @@
+"""
+How long the chat loop waits on interaction logging for each LLM call: the original synchronous
+file logging compared with handing records to the background BatchingLogWriter.
+
+Logs go to a temporary directory, not ./log. Payloads are the largest prompt and query result in the
+interaction log, so the numbers reflect a long conversation.
+
+Run from the repo root:
+    python benchmarks/bench_logging.py --calls 200
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+from utils import read_log_records, configure_interaction_log, prepend_uuid_on_message, generate_logging_uuid, LOG_FILE
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log', default=LOG_FILE, help='Interaction log to take realistic payloads from')
+parser.add_argument('--calls', default=200, type=int, help='Number of LLM calls to log')
+
+
+def largest_values(log_path):
+    largest = {}
+    for record in read_log_records(log_path):
+        if len(record['value']) > len(largest.get(record['key'], '')):
+            largest[record['key']] = record['value']
+    return largest
+
+
+def log_one_call(info, payload, call_uuid, session_uuid):
+    """Same records as log_llm_call + log_response + log_action + log_query_result, for the given logging function"""
+    info(prepend_uuid_on_message(session_uuid, call_uuid, 'llm_name|replicate/llama-2-70b-chat'))
+    info(prepend_uuid_on_message(session_uuid, call_uuid, 'llm_version|0'))
+    for key, value in payload['input'].items():
+        info(prepend_uuid_on_message(session_uuid, call_uuid, 'input_' + key + '|' + str(value) + f'|||end input_{key}|||'))
+    info(prepend_uuid_on_message(session_uuid, call_uuid, 'response|' + payload['response'] + '|||end response|||'))
+    info(prepend_uuid_on_message(session_uuid, call_uuid, 'next_action|query'))
+    info(prepend_uuid_on_message(session_uuid, call_uuid, 'query_result_string|' + payload['result'] + '|||end query_result_string|||'))
+
+
+def time_calls(log_call, n_calls):
+    session_uuid = generate_logging_uuid()
+    timings = []
+    for _ in range(n_calls):
+        start = time.perf_counter()
+        log_call(generate_logging_uuid(), session_uuid)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return 1000 * sum(timings) / n_calls, 1000 * timings[int(0.99 * (n_calls - 1))]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    largest = largest_values(args.log)
+    payload = {'input':{'prompt':largest['input_prompt'], 'system_prompt':largest['input_system_prompt'], 'max_length':2048,
+                        'temperature':0.1, 'top_p':0.9, 'max_new_tokens':2048, 'repetition_penalty':1},
+               'response':largest['response'], 'result':largest['query_result_string']}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the original setup: a FileHandler on the calling thread
+        sync_logger = logging.getLogger('bench_sync')
+        sync_logger.propagate = False
+        sync_logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(os.path.join(tmp, 'sync.log'), encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s|%(levelname)s|%(message)s'))
+        sync_logger.addHandler(handler)
+        sync_mean, sync_p99 = time_calls(lambda call, session: log_one_call(sync_logger.info, payload, call, session), args.calls)
+
+        results = {'synchronous FileHandler':(sync_mean, sync_p99)}
+        for log_format in ['text', 'jsonl']:
+            path = os.path.join(tmp, f'queued.{"jsonl" if log_format == "jsonl" else "log"}')
+            configure_interaction_log(path, log_format)
+            results[f'queued writer ({log_format})'] = time_calls(
+                lambda call, session: log_one_call(utils.interaction_logger.info, payload, call, session), args.calls)
+            configure_interaction_log(os.path.join(tmp, 'unused.log')) # flushes everything queued to path
+            n_records = sum(1 for _ in read_log_records(path))
+            print(f'{log_format}: {n_records} records written, {os.path.getsize(path) / 1e6:.1f} MB')
+
+    print(f'\nTime the chat loop spends logging each LLM call ({args.calls} calls, {len(payload["input"]["prompt"])} character prompt):')
+    for name, (mean, p99) in results.items():
+        print(f'  {name:<26} mean {mean:7.3f} ms   p99 {p99:7.3f} ms')
@@ -0,0 +1,90 @@
+"""
+Latency of LFU aggregate queries run as written, compared with routed by query_rewriter to the summary tables
+db_utils/make_lfu.py precomputes (melt_features, temp_hourly, arc_hourly). The queries are the examples in
+db_specific_prompts['lfu'] and the per-melt and per-day aggregates the LLM writes most.
+
+Each query goes through run_query (uncached), taking the fastest of --repeat runs each way. The routed and
+unrouted results are checked to be the same, to RESULT_DECIMALS places, including for queries that must not be
+routed because they only look like a precomputed aggregate. The one-off cost of rewriting a
+query (parsing it and checking the rewrite), which is cached after the first run, is reported separately.
+
+Run from the repo root:
+    python benchmarks/bench_precomputed.py --db ./db_files/lfu/lfu.duckdb
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import contextlib
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from db_specific_prompts import db_specific_prompts
+from db_manager import checkout, db_file_identity
+from utils import run_query
+import query_rewriter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', default='./db_files/lfu/lfu.duckdb', help='LFU DuckDB file, built with its summary tables')
+parser.add_argument('--repeat', default=20, type=int, help='Runs of each query each way, to take the fastest of')
+
+QUERIES = {
+    'cycles per melt, top 10': 'SELECT a._key, count(*) AS num_cycles FROM arc a GROUP BY a._key ORDER BY num_cycles DESC LIMIT 10;',
+    'heating time per melt': """SELECT _key, sum(date_diff('second', heating_start, heating_end)) AS heating_seconds, sum(active_power) AS active_power
+FROM arc GROUP BY _key ORDER BY heating_seconds DESC;""",
+    'temperature range per melt': """SELECT t._key, min(t.temperature) AS min_temp, max(t.temperature) AS max_temp, avg(t.temperature) AS avg_temp
+FROM temp_FULL_with_test t GROUP BY t._key;""",
+    'heating vs temperature slope': """WITH heating AS (SELECT _key, avg(active_power) AS avg_power, count(*) AS cycles FROM arc GROUP BY _key),
+slope AS (SELECT _key, regr_slope(temperature, epoch(_time)) AS slope FROM temp_FULL_with_test GROUP BY _key)
+SELECT corr(h.avg_power, s.slope) AS power_slope_correlation, avg(h.cycles) AS avg_cycles FROM heating h JOIN slope s ON h._key = s._key;""",
+    'temperature per day': """SELECT date_trunc('day', _time) AS day, avg(temperature) AS avg_temp, count(*) AS measurements
+FROM temp_FULL_with_test GROUP BY day ORDER BY day;""",
+    'arc power per month': """SELECT date_trunc('month', heating_start) AS month, sum(active_power) AS active_power, count(*) AS cycles
+FROM arc GROUP BY 1 ORDER BY 1;""",
+    # GROUP BY _time means the column here, not the alias, so this must not be routed to the daily buckets
+    'alias shadowing a column': """SELECT date_trunc('day', _time) AS _time, count(*) AS n FROM temp_FULL_with_test GROUP BY _time ORDER BY 1 LIMIT 3;""",
+}
+PROMPT_QUERY_RE = re.compile(r'Query:\s*```(.*?)```', re.DOTALL)
+RESULT_DECIMALS = 6
+
+
+def catalogue():
+    queries = {f'prompt example {i + 1}':query.strip() for i, query in enumerate(PROMPT_QUERY_RE.findall(db_specific_prompts['lfu']))}
+    queries.update(QUERIES)
+    return queries
+
+def fastest(run, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def rows(db_file, query):
+    def rounded(value):
+        return round(value, RESULT_DECIMALS) if isinstance(value, float) else value
+    with checkout(db_file) as db:
+        return sorted((tuple(rounded(value) for value in row) for row in db.execute(query).fetchall()), key=repr)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with contextlib.redirect_stdout(io.StringIO()):
+        query_rewriter.route_query(args.db, 'SELECT _key, count(*) AS n FROM arc GROUP BY _key') # load the table list and shadow catalog
+    print(f'{"":<32} {"as written":>12} {"routed":>12} {"speedup":>8} {"rewrite":>10}')
+    for name, query in catalogue().items():
+        with contextlib.redirect_stdout(io.StringIO()): # silence the debug prints along the way
+            query_rewriter.PRECOMPUTED_ROUTING = False
+            before = fastest(lambda: run_query(args.db, query), args.repeat)
+            query_rewriter.PRECOMPUTED_ROUTING = True
+            start = time.perf_counter()
+            routed = query_rewriter.routed_query.__wrapped__(*db_file_identity(args.db), query)
+            rewrite = time.perf_counter() - start
+            after = fastest(lambda: run_query(args.db, query), args.repeat)
+        same = rows(args.db, query) == rows(args.db, routed)
+        if routed == query:
+            print(f'  {name:<30} {1e3 * before:9.2f} ms {"not routed":>12}')
+            continue
+        print(f"  {name:<30} {1e3 * before:9.2f} ms {1e3 * after:9.2f} ms {before / after:7.1f}x {1e3 * rewrite:7.2f} ms{'' if same else '  RESULTS DIFFER'}")
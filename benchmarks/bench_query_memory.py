@@ -0,0 +1,64 @@
+"""
+Peak memory of running a large LLM-style query (SELECT * FROM lineitem) through query_manager,
+compared with materializing the whole result in pandas first, the way query_manager used to.
+
+Each measurement runs in its own process so the peak RSS of one doesn't hide the other.
+Best run against a scale factor 1 (or larger) TPC-H file.
+
+Run from the repo root:
+    python benchmarks/bench_query_memory.py --db ./db_files/tpch/tpch.duckdb --ceiling-mb 500
+"""
+import os
+import sys
+import argparse
+import subprocess
+import resource
+import contextlib
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', default='./db_files/tpch/tpch.duckdb', help='TPC-H DuckDB file')
+parser.add_argument('--query', default='SELECT * FROM lineitem;', help='Query to run')
+parser.add_argument('--ceiling-mb', default=None, type=float, help='Exit with an error if query_manager grows RSS by more than this')
+parser.add_argument('--mode', default=None, choices=['query_manager', 'materialize'], help=argparse.SUPPRESS) # used for the child processes
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in KB on Linux
+
+
+def measure(mode, db_file, query):
+    """Run in a child process: print how much the peak RSS grew while running the query"""
+    import pandas # imported before taking the baseline, so it isn't counted
+    from utils import query_manager
+    from db_manager import checkout
+    with checkout(db_file) as db:
+        db.sql('SELECT 1').fetchall() # open the database before taking the baseline
+    baseline = peak_rss_mb()
+    if mode == 'query_manager':
+        with contextlib.redirect_stdout(io.StringIO()):
+            query_manager(db_file, query)
+    else:
+        with checkout(db_file) as db:
+            db.sql(query).df()
+    print(peak_rss_mb() - baseline)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.mode:
+        measure(args.mode, args.db, args.query)
+        sys.exit()
+
+    growth = {}
+    for mode in ['materialize', 'query_manager']:
+        result = subprocess.run([sys.executable, __file__, '--db', args.db, '--query', args.query, '--mode', mode],
+                                capture_output=True, text=True, check=True)
+        growth[mode] = float(result.stdout.strip().splitlines()[-1])
+        print(f'{mode:<14} peak RSS grew by {growth[mode]:8.1f} MB')
+
+    if args.ceiling_mb is not None and growth['query_manager'] > args.ceiling_mb:
+        print(f'query_manager exceeded the {args.ceiling_mb} MB ceiling')
+        sys.exit(1)
@@ -0,0 +1,60 @@
+"""
+Prompt size with the relevance-pruned schema, compared with the full schema dump, and the time it takes to
+pick the relevant tables. The questions are the example questions in the database's db_specific_prompts,
+plus any given with --question.
+
+Prompt tokens are what the LLM has to process on every call, so they drive its latency and cost.
+
+Run from the repo root:
+    python benchmarks/bench_schema_prompt.py --db ./db_files/wca/wca.duckdb
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import schema_catalog
+from schema_catalog import get_catalog, select_tables
+from prompt_tools import generate_preprompt, generate_relevant_preprompt, get_schema
+from db_specific_prompts import db_specific_prompts
+from context_window import count_tokens
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', default='./db_files/wca/wca.duckdb', help='DuckDB file')
+parser.add_argument('--question', action='append', default=[], help='Question to select tables for. Can be repeated')
+parser.add_argument('--min-tables', default=0, type=int, help='Prune databases with at least this many tables (0 for any)')
+
+
+def time_it(fn, repeats=20):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    schema_catalog.SCHEMA_RETRIEVAL_MIN_TABLES = args.min_tables
+    questions = args.question + re.findall(r'^User: (.+)$', db_specific_prompts[get_schema(args.db)['database_name']], re.MULTILINE)
+
+    if os.path.exists(schema_catalog.catalog_path(args.db)):
+        os.remove(schema_catalog.catalog_path(args.db))
+    schema_catalog.cached_catalog.cache_clear()
+    start = time.perf_counter()
+    get_catalog(args.db)
+    print(f'Building the catalog: {time.perf_counter() - start:.2f} s (once per database file)\n')
+
+    full_prompt = generate_preprompt(args.db)[0]
+    full_tokens = count_tokens(full_prompt)
+    print(f'Full schema: {len(full_prompt)} characters, ~{full_tokens} tokens\n')
+    for question in questions:
+        pruned = generate_relevant_preprompt(args.db, [question])
+        schema_catalog.relevant_tables.cache_clear()
+        selection_time = time_it(lambda: (schema_catalog.relevant_tables.cache_clear(), generate_relevant_preprompt(args.db, [question])))
+        selection = select_tables(args.db, [question])
+        tables = ', '.join(name.split('.')[-1] for name in selection[0]) if selection else 'all (no table matched)'
+        tokens = count_tokens(pruned)
+        print(f'{question}\n  tables: {tables}\n  {len(pruned)} characters, ~{tokens} tokens '
+              f'({100 * (1 - tokens / full_tokens):.0f}% fewer), selected in {1000 * selection_time:.2f} ms\n')
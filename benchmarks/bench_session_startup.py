@@ -0,0 +1,58 @@
+"""
+Time what a new session does before it can show its first prompt: getting the schema preprompt.
+
+Compares the original path (open a connection, query the catalog, build the prompt) with
+generate_preprompt served from the on-disk schema cache and from the in-process cache.
+
+Run from the repo root:
+    python benchmarks/bench_session_startup.py --db ./db_files/lfu/lfu.duckdb
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import duckdb
+import schema_catalog
+schema_catalog.COLUMN_HINTS = False # compare like with like: the original prompt had no column statistics
+import prompt_tools
+from prompt_tools import generate_preprompt, get_table_details, get_db_specific_prompt, list_table_schemas, make_markdown_table_list
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', default='./db_files/tpch/tpch.duckdb', help='DuckDB file to start sessions on')
+parser.add_argument('--repeats', default=20, type=int, help='Number of session starts to average over')
+
+
+def uncached_startup(db_file):
+    """What each session used to do"""
+    db = duckdb.connect(db_file, read_only=True)
+    df = get_table_details(db)
+    db_spec = get_db_specific_prompt(db)
+    preprompt = list_table_schemas(df, db_spec), make_markdown_table_list(df)
+    db.close()
+    return preprompt
+
+
+def disk_cached_startup(db_file):
+    """First session in a new process: nothing in memory yet, but the schema cache file exists"""
+    prompt_tools.cached_schema.cache_clear()
+    prompt_tools.cached_preprompt.cache_clear()
+    return generate_preprompt(db_file)
+
+
+def mean_time(fn, db_file, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(db_file)
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert uncached_startup(args.db) == generate_preprompt(args.db) # also makes sure the cache file is written
+
+    for name, fn in [('connect + catalog queries', uncached_startup),
+                     ('on-disk schema cache', disk_cached_startup),
+                     ('in-process cache', generate_preprompt)]:
+        print(f'{name:<26} {1000 * mean_time(fn, args.db, args.repeats):8.3f} ms per session start')
@@ -0,0 +1,81 @@
+"""
+Compare the per-token cost of stop detection in the streaming loop:
+re-running check_for_stop_conditions on the whole response vs. feeding StopConditionScanner one token at a time.
+
+Run from the repo root:
+    python benchmarks/bench_stop_conditions.py
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import check_for_stop_conditions, StopConditionScanner
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tokens', default=4096, type=int, help='Number of tokens in each synthetic stream')
+parser.add_argument('--streams', default=5, type=int, help='Number of synthetic streams to average over')
+parser.add_argument('--buckets', default=8, type=int, help='Number of buckets to report per-token cost in')
+
+
+def synthetic_stream(n_tokens, seed):
+    """A long Thought that never trips a stop condition, so every token gets scanned,
+    ending with a query that does"""
+    rng = random.Random(seed)
+    words = ['the', ' total', ' revenue', ' per', ' nation', ' lineitem', ' join', ' orders', '\n', ' 1.', ' step',
+             ' ask', ' user', ' query', ' `', ' result', ',', ' customer', ' Thought', '.']
+    tokens = ['Thought:']
+    tokens += [rng.choice(words) for _ in range(n_tokens - 6)]
+    tokens += ['\nQuery:', '\n```', 'SELECT 1', '\n```', ' /End']
+    return tokens
+
+
+def time_per_token(tokens, scan):
+    """Return list of seconds spent on each token"""
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()): # silence the "Stopping prediction..." prints
+        scan_token = scan()
+        for token in tokens:
+            start = time.perf_counter()
+            stop_index = scan_token(token)
+            timings.append(time.perf_counter() - start)
+            if stop_index:
+                break
+    return timings
+
+
+def full_rescan():
+    full_response = ''
+    def scan_token(token):
+        nonlocal full_response
+        full_response += token
+        return check_for_stop_conditions(full_response)
+    return scan_token
+
+
+def incremental():
+    return StopConditionScanner().feed
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    streams = [synthetic_stream(args.tokens, seed) for seed in range(args.streams)]
+
+    for name, scan in [('check_for_stop_conditions', full_rescan), ('StopConditionScanner', incremental)]:
+        bucket_totals = [0.0] * args.buckets
+        bucket_counts = [0] * args.buckets
+        for tokens in streams:
+            timings = time_per_token(tokens, scan)
+            bucket_size = -(-len(timings) // args.buckets)
+            for i, t in enumerate(timings):
+                bucket_totals[i // bucket_size] += t
+                bucket_counts[i // bucket_size] += 1
+        per_token_us = [1e6 * total / max(count, 1) for total, count in zip(bucket_totals, bucket_counts)]
+        print(f'\n{name}: mean microseconds per token, by position in a {args.tokens}-token stream')
+        for i, cost in enumerate(per_token_us):
+            print(f'  tokens {i * args.tokens // args.buckets:>5}-{(i + 1) * args.tokens // args.buckets:<5} {cost:8.2f}')
+        print(f'  last bucket / first bucket: {per_token_us[-1] / per_token_us[0]:.1f}x')
@@ -0,0 +1,174 @@
+"""
+Latency and memory of LLM-style queries on TPC-H as the data grows: a fixed catalogue of queries, the kind
+the LLM writes, plus the example queries in db_specific_prompts['tpch'], each run through query_manager
+(uncached) against every scale factor built by
+
+    python db_utils/make_tpch.py 0.01 0.1 1 10
+
+Each query at each scale runs in its own process, so the peak RSS of one doesn't hide the next. The first run
+is reported as cold, and the median of the --repeat runs after it as warm. RSS is how much the peak grew
+while the query ran. --csv writes every measurement out, to chart.
+
+Run from the repo root:
+    python benchmarks/bench_tpch_scales.py --repeat 3 --csv tpch_scales.csv
+"""
+import os
+import re
+import sys
+import csv
+import glob
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import resource
+import contextlib
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from db_specific_prompts import db_specific_prompts
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db', nargs='+', default=None, help='TPC-H DuckDB files. Defaults to ./db_files/tpch/sf*/tpch.duckdb')
+parser.add_argument('--repeat', default=3, type=int, help='Warm runs of each query, after the cold one')
+parser.add_argument('--queries', nargs='+', default=None, help='Only run the catalogue queries with these names')
+parser.add_argument('--csv', default=None, help='Write the measurements to this CSV file')
+parser.add_argument('--query', default=None, help=argparse.SUPPRESS) # used for the child processes
+
+# the shapes of query the LLM writes most: whole tables, counts, joins with aggregates, top-N and filters
+QUERY_CATALOGUE = {
+    'select * lineitem': 'SELECT * FROM lineitem;',
+    'count orders': 'SELECT COUNT(*) FROM orders;',
+    'revenue by year': """SELECT year(o.o_orderdate) AS year, SUM(l.l_extendedprice * (1 - l.l_discount)) AS revenue
+FROM main.orders o JOIN main.lineitem l ON l.l_orderkey = o.o_orderkey GROUP BY year ORDER BY year;""",
+    'top customers by spend': """SELECT c.c_name, n.n_name, SUM(o.o_totalprice) AS total_spend
+FROM main.customer c JOIN main.orders o ON o.o_custkey = c.c_custkey JOIN main.nation n ON n.n_nationkey = c.c_nationkey
+GROUP BY c.c_name, n.n_name ORDER BY total_spend DESC LIMIT 10;""",
+    'orders per customer': """SELECT c.c_name, COUNT(o.o_orderkey) AS order_count
+FROM main.customer c LEFT JOIN main.orders o ON o.o_custkey = c.c_custkey GROUP BY c.c_name;""",
+    'parts like': "SELECT p_name, p_retailprice FROM part WHERE p_name ILIKE '%green%' LIMIT 20;",
+    'pricing summary (Q1)': """SELECT l_returnflag, l_linestatus, SUM(l_quantity) AS sum_qty, SUM(l_extendedprice) AS sum_base_price,
+SUM(l_extendedprice * (1 - l_discount)) AS sum_disc_price, AVG(l_discount) AS avg_disc, COUNT(*) AS count_order
+FROM lineitem WHERE l_shipdate <= DATE '1998-09-02' GROUP BY l_returnflag, l_linestatus ORDER BY l_returnflag, l_linestatus;""",
+    'shipping priority (Q3)': """SELECT l.l_orderkey, SUM(l.l_extendedprice * (1 - l.l_discount)) AS revenue, o.o_orderdate, o.o_shippriority
+FROM customer c JOIN orders o ON c.c_custkey = o.o_custkey JOIN lineitem l ON l.l_orderkey = o.o_orderkey
+WHERE c.c_mktsegment = 'BUILDING' AND o.o_orderdate < DATE '1995-03-15' AND l.l_shipdate > DATE '1995-03-15'
+GROUP BY l.l_orderkey, o.o_orderdate, o.o_shippriority ORDER BY revenue DESC, o.o_orderdate LIMIT 10;""",
+    'local supplier volume (Q5)': """SELECT n.n_name, SUM(l.l_extendedprice * (1 - l.l_discount)) AS revenue
+FROM customer c JOIN orders o ON c.c_custkey = o.o_custkey JOIN lineitem l ON l.l_orderkey = o.o_orderkey
+JOIN supplier s ON l.l_suppkey = s.s_suppkey AND c.c_nationkey = s.s_nationkey JOIN nation n ON s.s_nationkey = n.n_nationkey
+JOIN region r ON n.n_regionkey = r.r_regionkey
+WHERE r.r_name = 'ASIA' AND o.o_orderdate >= DATE '1994-01-01' AND o.o_orderdate < DATE '1995-01-01'
+GROUP BY n.n_name ORDER BY revenue DESC;""",
+    'revenue change forecast (Q6)': """SELECT SUM(l_extendedprice * l_discount) AS revenue FROM lineitem
+WHERE l_shipdate >= DATE '1994-01-01' AND l_shipdate < DATE '1995-01-01' AND l_discount BETWEEN 0.05 AND 0.07 AND l_quantity < 24;""",
+}
+PROMPT_QUERY_RE = re.compile(r'Query:\s*```(.*?)```', re.DOTALL)
+SF_RE = re.compile(r'[/\\]sf([\d.]+)[/\\]')
+
+
+def catalogue():
+    """{name: query}: QUERY_CATALOGUE and the examples the tpch prompt gives the LLM"""
+    queries = dict(QUERY_CATALOGUE)
+    for i, query in enumerate(PROMPT_QUERY_RE.findall(db_specific_prompts['tpch'])):
+        queries[f'prompt example {i + 1}'] = query.strip()
+    return queries
+
+def scale_factor(db_file):
+    """From the sf<N> directory make_tpch.py writes to, or else estimated from the size of lineitem"""
+    match = SF_RE.search(db_file)
+    if match:
+        return float(match.group(1))
+    import duckdb
+    db = duckdb.connect(db_file, read_only=True)
+    rows = db.execute("SELECT estimated_size FROM duckdb_tables() WHERE table_name = 'lineitem'").fetchone()[0]
+    db.close()
+    return round(rows / 6e6, 3)
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in KB on Linux
+
+
+def measure(db_file, query, repeat):
+    """Run in a child process: print the cold and warm latency, peak RSS growth and outcome, as JSON"""
+    import pandas # imported before taking the baseline, so it isn't counted
+    from utils import query_manager, is_query_error, QUERY_TIMEOUT_PREFIX, QUERY_REJECTED_PREFIX
+    from db_manager import checkout
+    with checkout(db_file) as db:
+        db.sql('SELECT 1').fetchall() # open the database before taking the baseline
+    baseline = peak_rss_mb()
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()): # silence the debug prints along the way
+        for _ in range(1 + repeat):
+            start = time.perf_counter()
+            result_string, _ = query_manager(db_file, query, use_cache=False)
+            timings.append(time.perf_counter() - start)
+            if is_query_error(result_string):
+                break # an error or a timeout is the same every time
+    outcome = 'ok'
+    if result_string.startswith(QUERY_TIMEOUT_PREFIX):
+        outcome = 'timeout'
+    elif result_string.startswith(QUERY_REJECTED_PREFIX): # by admission control, over one of its cost limits
+        outcome = 'rejected: ' + result_string.splitlines()[2].split(': ', 1)[-1]
+    elif is_query_error(result_string):
+        outcome = ('error: ' + result_string.splitlines()[1][:100]) if '\n' in result_string else 'error'
+    print(json.dumps({'cold':timings[0], 'warm':statistics.median(timings[1:]) if len(timings) > 1 else None,
+                      'rss_mb':peak_rss_mb() - baseline, 'outcome':outcome}))
+
+
+def run(db_files, queries, repeat):
+    """[measurement dict] for every query at every scale"""
+    measurements = []
+    for db_file in db_files:
+        sf = scale_factor(db_file)
+        print(f'\nSF {sf:g}  {db_file}')
+        for name, query in queries.items():
+            result = subprocess.run([sys.executable, __file__, '--db', db_file, '--query', query, '--repeat', str(repeat)],
+                                    capture_output=True, text=True)
+            if result.returncode != 0:
+                measurement = {'cold':None, 'warm':None, 'rss_mb':None, 'outcome':'crashed: ' + result.stderr.strip().splitlines()[-1][:100]}
+            else:
+                measurement = json.loads(result.stdout.strip().splitlines()[-1])
+            measurements.append({'sf':sf, 'db':db_file, 'query':name, **measurement})
+            warm = f"{measurement['warm']:8.3f} s" if measurement['warm'] is not None else '       -  '
+            cold = f"{measurement['cold']:8.3f} s" if measurement['cold'] is not None else '       -  '
+            rss = f"{measurement['rss_mb']:8.1f} MB" if measurement['rss_mb'] is not None else ''
+            print(f"  {name:<30} cold {cold}  warm {warm}  RSS +{rss}  {'' if measurement['outcome'] == 'ok' else measurement['outcome']}")
+    return measurements
+
+def print_growth(measurements):
+    """Warm latency of each query at each scale, side by side"""
+    scales = sorted({m['sf'] for m in measurements})
+    by_query = {}
+    for m in measurements:
+        by_query.setdefault(m['query'], {})[m['sf']] = m
+    print(f'\n  {"Warm latency (s)":<30}  ' + ''.join(f'{"SF " + format(sf, "g"):>12}' for sf in scales))
+    for name, by_scale in by_query.items():
+        cells = []
+        for sf in scales:
+            m = by_scale.get(sf)
+            value = m and (m['warm'] if m['warm'] is not None else m['cold'])
+            cells.append(f'{value:12.3f}' if value is not None else f"{m['outcome'][:11] if m else '':>12}")
+        print(f'  {name:<30}' + ' ' * 2 + ''.join(cells))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.query:
+        measure(args.db[0], args.query, args.repeat)
+        sys.exit()
+
+    db_files = args.db or sorted(glob.glob('./db_files/tpch/sf*/tpch.duckdb'), key=scale_factor)
+    if not db_files:
+        sys.exit('No TPC-H files found. Build them with: python db_utils/make_tpch.py 0.01 0.1 1 10')
+    queries = catalogue()
+    if args.queries:
+        queries = {name:query for name, query in queries.items() if name in args.queries}
+    measurements = run(sorted(db_files, key=scale_factor), queries, args.repeat)
+    print_growth(measurements)
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=['sf', 'db', 'query', 'cold', 'warm', 'rss_mb', 'outcome'])
+            writer.writeheader()
+            writer.writerows(measurements)
@@ -0,0 +1,248 @@
+"""
+Time and peak memory of building the WCA database from its MySQL dump: the streaming importer in
+db_utils/make_wca.py, compared with the statement-at-a-time loop it replaced (legacy_import below, kept as it
+was). Both build a database from the same synthetic dump, shaped like the WCA export: a few small tables, and
+Persons and Results as one INSERT of many rows each, with names like O\\'Brien, NULLs, and strings holding
+commas, brackets and newlines. The tables they build are checked to be the same.
+
+Each importer runs in its own process so the peak RSS of one doesn't hide the other.
+
+Run from the repo root:
+    python benchmarks/bench_wca_import.py --results 200000
+    python benchmarks/bench_wca_import.py --dump ./db_files/wca/WCA_export.sql   # a real export, if you have one
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import resource
+import tempfile
+import contextlib
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db_utils'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dump', default=None, help='MySQL dump to import. Defaults to a synthetic one')
+parser.add_argument('--results', default=200000, type=int, help='Rows of the Results table in the synthetic dump')
+parser.add_argument('--workers', default=4, type=int, help='Tables loaded at the same time by the streaming importer')
+parser.add_argument('--mode', default=None, choices=['legacy', 'streaming'], help=argparse.SUPPRESS) # used for the child processes
+parser.add_argument('--db', default=None, help=argparse.SUPPRESS)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in KB on Linux
+
+
+#### the importer make_wca.py used to be
+
+def legacy_import(files, dbfile):
+    import duckdb
+    import sqlglot
+    db = duckdb.connect(dbfile)
+    for file in files:
+        with open(file,'r') as f:
+            mysql_query = ''
+            in_query = False
+            for line in f:
+                if ('CREATE' in line) or ('INSERT' in line):
+                    in_query = True
+                if re.search(r';\s*$',line): #then it is probably the end of the SQL statement we want to execute
+                    mysql_query += '\n' + line
+                    if mysql_query.startswith('\nLOCK TABLES') or mysql_query.startswith('\nUNLOCK') or 'ar_internal_metadata' in mysql_query:
+                        pass #skip the query
+                    else:
+                        if ('INSERT INTO `RanksAverage`' in line[:100]) or ('INSERT INTO `RanksSingle`' in line[:100]) or ('INSERT INTO `RoundTypes`' in line[:100]) or ('INSERT INTO `Scrambles`' in line[:100]) or ('INSERT INTO `Results`' in line[:100]) or ('INSERT INTO `Persons`' in line[:100]):
+                            # strip backticks from Table name
+                            mysql_query = mysql_query[:100].replace('`','"') + mysql_query[100:]
+
+                            # Deal with escapes for names like O'Brien
+                            mysql_query = mysql_query.replace(r"\'",r"''")
+
+                            duckdb_queries = [mysql_query] # YOLO without transpiling if it's an insert.
+                        else:
+                            print(f'\nTranspiling {line[:200]} ...')
+                            duckdb_queries = sqlglot.transpile(mysql_query,read='mysql',write='duckdb')
+                        for query in duckdb_queries:
+                            print(f'\nExecuting {query[:200]} ...')
+                            query = query.replace('COLLATE utf8mb4_unicode_ci','') # don't need to specify collation
+                            query = query.replace('COLLATE utf8mb3_general_ci','') # don't need to specify collation
+                            query = query.replace('CHARACTER SET utf8mb3','')
+                            query = query.replace('TINYINT(1)','INT')
+                            db.sql(query)
+                    mysql_query = ''
+                    in_query = False
+                elif in_query: # we're in the query but haven't hit the end
+                    mysql_query += '\n' + line
+    db.close()
+
+
+#### a synthetic dump
+
+TABLE_HEADER = """--
+-- Table structure for table `{table}`
+--
+
+DROP TABLE IF EXISTS `{table}`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+{ddl}
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `{table}`
+--
+
+LOCK TABLES `{table}` WRITE;
+/*!40000 ALTER TABLE `{table}` DISABLE KEYS */;
+"""
+TABLE_FOOTER = """/*!40000 ALTER TABLE `{table}` ENABLE KEYS */;
+UNLOCK TABLES;
+
+"""
+DDL = {
+'Competitions': """CREATE TABLE `Competitions` (
+  `id` varchar(32) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `name` varchar(50) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `cityName` varchar(50) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `countryId` varchar(50) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `information` mediumtext COLLATE utf8mb4_unicode_ci,
+  `year` smallint unsigned NOT NULL DEFAULT '0',
+  `latitude` int DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;""",
+'RoundTypes': """CREATE TABLE `RoundTypes` (
+  `id` char(1) CHARACTER SET utf8mb3 COLLATE utf8mb3_general_ci NOT NULL DEFAULT '',
+  `rank` int NOT NULL DEFAULT '0',
+  `name` varchar(50) CHARACTER SET utf8mb3 COLLATE utf8mb3_general_ci NOT NULL DEFAULT '',
+  `final` tinyint(1) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;""",
+'Persons': """CREATE TABLE `Persons` (
+  `id` varchar(10) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `subid` tinyint NOT NULL DEFAULT '1',
+  `name` varchar(80) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
+  `countryId` varchar(50) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `gender` char(1) COLLATE utf8mb4_unicode_ci DEFAULT ''
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;""",
+'Results': """CREATE TABLE `Results` (
+  `competitionId` varchar(32) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `eventId` varchar(6) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `roundTypeId` char(1) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `pos` smallint NOT NULL DEFAULT '0',
+  `best` int NOT NULL DEFAULT '0',
+  `average` int NOT NULL DEFAULT '0',
+  `personName` varchar(80) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
+  `personId` varchar(10) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT '',
+  `value1` int NOT NULL DEFAULT '0',
+  `value2` int NOT NULL DEFAULT '0',
+  `value3` int NOT NULL DEFAULT '0',
+  `regionalSingleRecord` char(3) COLLATE utf8mb4_unicode_ci DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;""",
+'ar_internal_metadata': """CREATE TABLE `ar_internal_metadata` (
+  `key` varchar(255) NOT NULL,
+  `value` varchar(255) DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;""",
+}
+FIRST_NAMES = ["Sean", "Maria", "Feliks", "Yusheng", "Max", "Zoë", "Łukasz", "Mats", "Anna-Lena"]
+LAST_NAMES = ["O\\'Brien", "D\\'Angelo", "Zemdegs", "Du", "Park", "Valk", "Müller", "Ng (吴)", "Smith, Jr."]
+EVENTS = ['333', '222', '444', 'pyram', 'clock', '333oh']
+
+def sql_string(value):
+    return 'NULL' if value is None else f"'{value}'"
+
+def write_insert(f, table, rows):
+    f.write(f'INSERT INTO `{table}` VALUES ')
+    f.write(','.join('(' + ','.join(rows_values) + ')' for rows_values in rows))
+    f.write(';\n')
+
+def write_synthetic_dump(path, n_results, seed=0):
+    """A dump shaped like the WCA export, with n_results rows of Results"""
+    rng = random.Random(seed)
+    competitions = [f'Open{year}{i}' for year in range(2003, 2023) for i in range(20)]
+    persons = []
+    for i in range(max(100, n_results // 20)):
+        last_name = LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)]
+        id = f"{2003 + i % 20}{re.sub('[^A-Z]', 'X', last_name[:4].upper())}{i:02d}"
+        persons.append((id, f'{FIRST_NAMES[i % len(FIRST_NAMES)]} {last_name}'))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('-- MySQL dump 10.13  Distrib 8.0.34, for Linux (x86_64)\n--\n-- Host: localhost    Database: wca_export\n\n'
+                '/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;\n/*!50503 SET NAMES utf8mb4 */;\n\n')
+        tables = {
+            'Competitions':[[sql_string(id), sql_string(f'{id} (the {i}th, again)'), sql_string(rng.choice(['Paris', "L\\'Aquila", 'Multiple cities'])),
+                             sql_string('France'), sql_string(rng.choice([None, 'Line one\\r\\nLine two: \\"quoted\\", and (brackets)', 'C:\\\\cubes\\\\'])),
+                             str(2003 + i // 20), rng.choice(['NULL', str(rng.randint(-90000000, 90000000))])]
+                            for i, id in enumerate(competitions)],
+            'RoundTypes':[[sql_string(id), str(rank), sql_string(name), str(final)] for rank, (id, name, final) in
+                          enumerate([('1', 'First round', 0), ('2', 'Second round', 0), ('f', 'Final', 1), ('c', 'Combined Final', 1)])],
+            'Persons':[[sql_string(id), '1', sql_string(name), sql_string(rng.choice(['USA', 'Ireland', "Cote d\\'Ivoire"])), sql_string(rng.choice('mf'))]
+                       for id, name in persons],
+            'Results':[[sql_string(rng.choice(competitions)), sql_string(rng.choice(EVENTS)), sql_string(rng.choice('12fc')), str(rng.randint(1, 100)),
+                        str(rng.randint(500, 20000)), str(rng.randint(500, 20000)), sql_string(name), sql_string(id),
+                        str(rng.randint(500, 20000)), str(rng.randint(-2, 20000)), str(rng.randint(-2, 20000)),
+                        sql_string(rng.choice([None] * 20 + ['NR', 'WR']))]
+                       for id, name in (rng.choice(persons) for _ in range(n_results))],
+            'ar_internal_metadata':[[sql_string('environment'), sql_string('production')]],
+        }
+        for table, rows in tables.items():
+            f.write(TABLE_HEADER.format(table=table, ddl=DDL[table]))
+            write_insert(f, table, rows)
+            f.write(TABLE_FOOTER.format(table=table))
+
+
+#### measurement
+
+def run_importer(mode, dump, db_file, workers):
+    """Run in a child process: print the seconds taken and peak RSS"""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # silence the importers' progress prints
+        if mode == 'legacy':
+            legacy_import([dump], db_file)
+        else:
+            from make_wca import import_dump
+            import_dump([dump], db_file, workers)
+    print(json.dumps({'seconds':time.perf_counter() - start, 'peak_rss_mb':peak_rss_mb()}))
+
+def table_fingerprints(db_file):
+    """{table: (rows, order-independent hash of the rows)}"""
+    import duckdb
+    db = duckdb.connect(db_file, read_only=True)
+    tables = [row[0] for row in db.execute('SHOW TABLES').fetchall()]
+    fingerprints = {table:db.execute(f'SELECT count(*), sum(hash(t)) FROM "{table}" AS t').fetchone() for table in tables}
+    db.close()
+    return fingerprints
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.mode:
+        run_importer(args.mode, args.dump, args.db, args.workers)
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = args.dump
+        if dump is None:
+            dump = os.path.join(tmp, 'WCA_export_synthetic.sql')
+            write_synthetic_dump(dump, args.results)
+        print(f'{dump}: {os.path.getsize(dump) / 2**20:.1f} MB')
+        fingerprints = {}
+        for mode in ['legacy', 'streaming']:
+            db_file = os.path.join(tmp, f'{mode}.duckdb')
+            result = subprocess.run([sys.executable, __file__, '--mode', mode, '--dump', dump, '--db', db_file, '--workers', str(args.workers)],
+                                    capture_output=True, text=True)
+            if result.returncode != 0:
+                print(f'  {mode:<10} failed:\n{result.stderr[-2000:]}')
+                continue
+            measurement = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f"  {mode:<10} {measurement['seconds']:8.2f} s, peak RSS {measurement['peak_rss_mb']:8.1f} MB")
+            fingerprints[mode] = table_fingerprints(db_file)
+        if len(fingerprints) == 2:
+            same = fingerprints['legacy'] == fingerprints['streaming']
+            print(f"Tables {'match' if same else 'DIFFER'}: " +
+                  ', '.join(f'{table} {n_rows:,} rows' for table, (n_rows, _) in sorted(fingerprints['streaming'].items())))
+            if not same:
+                for table in sorted(set(fingerprints['legacy']) | set(fingerprints['streaming'])):
+                    print(f"  {table:<24} legacy {fingerprints['legacy'].get(table)}  streaming {fingerprints['streaming'].get(table)}")
+                sys.exit(1)
@@ -0,0 +1,110 @@
+"""
+Write several candidate responses for an agent step at once, and keep the first one that works.
+
+SQLCoder and LLaMA often write a first query that doesn't bind or doesn't run, and each retry is another
+full round trip to the model. With more than one candidate, the predictions for a step are started together,
+at different temperatures and/or with different models. Each candidate is checked as soon as it has finished
+streaming: its query is pre-flighted against the database's catalog and then run. The first candidate whose
+query runs without an error, or that chose an action other than a query, wins, and the other predictions are
+cancelled. If every candidate's query fails, the first one to finish is used, and its error goes back to the
+model as usual.
+
+Every candidate is logged as an LLM call of its own, including the cancelled ones.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import choose_next_action, preflight_query, query_manager, is_query_error, \
+    generate_logging_uuid, log_llm_call, log_response
+from llm_backends import stream_response
+
+PARALLEL_CANDIDATES = int(os.environ.get('PARALLEL_CANDIDATES', default=1)) # 1 writes one response at a time
+CANDIDATE_TEMPERATURE_STEP = float(os.environ.get('CANDIDATE_TEMPERATURE_STEP', default=0.3))
+MAX_TEMPERATURE = 5.0 # the top of the sidebar's temperature slider
+
+# candidates spend most of their time waiting on the model, so this can be generous
+candidate_workers = ThreadPoolExecutor(max_workers=32, thread_name_prefix='candidate')
+
+
+class Candidate:
+    """One prediction for an agent step, and what came of it"""
+
+    def __init__(self, index, llm, input):
+        self.index = index
+        self.llm = llm
+        self.input = input
+        self.call_uuid = generate_logging_uuid()
+        self.prediction = None
+        self.response = ''
+        self.next_action = None
+        self.next_action_input = None
+        self.query_result = None # (string_out, md_out), if the response is a query that was run
+        self.finished_at = None
+
+    @property
+    def valid(self):
+        if self.next_action != 'query':
+            return True
+        return self.query_result is not None and not is_query_error(self.query_result[0])
+
+
+def candidate_inputs(llms, input, n_candidates):
+    """(llm, input) for each candidate: the models take turns, and each time round the list
+       the temperature goes up by CANDIDATE_TEMPERATURE_STEP"""
+    candidates = []
+    for i in range(n_candidates):
+        candidate_input = dict(input)
+        candidate_input['temperature'] = min(MAX_TEMPERATURE, input['temperature'] + CANDIDATE_TEMPERATURE_STEP * (i // len(llms)))
+        candidates.append((llms[i % len(llms)], candidate_input))
+    return candidates
+
+
+def run_candidate(backend, candidate, db_file, decided, session_uuid):
+    log_llm_call(candidate.llm, candidate.input, candidate.call_uuid, session_uuid)
+    candidate.prediction = backend.create(candidate.llm, candidate.input)
+    if decided.is_set(): # another candidate won while this one was starting
+        candidate.prediction.cancel()
+    candidate.response = stream_response(candidate.prediction)
+    log_response(candidate.response, candidate.call_uuid, session_uuid)
+    candidate.next_action, candidate.next_action_input = choose_next_action(candidate.response)
+    if candidate.next_action == 'query' and not decided.is_set():
+        candidate.query_result = preflight_query(db_file, candidate.next_action_input) \
+            or query_manager(db_file, candidate.next_action_input)
+    candidate.finished_at = time.perf_counter()
+    return candidate
+
+
+def generate_candidates(backend, llms, input, db_file, n_candidates, session_uuid):
+    """Race n_candidates predictions for one agent step. Returns the winning Candidate and a dict of metrics.
+       A winner that chose a query carries its result, so the query doesn't need to be run again"""
+    start = time.perf_counter()
+    decided = threading.Event()
+    candidates = [Candidate(i, llm, candidate_input) for i, (llm, candidate_input) in enumerate(candidate_inputs(llms, input, n_candidates))]
+    pending = {candidate_workers.submit(run_candidate, backend, candidate, db_file, decided, session_uuid) for candidate in candidates}
+    finished = [] # in the order they finished
+    errors = []
+    winner = None
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                print(f'Candidate failed: {future.exception()}')
+                errors.append(future.exception())
+            else:
+                finished.append(future.result())
+        finished.sort(key=lambda candidate: candidate.finished_at)
+        winner = next((candidate for candidate in finished if candidate.valid), None)
+    decided.set()
+    for candidate in candidates:
+        if candidate is not winner and candidate.prediction is not None:
+            candidate.prediction.cancel()
+    if winner is None:
+        if not finished:
+            raise errors[0]
+        winner = finished[0] # every query failed, so hand back the first error
+    elapsed = time.perf_counter() - start
+    metrics = {'candidates':n_candidates, 'finished':len(finished), 'valid':sum(candidate.valid for candidate in finished),
+               'failed':len(errors), 'winner':winner.index, 'winner_llm':winner.llm, 'winner_temperature':winner.input['temperature'],
+               'seconds_to_winner':winner.finished_at - start, 'seconds':elapsed}
+    return winner, metrics
@@ -0,0 +1,258 @@
+"""
+Fit the prompt into the model's context window.
+
+Every LLM call sends the schema, the system prompt and the whole dialogue so far. In a long session, e.g. the
+LLM iterating over query errors, that eventually overflows the model's context window and the session stops
+working, while most of the tokens are spent on old query results nobody needs anymore.
+
+fit_prompt counts the tokens of each part of the prompt and, only if the whole thing doesn't fit, trims it
+step by step until it does:
+    1. earlier query errors are cut to their first line, and repeats of the same error collapsed
+    2. earlier query results are cut down to their first few lines
+    3. the columns of tables the conversation never mentions are dropped from the schema (their names stay)
+    4. earlier query results are dropped altogether
+    5. the oldest messages are dropped, always keeping the latest question and what followed it
+If it still doesn't fit - the schema and the latest question and response alone are too long - PromptTooLong is
+raised rather than sending a prompt the model would cut off.
+
+Tokens are counted with a tokenizer.json file, if TOKENIZER_FILE names one and the tokenizers package is
+installed (pip install tokenizers). Otherwise they are estimated in a way that follows the LLaMA tokenizer:
+each digit, symbol and newline is a token of its own, and words take a token per few characters.
+The estimate errs on the high side.
+"""
+import os
+import re
+import math
+import functools
+import pandas as pd
+from utils import is_query_error, QUERY_ERROR_PREFIX, QUERY_TIMEOUT_PREFIX
+from prompt_tools import get_schema, list_table_schemas, render_message
+from schema_catalog import column_hints
+from db_specific_prompts import db_specific_prompts
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+TOKENIZER_FILE = os.environ.get('TOKENIZER_FILE', default='')
+CONTEXT_WINDOW_TOKENS = int(os.environ.get('CONTEXT_WINDOW_TOKENS', default=0)) # 0 uses the model's own window
+CONTEXT_RESPONSE_RESERVE = int(os.environ.get('CONTEXT_RESPONSE_RESERVE', default=768)) # tokens kept free for the response
+ESTIMATE_MARGIN = 1.1
+
+# context window of each model family, matched against the endpoint name. The first match wins
+MODEL_CONTEXT_WINDOWS = [
+    ('codellama', 16384),
+    ('sqlcoder', 8192),
+    ('llama', 4096),
+]
+DEFAULT_CONTEXT_WINDOW = 4096
+
+KEEP_RESULT_LINES = 6 # header, separator and the first rows of a truncated query result
+ESTIMATE_PIECES_RE = re.compile(r'[A-Za-z]+|\d|\n| {2,}|[^\x00-\x7f]|[^\sA-Za-z\d]')
+
+
+def context_window_tokens(llm):
+    if CONTEXT_WINDOW_TOKENS:
+        return CONTEXT_WINDOW_TOKENS
+    llm = llm.lower()
+    for family, window in MODEL_CONTEXT_WINDOWS:
+        if family in llm:
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+@functools.lru_cache(maxsize=1)
+def load_tokenizer(path):
+    if Tokenizer is None or not path:
+        return None
+    return Tokenizer.from_file(path)
+
+def estimate_tokens(text):
+    n_tokens = 0
+    for piece in ESTIMATE_PIECES_RE.findall(text):
+        if piece[0].isalpha() and piece.isascii():
+            n_tokens += math.ceil(len(piece) / 4)
+        elif piece[0] == ' ':
+            n_tokens += math.ceil(len(piece) / 4) # runs of spaces, e.g. indentation
+        elif not piece.isascii():
+            n_tokens += 2 # byte fallback
+        else:
+            n_tokens += 1
+    return math.ceil(n_tokens * ESTIMATE_MARGIN)
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Tokens in a piece of the prompt. Cached, as the same messages are counted again on every LLM call"""
+    tokenizer = load_tokenizer(TOKENIZER_FILE)
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return estimate_tokens(text)
+
+
+class PromptTooLong(Exception):
+    """The prompt can't be trimmed enough to fit the context window"""
+
+    def __init__(self, prompt_tokens, budget, window, schema_fits):
+        advice = 'Ask a shorter question, or start a new chat.' if schema_fits else \
+            ("The database's schema alone doesn't fit: choose a model with a larger context window, or set "
+             'CONTEXT_WINDOW_TOKENS if the model has a larger one than assumed.')
+        super().__init__(f'The prompt is too long for the model: even trimmed, it takes {prompt_tokens} tokens, and the '
+                         f'{window} token context window leaves room for {budget}. {advice}')
+        self.prompt_tokens = prompt_tokens
+        self.budget = budget
+        self.window = window
+
+
+class ContextView:
+    """The parts of a Conversation's prompt, in a form that can be trimmed without changing the conversation"""
+
+    def __init__(self, conversation, db_file):
+        self.pre_prompt = conversation.pre_prompt
+        self.tables = None # the schema as a dataframe, if the preprompt is the standard one and can be trimmed by table
+        schema = get_schema(db_file)
+        df = pd.DataFrame(schema['tables'])
+        db_specific = db_specific_prompts.get(schema['database_name'], '')
+        hints = column_hints(db_file)
+        if list_table_schemas(df, db_specific, hints) == self.pre_prompt:
+            self.tables, self.db_specific, self.hints = df, db_specific, hints
+        self.messages = [] # {'role', 'text' as sent to the LLM, 'is_error'}
+        for message in conversation.chat_dialogue:
+            if 'result_id' in message:
+                text = conversation.query_results[message['result_id']][0]
+                self.messages.append({'role':'🦆', 'text':text, 'is_error':is_query_error(text)})
+            else:
+                self.messages.append({'role':message['role'], 'text':message['content'], 'is_error':False})
+
+    @staticmethod
+    def render_part(message):
+        if 'omitted' in message: # stands in for messages that were dropped
+            return f'({message["omitted"]} earlier messages of this conversation are omitted to save space.)\n\n'
+        return render_message(message['role'], message['text'])
+
+    def render(self):
+        return self.pre_prompt + ''.join(self.render_part(m) for m in self.messages)
+
+    def segment_tokens(self):
+        tokens = {'schema':count_tokens(self.pre_prompt), 'dialogue':0, 'query_results':0}
+        for message in self.messages:
+            segment = 'query_results' if message['role'] == '🦆' else 'dialogue'
+            tokens[segment] += count_tokens(self.render_part(message))
+        return tokens
+
+    def earlier_results(self):
+        """Query results other than the latest one"""
+        results = [m for m in self.messages if m['role'] == '🦆']
+        return results[:-1]
+
+    def latest_question_index(self):
+        for i in range(len(self.messages) - 1, -1, -1):
+            if self.messages[i]['role'] == 'user':
+                return i
+        return len(self.messages)
+
+
+def collapse_errors(view):
+    """Cut earlier errors to their first line, and repeats of the same error to a note"""
+    changed = False
+    previous_error = None
+    for message in view.earlier_results():
+        if not message['is_error']:
+            previous_error = None
+            continue
+        prefix = QUERY_ERROR_PREFIX if message['text'].startswith(QUERY_ERROR_PREFIX) else QUERY_TIMEOUT_PREFIX
+        first_line = prefix + ' ' + message['text'][len(prefix):].strip().split('\n')[0][:200]
+        text = '(The same error again.)' if first_line == previous_error else first_line
+        previous_error = first_line
+        if text != message['text']:
+            message['text'] = text
+            changed = True
+    return changed
+
+def truncate_results(view, max_lines):
+    """Cut earlier query results to their first max_lines lines"""
+    changed = False
+    for message in view.earlier_results():
+        lines = message['text'].split('\n')
+        if message['is_error'] or len(lines) <= max_lines + 1:
+            continue
+        if max_lines:
+            message['text'] = '\n'.join(lines[:max_lines] + [f'... ({len(lines) - max_lines} more lines of this earlier result omitted)'])
+        else:
+            message['text'] = '(Earlier result omitted to save space.)'
+        changed = True
+    return changed
+
+def drop_unused_schema(view):
+    """Keep the columns of only the tables the conversation mentions"""
+    if view.tables is None:
+        return False
+    dialogue = ' '.join(m['text'] for m in view.messages).lower()
+    mentioned = view.tables['name'].map(lambda name: re.search(r'\b' + re.escape(name.lower()) + r'\b', dialogue) is not None)
+    if not mentioned.any() or mentioned.all():
+        return False
+    others = ', '.join(f'{row.schema}.{row.name}' for row in view.tables[~mentioned].itertuples())
+    note = f'The database also has the following tables, whose columns are omitted here to save space: {others}\n\n'
+    view.pre_prompt = list_table_schemas(view.tables[mentioned], note + view.db_specific, view.hints)
+    view.tables = None # only trim once
+    return True
+
+def drop_oldest_message(view):
+    """Drop the oldest message, but never the latest question or the latest response and its result"""
+    keep = {view.latest_question_index(), len(view.messages) - 2, len(view.messages) - 1}
+    for i, message in enumerate(view.messages):
+        if i not in keep and 'omitted' not in message:
+            break
+    else:
+        return False
+    view.messages.pop(i)
+    if i > 0 and 'omitted' in view.messages[i - 1]:
+        view.messages[i - 1]['omitted'] += 1
+    elif i < len(view.messages) and 'omitted' in view.messages[i]:
+        view.messages[i]['omitted'] += 1
+    else:
+        view.messages.insert(i, {'role':'note', 'omitted':1, 'is_error':False})
+    return True
+
+TRIM_STEPS = [
+    ('collapsed earlier errors', collapse_errors),
+    ('truncated earlier results', lambda view: truncate_results(view, KEEP_RESULT_LINES)),
+    ('dropped unused tables from the schema', drop_unused_schema),
+    ('dropped earlier results', lambda view: truncate_results(view, 0)),
+    ('dropped oldest messages', drop_oldest_message),
+]
+
+
+def fit_prompt(conversation, db_file, llm, system_prompt, max_new_tokens):
+    """Return the prompt to send for a Conversation, trimmed to fit the llm's context window if needed,
+       and a report of the tokens used by each part of it and what was trimmed.
+       The prompt leaves at least CONTEXT_RESPONSE_RESERVE tokens (or max_new_tokens, if fewer) for the response.
+       report['max_new_tokens'] is max_new_tokens cut down to what the prompt leaves: the length to ask for.
+       Raises PromptTooLong if it doesn't fit even after all the trimming"""
+    window = context_window_tokens(llm)
+    reserved = min(int(max_new_tokens), CONTEXT_RESPONSE_RESERVE)
+    fixed_tokens = count_tokens(system_prompt) + count_tokens('Assistant: ')
+    budget = window - reserved - fixed_tokens
+
+    prompt = conversation.prompt()
+    tokens = {'schema':count_tokens(conversation.pre_prompt), 'dialogue':0, 'query_results':0}
+    for message, segment in zip(conversation.chat_dialogue, conversation.segments[1:]):
+        tokens['query_results' if 'result_id' in message else 'dialogue'] += count_tokens(segment)
+    trimmed = []
+    if sum(tokens.values()) > budget:
+        view = ContextView(conversation, db_file)
+        for description, trim in TRIM_STEPS:
+            while sum(view.segment_tokens().values()) > budget and trim(view):
+                if description not in trimmed:
+                    trimmed.append(description)
+                if trim is not drop_oldest_message:
+                    break # the other steps do all they can in one go
+        prompt = view.render()
+        tokens = view.segment_tokens()
+        if sum(tokens.values()) > budget:
+            raise PromptTooLong(fixed_tokens + sum(tokens.values()), window - reserved, window, tokens['schema'] <= budget)
+
+    prompt_tokens = fixed_tokens + sum(tokens.values())
+    report = {'window':window, 'system_prompt':fixed_tokens, **tokens, 'reserved_for_response':reserved, 'trimmed':trimmed,
+              'max_new_tokens':max(reserved, min(int(max_new_tokens), window - prompt_tokens))}
+    report['total'] = prompt_tokens + reserved
+    return prompt, report
@@ -0,0 +1,205 @@
+"""
+Process-wide DuckDB connections, shared by all Streamlit sessions.
+
+Each database file is opened read-only once per process. Sessions don't hold their own connection -
+they check out a cursor on the shared connection for as long as they need it:
+
+    with checkout(db_file) as db:
+        db.sql(query).df()
+
+Cursors share the database instance (and its buffer cache), but each one can run a query independently,
+so concurrent sessions can query the same file at the same time. The number of cursors in use on each
+file is capped, and idle cursors are kept for reuse.
+
+Queries generated by the LLM go through run_with_deadline, which runs them on a worker thread and
+cancels them if they run past QUERY_TIMEOUT, so a runaway query can't hold up a session indefinitely.
+
+explain_query checks that a query parses and binds without running it. It plans the query against a
+shadow of the database: an in-memory database with the same name, schemas, tables and views, but no rows.
+That takes about a millisecond and never waits on the cursors running real queries.
+"""
+import os
+import re
+import time
+import functools
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError as FutureTimeoutError
+import duckdb
+import pandas # imported up front - duckdb otherwise imports it lazily on the first .df(), which can deadlock if that happens on several threads at once
+
+MAX_CURSORS_PER_DB = int(os.environ.get('DUCKDB_MAX_CURSORS', default=8))
+CURSOR_CHECKOUT_TIMEOUT = float(os.environ.get('DUCKDB_CHECKOUT_TIMEOUT', default=60)) # seconds
+QUERY_TIMEOUT = float(os.environ.get('QUERY_TIMEOUT', default=30)) # seconds a query may run before it is cancelled
+QUERY_INTERRUPT_GRACE = 5 # seconds to keep interrupting a timed out query while waiting for it to stop
+
+# Resource limits for each database instance. memory_limit and threads are database-wide settings in DuckDB,
+# so they apply to all the sessions sharing a file, e.g. DUCKDB_MEMORY_LIMIT=2GB DUCKDB_THREADS=4
+def database_config():
+    config = {}
+    if os.environ.get('DUCKDB_MEMORY_LIMIT'):
+        config['memory_limit'] = os.environ['DUCKDB_MEMORY_LIMIT']
+    if os.environ.get('DUCKDB_THREADS'):
+        config['threads'] = int(os.environ['DUCKDB_THREADS'])
+    return config
+
+
+class DatabasePool:
+    """One read-only connection to a database file, handing out a bounded number of cursors"""
+
+    def __init__(self, db_file, max_cursors=MAX_CURSORS_PER_DB, config=None):
+        self.db_file = db_file
+        self.connection = duckdb.connect(db_file, read_only=True, config=database_config() if config is None else config)
+        self.max_cursors = max_cursors
+        self._slots = threading.BoundedSemaphore(max_cursors)
+        self._idle_cursors = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def cursor(self, timeout=CURSOR_CHECKOUT_TIMEOUT):
+        """Check out a cursor, waiting up to timeout seconds if they are all in use"""
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f'Timed out after {timeout} s waiting for a free connection to {self.db_file}')
+        try:
+            with self._lock: # creating cursors on the shared connection isn't thread-safe
+                cursor = self._idle_cursors.pop() if self._idle_cursors else self.connection.cursor()
+            try:
+                yield cursor
+            finally:
+                with self._lock:
+                    self._idle_cursors.append(cursor)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for cursor in self._idle_cursors:
+                cursor.close()
+            self._idle_cursors = []
+            self.connection.close()
+
+
+pools = {} # absolute path of the database file -> DatabasePool
+pools_lock = threading.Lock()
+
+def get_pool(db_file):
+    """Return the pool for a database file, opening it the first time it is asked for"""
+    key = os.path.abspath(db_file)
+    with pools_lock:
+        if key not in pools:
+            pools[key] = DatabasePool(db_file)
+        return pools[key]
+
+def checkout(db_file, timeout=CURSOR_CHECKOUT_TIMEOUT):
+    """Context manager giving a cursor on the shared connection to db_file"""
+    return get_pool(db_file).cursor(timeout)
+
+class QueryTimeout(Exception):
+    """A query ran past its deadline and was cancelled"""
+
+    def __init__(self, timeout):
+        super().__init__(f'Query did not finish within the {timeout:g} second time limit')
+        self.timeout = timeout
+
+
+# queries run on these threads, so the caller can stop waiting on one that runs too long
+query_workers = ThreadPoolExecutor(max_workers=int(os.environ.get('QUERY_WORKERS', default=32)), thread_name_prefix='duckdb-query')
+
+def run_with_deadline(db_file, fn, timeout=QUERY_TIMEOUT):
+    """Check out a cursor on db_file and call fn(cursor) on a worker thread, returning its result.
+
+       If it takes longer than timeout seconds (including any wait for a free cursor), the query is
+       interrupted with Connection.interrupt(), which frees its worker and returns its cursor to the pool,
+       and QueryTimeout is raised.
+       """
+    state = {'cursor':None, 'abandoned':False}
+    state_lock = threading.Lock()
+
+    def work():
+        with checkout(db_file, timeout) as db:
+            with state_lock:
+                if state['abandoned']: # the deadline passed while waiting for a cursor
+                    return None
+                state['cursor'] = db
+            return fn(db)
+
+    future = query_workers.submit(work)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        with state_lock:
+            state['abandoned'] = True
+            cursor = state['cursor']
+        if cursor is not None:
+            # keep interrupting until the worker stops, in case the first interrupt landed just before the query started
+            deadline = time.monotonic() + QUERY_INTERRUPT_GRACE
+            while not future.done() and time.monotonic() < deadline:
+                cursor.interrupt()
+                wait([future], timeout=0.1)
+            if not future.done():
+                print(f'Query on {db_file} is still running {QUERY_INTERRUPT_GRACE} s after it was interrupted')
+        raise QueryTimeout(timeout)
+
+def db_file_identity(db_file):
+    """(absolute path, modification time, size) of a database file. The app only opens the files
+       read-only, so anything derived from a file's contents can be cached under this key"""
+    stat = os.stat(db_file)
+    return os.path.abspath(db_file), stat.st_mtime_ns, stat.st_size
+
+#### catalog-only shadow databases, for checking queries
+
+# statements EXPLAIN can plan. Anything else (PRAGMA, SHOW, DESCRIBE, ...) isn't checked
+EXPLAINABLE_RE = re.compile(r'^\s*\(*\s*(select|with|from|values|table)\b', re.IGNORECASE)
+STATEMENT_SEPARATOR_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|;")
+
+def single_statement(query):
+    """The query without trailing semicolons, or None if it is several statements"""
+    query = query.strip().rstrip(';').strip()
+    if any(match.group() == ';' for match in STATEMENT_SEPARATOR_RE.finditer(query)):
+        return None
+    return query
+
+@functools.lru_cache(maxsize=32)
+def shadow_database(db_path, mtime_ns, size):
+    """An in-memory copy of a database file's catalog, without any data. None if it can't be recreated,
+       e.g. because a table uses a user-defined type"""
+    with checkout(db_path) as db:
+        database_name = db.sql("""SELECT database_name FROM duckdb_databases() WHERE not internal""").fetchone()[0]
+        schemas = [schema for (schema,) in db.sql(f"""SELECT schema_name FROM duckdb_schemas() WHERE NOT internal AND database_name = '{database_name}'""").fetchall()]
+        statements = db.sql("""SELECT schema_name, sql FROM duckdb_tables() WHERE NOT internal
+                               UNION ALL SELECT schema_name, sql FROM duckdb_views() WHERE NOT internal""").fetchall()
+    shadow = duckdb.connect()
+    try:
+        shadow.execute(f"""ATTACH ':memory:' AS "{database_name}" """)
+        for schema in schemas:
+            shadow.execute(f'CREATE SCHEMA IF NOT EXISTS "{database_name}"."{schema}"')
+        for schema, sql in statements: # tables come first, as views refer to them
+            shadow.execute(f'USE "{database_name}"."{schema}"')
+            shadow.execute(sql)
+    except duckdb.Error as e:
+        print(f'Could not build a shadow of {db_path} for checking queries: {e}')
+        shadow.close()
+        return None
+    return shadow, database_name
+
+def explain_query(db_file, query):
+    """Parse, bind and plan a query without running it. Raises the DuckDB error if it wouldn't run.
+       Returns False if the query can't be checked this way, True if it passed"""
+    query = single_statement(query)
+    shadow = shadow_database(*db_file_identity(db_file))
+    if query is None or shadow is None or not EXPLAINABLE_RE.match(query):
+        return False
+    shadow, database_name = shadow
+    cursor = shadow.cursor() # each cursor is independent, so queries from several threads can be checked at once
+    try:
+        cursor.execute(f'USE "{database_name}"')
+        cursor.execute('EXPLAIN ' + query)
+    finally:
+        cursor.close()
+    return True
+
+def close_all():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
@@ -75,6 +75,15 @@ The "gas" table provides the amount of gas used on a given melt.
 The "temp" table and the "temp_FULL_with_test" table both contain temperature measurements at several times for each melt. The unit of the temperature is Celsius. 
 If a user asks a question about temperature, you MUST use the "temp_FULL_with_test" table for temperature data. The "temp" table has missing values.
 
+There are also summary tables, precomputed from the tables above. Use them rather than aggregating the large tables yourself when they have what you need.
+The "melt_features" table has one row per melt key, with the per-melt aggregates: arc_rows and arc_cycles (the number of arc heating cycles), arc_heating_seconds,
+arc_active_power and arc_reactive_power (sums), arc_avg_active_power, arc_avg_reactive_power, first_heating_start, last_heating_end,
+temp_measurements, first_temp_time, last_temp_time, first_temperature, last_temperature, min_temperature, max_temperature, avg_temperature,
+temp_slope_c_per_second (the regr_slope of temperature against epoch time), total_bulk and total_wire (kg of all bulk and wire elements added), and gas.
+Its arc and temp columns are NULL for melts with no rows in "arc" or "temp_FULL_with_test".
+The "temp_hourly" and "arc_hourly" tables roll up "temp_FULL_with_test" and "arc" by the hour in their hour_start column, with the number of rows, sums, minimums and maximums, and the number of melts.
+For trends by day or month, aggregate them again, e.g. the average temperature per day is SUM(sum_temperature) / SUM(temp_measurements) grouped by date_trunc('day', hour_start).
+
 All time values are stored as timestamps in the format YYYY-MM-DD HH:mm:ss. If you want to match strictly on a date, it is best to compare time to the date with >= AND < conditions.
 
 When you query, do not include the "main." schema prefix on the table names, since we only have one schema.
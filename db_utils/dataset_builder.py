@@ -0,0 +1,180 @@
+"""
+Builds a DuckDB database from CSV files, one table per file, rebuilding only what changed.
+
+Each source is staged as a Parquet file in a directory next to the database (lfu.duckdb.parquet/), sorted by
+the source's sort_by columns, and its table is created from that. The sources are staged at the same time,
+each on a cursor of its own.
+
+The first time a source is seen, its column types are sniffed with read_csv_auto, and saved in a manifest
+next to the database (lfu.duckdb.sources.json), along with a hash of the file's content. From then on the
+CSV is read with those types given explicitly, so nothing is sniffed again, and keys and timestamps are
+parsed once, when staging: the Parquet files and the tables hold them typed. The types in the manifest can be
+edited by hand. They are sniffed again only if the file's header changes.
+
+A source whose hash matches the manifest, with its staging file and table in place, is skipped. If only the
+table is missing, it's recreated from the staging file without reading the CSV.
+
+Derived tables (summaries computed from the source tables) are rebuilt after the sources, whenever any source
+table changed, or the derived table is missing or its query changed (the manifest keeps a hash of each query).
+Later derived tables are rebuilt along with an earlier one, as they may read it.
+"""
+import os
+import csv
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import duckdb
+
+HASH_CHUNK_BYTES = 1 << 20
+
+
+class Source:
+    """A CSV file to build a table from.
+       sort_by: columns (as named in the table) to sort the staged rows by, where the table has them.
+       columns: [(name in the CSV header, name in the table, type)] to use rather than sniffing them"""
+
+    def __init__(self, table, path, sort_by=(), columns=None):
+        self.table = table
+        self.path = path
+        self.sort_by = list(sort_by)
+        self.columns = columns
+
+
+def manifest_path(db_file):
+    return db_file + '.sources.json'
+
+def staging_path(db_file, table):
+    return os.path.join(db_file + '.parquet', f'{table}.parquet')
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def sql_string(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_header(path):
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        return next(csv.reader(f), [])
+
+def sniff_columns(cursor, path, header):
+    """[(name in the CSV header, normalized name, type)], as read_csv_auto sees them"""
+    sniffed = cursor.execute(f'DESCRIBE SELECT * FROM read_csv_auto({sql_string(path)}, normalize_names=true)').fetchall()
+    return [[raw, name, column_type] for raw, (name, column_type, *_) in zip(header, sniffed)]
+
+
+def load_manifest(db_file):
+    try:
+        with open(manifest_path(db_file), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(db_file, manifest):
+    with open(manifest_path(db_file), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def build_table(db, db_file, source, entry, existing_tables):
+    """Stage the source and create its table, unless nothing changed. Returns its new manifest entry and what was done"""
+    cursor = db.cursor() # one per thread
+    try:
+        digest = file_hash(source.path)
+        header = read_header(source.path)
+        parquet = staging_path(db_file, source.table)
+        if entry and entry['sha256'] == digest and os.path.exists(parquet):
+            if source.table in existing_tables:
+                return entry, 'unchanged'
+            cursor.execute(f'CREATE OR REPLACE TABLE {quote(source.table)} AS SELECT * FROM read_parquet({sql_string(parquet)})')
+            return entry, 'restored from staging'
+
+        if source.columns is not None:
+            columns = [list(column) for column in source.columns]
+        elif entry and entry['header'] == header:
+            columns = entry['columns'] # the cached schema
+        else:
+            columns = sniff_columns(cursor, source.path, header)
+        types = ', '.join(f'{sql_string(raw)}: {sql_string(column_type)}' for raw, _, column_type in columns)
+        select = ', '.join(f'{quote(raw)} AS {quote(name)}' for raw, name, _ in columns)
+        names = [name for _, name, _ in columns]
+        order = ', '.join(quote(column) for column in source.sort_by if column in names)
+        cursor.execute(f"""COPY (SELECT {select} FROM read_csv({sql_string(source.path)}, header=true, columns={{{types}}})
+                                 {'ORDER BY ' + order if order else ''})
+                           TO {sql_string(parquet)} (FORMAT PARQUET)""")
+        cursor.execute(f'CREATE OR REPLACE TABLE {quote(source.table)} AS SELECT * FROM read_parquet({sql_string(parquet)})')
+        rows = cursor.execute(f'SELECT count(*) FROM {quote(source.table)}').fetchone()[0]
+        return {'source':source.path, 'sha256':digest, 'header':header, 'columns':columns, 'rows':rows}, 'built'
+    finally:
+        cursor.close()
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+def build_derived(db, derived, manifest, existing_tables, sources_changed):
+    """Create the derived tables, in order, from the first one whose inputs or query changed.
+       Updates their manifest entries. Returns {table: what was done}"""
+    outcomes = {}
+    rebuild = sources_changed
+    for table, query in derived:
+        digest = query_hash(query)
+        entry = manifest.get(table)
+        rebuild = rebuild or table not in existing_tables or not entry or entry.get('query_sha256') != digest
+        if not rebuild:
+            outcomes[table] = 'unchanged'
+            continue
+        start = time.perf_counter()
+        db.execute(f'CREATE OR REPLACE TABLE {quote(table)} AS {query}')
+        outcomes[table] = 'built'
+        rows = db.execute(f'SELECT count(*) FROM {quote(table)}').fetchone()[0]
+        manifest[table] = {'derived':True, 'query_sha256':digest, 'rows':rows}
+        print(f"  {table:<24} {'derived':<22} {rows:>10,} rows  {time.perf_counter() - start:.2f} s")
+    return outcomes
+
+
+def build_database(db_file, sources, workers=8, derived=()):
+    """Create or update a table for each source, then the derived tables: [(table, query)] built in order.
+       Tables built from sources that are gone are dropped. Returns {table: what was done}"""
+    start = time.perf_counter()
+    manifest = load_manifest(db_file)
+    os.makedirs(db_file + '.parquet', exist_ok=True)
+    db = duckdb.connect(db_file)
+    try:
+        existing_tables = {row[0] for row in db.execute("SELECT table_name FROM duckdb_tables() WHERE schema_name = 'main'").fetchall()}
+        with ThreadPoolExecutor(max_workers=workers) as builders:
+            futures = {source.table:builders.submit(build_table, db, db_file, source, manifest.get(source.table), existing_tables) for source in sources}
+            outcomes = {}
+            errors = []
+            for table, future in futures.items():
+                try:
+                    manifest[table], outcomes[table] = future.result()
+                    print(f"  {table:<24} {outcomes[table]:<22} {manifest[table]['rows']:>10,} rows")
+                except Exception as e:
+                    errors.append(f'{table}: {e}')
+        sources_changed = any(outcome != 'unchanged' for outcome in outcomes.values())
+        for table in set(manifest) - {source.table for source in sources} - {table for table, _ in derived}:
+            was_derived = manifest[table].get('derived', False)
+            print(f"  {table:<24} {'no longer derived' if was_derived else 'source removed'}, dropping it")
+            db.execute(f'DROP TABLE IF EXISTS {quote(table)}')
+            if os.path.exists(staging_path(db_file, table)):
+                os.remove(staging_path(db_file, table))
+            del manifest[table]
+            outcomes[table] = 'dropped'
+            sources_changed = sources_changed or not was_derived
+        if derived and not errors:
+            outcomes.update(build_derived(db, derived, manifest, existing_tables, sources_changed))
+    finally:
+        db.close()
+        save_manifest(db_file, manifest) # keep whatever did get built
+    if errors:
+        raise RuntimeError('Could not build ' + '; '.join(errors))
+    print(f'Built {db_file} in {time.perf_counter() - start:.2f} s')
+    return outcomes
@@ -1,20 +1,76 @@
-import duckdb
+"""
+Build lfu.duckdb from the CSV files of the ladle furnace dataset, one table per file.
+
+    cd ./db_files/lfu; python ../../db_utils/make_lfu.py
+
+Running it again only rebuilds the tables whose CSV changed (see dataset_builder.py).
+
+Besides a table per CSV, it precomputes the per-melt aggregates the LLM otherwise writes CTEs for on nearly
+every question (melt_features), and hourly rollups of the time series (temp_hourly, arc_hourly).
+query_rewriter.py routes matching aggregate queries to them, so keep the two in step.
+"""
 import os
+import duckdb
+from dataset_builder import Source, build_database
 
 dbfile = r'lfu.duckdb'
 
-db = duckdb.connect(dbfile)
+files = sorted(f for f in os.listdir() if f.endswith('.csv'))
+
+# strip extension and remove the "data_" prefix. Rows are staged in order of melt, then time
+sources = [Source(f.replace('.csv','').replace('data_',''), f, sort_by=['_key', '_time', 'heating_start']) for f in files]
 
-files = [f for f in os.listdir() if f.endswith('.csv')]
+BULK_TOTAL = ' + '.join(f'coalesce(b.bulk_{i}, 0)' for i in range(1, 16))
+WIRE_TOTAL = ' + '.join(f'coalesce(w.wire_{i}, 0)' for i in range(1, 10))
+DERIVED_TABLES = [
+    # one row per melt. The arc_ and temp_ columns are NULL for melts with no rows in arc or temp_FULL_with_test
+    ('melt_features', f"""
+    WITH melts AS (SELECT _key FROM arc UNION SELECT _key FROM temp_FULL_with_test UNION SELECT _key FROM bulk
+                   UNION SELECT _key FROM wire UNION SELECT _key FROM gas),
+    arc_melt AS (SELECT _key, count(*) AS arc_rows, count(DISTINCT heating_start) AS arc_cycles,
+                        CAST(sum(date_diff('second', heating_start, heating_end)) AS BIGINT) AS arc_heating_seconds,
+                        sum(active_power) AS arc_active_power, avg(active_power) AS arc_avg_active_power,
+                        sum(reactive_power) AS arc_reactive_power, avg(reactive_power) AS arc_avg_reactive_power,
+                        min(heating_start) AS first_heating_start, max(heating_end) AS last_heating_end
+                 FROM arc GROUP BY _key),
+    temp_melt AS (SELECT _key, count(*) AS temp_rows, count(temperature) AS temp_measurements,
+                         min(_time) AS first_temp_time, max(_time) AS last_temp_time,
+                         arg_min(temperature, _time) AS first_temperature, arg_max(temperature, _time) AS last_temperature,
+                         min(temperature) AS min_temperature, max(temperature) AS max_temperature, avg(temperature) AS avg_temperature,
+                         regr_slope(temperature, epoch(_time)) AS temp_slope_c_per_second
+                  FROM temp_FULL_with_test GROUP BY _key)
+    SELECT m._key, a.* EXCLUDE (_key), t.* EXCLUDE (_key),
+           CASE WHEN b._key IS NOT NULL THEN {BULK_TOTAL} END AS total_bulk,
+           CASE WHEN w._key IS NOT NULL THEN {WIRE_TOTAL} END AS total_wire,
+           g.gas_1 AS gas
+    FROM melts m
+    LEFT JOIN arc_melt a ON a._key = m._key
+    LEFT JOIN temp_melt t ON t._key = m._key
+    LEFT JOIN bulk b ON b._key = m._key
+    LEFT JOIN wire w ON w._key = m._key
+    LEFT JOIN gas g ON g._key = m._key
+    ORDER BY m._key
+    """),
+    ('temp_hourly', """
+    SELECT date_trunc('hour', _time) AS hour_start, count(*) AS n_rows, count(temperature) AS temp_measurements,
+           sum(temperature) AS sum_temperature, min(temperature) AS min_temperature, max(temperature) AS max_temperature,
+           count(DISTINCT _key) AS melts
+    FROM temp_FULL_with_test GROUP BY hour_start ORDER BY hour_start
+    """),
+    ('arc_hourly', """
+    SELECT date_trunc('hour', heating_start) AS hour_start, count(*) AS arc_rows,
+           CAST(sum(date_diff('second', heating_start, heating_end)) AS BIGINT) AS arc_heating_seconds,
+           sum(active_power) AS arc_active_power, sum(reactive_power) AS arc_reactive_power, count(DISTINCT _key) AS melts
+    FROM arc GROUP BY hour_start ORDER BY hour_start
+    """),
+]
 
 try:
-    for file in files:
-        tablename = file.replace('.csv','').replace('data_','') # strip extension and remove the "data_" prefix
-        db.sql(f"""
-        CREATE TABLE {tablename} as (SELECT * FROM read_csv_auto('{file}',normalize_names = true))
-        """)
+    build_database(dbfile, sources, derived=DERIVED_TABLES)
     print('Successfully built LFU tables:')
+    db = duckdb.connect(dbfile, read_only=True)
     db.sql("SHOW TABLES").show()
+    db.close()
 except Exception as e:
     print('Error creating LFU')
-    raise e
\ No newline at end of file
+    raise e
@@ -1,24 +1,94 @@
-import duckdb
+"""
+Build TPC-H databases with DuckDB's tpch extension.
+
+    python db_utils/make_tpch.py 0.1                          # ./db_files/tpch/tpch.duckdb, the one the app uses
+    python db_utils/make_tpch.py 0.01 0.1 1 10 --children 8   # ./db_files/tpch/sf0.01/tpch.duckdb, ... one per scale factor
+
+Each scale factor is generated in chunks: dbgen(sf, children, step) generates one step of the data split
+children ways (every table, nation and region included, is split between the steps). The steps run at the same
+time, each in a process of its own writing a file of its own, as dbgen isn't thread-safe: steps run on threads
+of one process crash it. The step files are then appended to the tables one after another, and deleted. The
+result has the same rows as a single dbgen(sf) (checked at SF 1, by row counts and a hash of every table).
+Every file is called tpch.duckdb, so the app and the benchmarks see the same database name (and the same
+db_specific_prompts) at every scale.
+"""
+import os
+import time
+import shutil
 import argparse
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import duckdb
+
+DEFAULT_DB_FILE = r'./db_files/tpch/tpch.duckdb'
+SCALE_DB_FILE = r'./db_files/tpch/sf{sf:g}/tpch.duckdb'
+MIN_CHUNK_SF = 0.1 # smaller scale factors aren't worth splitting up
 
 parser = argparse.ArgumentParser()
-parser.add_argument('sf', default=1, nargs=1, type=float, help='TPC-H Scale Factor')
-
-args = parser.parse_args()
-sf = args.sf[0]
-
-dbfile = r'./db_files/tpch/tpch.duckdb'
-
-db = duckdb.connect(dbfile)
-
-try:
-    db.sql(f"""
-    INSTALL tpch;
-    LOAD tpch;
-    CALL dbgen(sf={sf});
-    """)
-    print('Successfully built TPC-H tables:')
-    db.sql("SHOW TABLES").show()
-except Exception as e:
-    print('Error creating TPC-H')
-    raise e
\ No newline at end of file
+parser.add_argument('sf', default=[0.1], nargs='*', type=float, help='TPC-H Scale Factors. With more than one, each gets its own file')
+parser.add_argument('--children', default=os.cpu_count(), type=int, help='Chunks to generate each scale factor in, at the same time')
+
+
+def db_file_for(sf, scale_factors):
+    return DEFAULT_DB_FILE if len(scale_factors) == 1 else SCALE_DB_FILE.format(sf=sf)
+
+def load_tpch(db):
+    try:
+        db.execute('LOAD tpch') # built into the Python package, so it doesn't need downloading
+    except duckdb.Error:
+        db.execute('INSTALL tpch')
+        db.execute('LOAD tpch')
+
+def generate_step(step_file, sf, children, step):
+    db = duckdb.connect(step_file) # in a process of its own
+    try:
+        load_tpch(db)
+        db.execute(f'CALL dbgen(sf={sf}, children={children}, step={step})')
+    finally:
+        db.close()
+
+def build(db_file, sf, children):
+    """Generate one scale factor into a new file"""
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    children = max(1, min(children, int(sf / MIN_CHUNK_SF)))
+    start = time.perf_counter()
+    db = duckdb.connect(db_file)
+    try:
+        load_tpch(db)
+        if children == 1:
+            db.sql(f'CALL dbgen(sf={sf})')
+        else:
+            db.sql('CALL dbgen(sf=0)') # the empty tables, so the steps only append to them
+            tables = [row[0] for row in db.execute('SELECT table_name FROM duckdb_tables() ORDER BY table_name').fetchall()]
+            steps_dir = tempfile.mkdtemp(prefix='tpch_steps_', dir=os.path.dirname(os.path.abspath(db_file)))
+            try:
+                step_files = [os.path.join(steps_dir, f'step{step}.duckdb') for step in range(children)]
+                with ProcessPoolExecutor(max_workers=children, mp_context=multiprocessing.get_context('spawn')) as steps:
+                    for future in [steps.submit(generate_step, step_file, sf, children, step) for step, step_file in enumerate(step_files)]:
+                        future.result()
+                for step_file in step_files:
+                    db.execute(f"ATTACH '{step_file}' AS step (READ_ONLY)")
+                    for table in tables:
+                        db.execute(f'INSERT INTO {table} SELECT * FROM step.{table}')
+                    db.execute('DETACH step')
+            finally:
+                shutil.rmtree(steps_dir, ignore_errors=True)
+        print(f'\nBuilt TPC-H SF {sf:g} in {db_file}, {children} chunks, {time.perf_counter() - start:.1f} s:')
+        db.sql("""SELECT table_name, estimated_size AS rows FROM duckdb_tables() ORDER BY table_name""").show()
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    try:
+        for sf in args.sf:
+            build(db_file_for(sf, args.sf), sf, args.children)
+    except Exception as e:
+        print('Error creating TPC-H')
+        raise e
+    print(f'Successfully built TPC-H tables, peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
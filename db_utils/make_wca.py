@@ -1,54 +1,217 @@
-import duckdb
-import os
+"""
+Build wca.duckdb from the WCA results export, a MySQL dump.
 
-import sqlglot
+    cd ./db_files/wca; python ../../db_utils/make_wca.py
+
+The dump's INSERT statements run to hundreds of MB each, which is too much to hand to DuckDB's SQL parser, or
+to build up in memory a line at a time. Instead the dump is read in a single streaming pass, in fixed-size
+chunks. The value tuples of each INSERT are picked out with one regular expression, and written as lines of a
+CSV staging file per table, which DuckDB bulk-loads with COPY. Only the CREATE TABLE statements are transpiled
+from MySQL with sqlglot. A table is loaded as soon as its rows have all been staged, on a thread of its own,
+while the dump is still being read for the next table.
+
+MySQL backslash escapes are converted on the way: \\' becomes the '' that the CSV reader (and SQL) expects,
+and \\n, \\t etc. the characters they stand for.
+Only an unquoted NULL is a null value: the string 'NULL' (and the empty string '') is loaded as it was written.
+"""
+import os
 import re
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import duckdb
+import sqlglot
+
+READ_CHUNK_CHARS = 1 << 22 # characters of the dump read at a time
+MAX_TUPLE_CHARS = 1 << 26 # a value tuple longer than this means the dump couldn't be parsed
+SKIP_TABLES = {'ar_internal_metadata'}
+
+# one value tuple of an INSERT, and the , or ; after it. Once escapes are converted, a quote inside a string is always doubled.
+# Written so there's only one way to match any text (a string ends at a quote that isn't followed by another), which
+# keeps the backtracking linear when a tuple is cut off at the end of the buffer
+TUPLE_RE = re.compile(r"\s*\(([^'()]*(?:'[^']*(?:''[^']*)*'(?!')[^'()]*)*)\)\s*([,;])")
+INSERT_RE = re.compile(r"INSERT INTO `([^`]+)` VALUES\s*")
+CREATE_TABLE_RE = re.compile(r"CREATE TABLE `([^`]+)`")
+MYSQL_ESCAPE_RE = re.compile(r"\\(.)", re.DOTALL)
+MYSQL_ESCAPES = {"'":"''", '0':'', 'n':'\n', 'r':'\r', 't':'\t', 'Z':'\x1a', 'b':'\b'} # anything else stands for itself
+
+
+def unescape(text):
+    if '\\' not in text:
+        return text
+    return MYSQL_ESCAPE_RE.sub(lambda m: MYSQL_ESCAPES.get(m.group(1), m.group(1)), text)
+
+def read_chunks(f, size=READ_CHUNK_CHARS):
+    """Chunks of the dump with the escapes converted. A backslash at the end of a chunk is held back for the next one"""
+    held = ''
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            if held:
+                yield unescape(held)
+            return
+        chunk = held + chunk
+        trailing_backslashes = len(chunk) - len(chunk.rstrip('\\'))
+        held = '\\' if trailing_backslashes % 2 else ''
+        yield unescape(chunk[:len(chunk) - len(held)])
 
 
-dbfile = r'wca.duckdb'
-
-db = duckdb.connect(dbfile)
-
-files = [f for f in os.listdir() if f.endswith('.sql')]
-print(files)
-try:
-    for file in files:
-        with open(file,'r') as f:
-            mysql_query = ''
-            in_query = False
-            for line in f:
-                if ('CREATE' in line) or ('INSERT' in line):
-                    in_query = True
-                if re.search(r';\s*$',line): #then it is probably the end of the SQL statement we want to execute 
-                    mysql_query += '\n' + line
-                    if mysql_query.startswith('\nLOCK TABLES') or mysql_query.startswith('\nUNLOCK') or 'ar_internal_metadata' in mysql_query:
-                        pass #skip the query
-                    else:
-                        if ('INSERT INTO `RanksAverage`' in line[:100]) or ('INSERT INTO `RanksSingle`' in line[:100]) or ('INSERT INTO `RoundTypes`' in line[:100]) or ('INSERT INTO `Scrambles`' in line[:100]) or ('INSERT INTO `Results`' in line[:100]) or ('INSERT INTO `Persons`' in line[:100]):
-                            # strip backticks from Table name
-                            mysql_query = mysql_query[:100].replace('`','"') + mysql_query[100:]
-
-                            # Deal with escapes for names like O'Brien
-                            mysql_query = mysql_query.replace(r"\'",r"''")
-
-                            duckdb_queries = [mysql_query] # YOLO without transpiling if it's an insert.
+class DumpScanner:
+    """Reads a MySQL dump in one pass. events() yields
+           ('ddl', table, statement)   for each CREATE TABLE
+           ('rows', table, csv_text)   for each run of value tuples of an INSERT, as CSV lines
+       Everything else (comments, SET, DROP TABLE, LOCK TABLES, ...) is skipped"""
+
+    def __init__(self, f):
+        self.chunks = read_chunks(f)
+        self.buffer = ''
+        self.pos = 0
+
+    def read_more(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def events(self):
+        table = None # the table of the INSERT being read
+        statement = [] # lines of the statement being read, outside of INSERTs
+        while True:
+            if table is not None:
+                rows = []
+                end_of_insert = False
+                while not end_of_insert:
+                    m = TUPLE_RE.match(self.buffer, self.pos)
+                    if m is None:
+                        break
+                    rows.append(m.group(1))
+                    self.pos = m.end()
+                    end_of_insert = m.group(2) == ';'
+                if rows and table not in SKIP_TABLES:
+                    rows.append('')
+                    yield 'rows', table, '\n'.join(rows)
+                if end_of_insert:
+                    table = None
+                elif len(self.buffer) - self.pos > MAX_TUPLE_CHARS or not self.read_more():
+                    raise ValueError(f'Could not parse the values of INSERT INTO `{table}` at: {self.buffer[self.pos:self.pos + 200]}')
+                continue
+
+            if not statement:
+                m = INSERT_RE.match(self.buffer, self.pos)
+                if m is not None:
+                    table = m.group(1)
+                    self.pos = m.end()
+                    continue
+            end = self.buffer.find('\n', self.pos)
+            if end == -1:
+                if self.read_more():
+                    continue
+                if self.pos == len(self.buffer):
+                    return
+                end = len(self.buffer)
+            line = self.buffer[self.pos:end]
+            self.pos = end + 1
+            if not statement and not line.startswith('CREATE TABLE'):
+                continue
+            statement.append(line)
+            if line.rstrip().endswith(';'):
+                ddl = '\n'.join(statement)
+                statement = []
+                name = CREATE_TABLE_RE.match(ddl).group(1)
+                if name not in SKIP_TABLES:
+                    yield 'ddl', name, ddl
+
+
+def transpile_ddl(mysql_ddl):
+    """CREATE TABLE statements for DuckDB, from a MySQL one"""
+    queries = sqlglot.transpile(mysql_ddl, read='mysql', write='duckdb')
+    cleaned = []
+    for query in queries:
+        query = query.replace('COLLATE utf8mb4_unicode_ci','') # don't need to specify collation
+        query = query.replace('COLLATE utf8mb3_general_ci','') # don't need to specify collation
+        query = query.replace('CHARACTER SET utf8mb3','')
+        query = query.replace('TINYINT(1)','INT')
+        cleaned.append(query)
+    return cleaned
+
+def copy_into(db, table, csv_path):
+    cursor = db.cursor() # one per thread
+    try:
+        cursor.execute(f"""COPY "{table}" FROM '{csv_path}' (FORMAT CSV, DELIMITER ',', QUOTE '''', ESCAPE '''', NULL 'NULL', ALLOW_QUOTED_NULLS false, HEADER false)""")
+        return table, cursor.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def import_dump(paths, db_file, workers=4, staging_dir=None):
+    """Load MySQL dump files into a DuckDB database. Returns {table: rows}"""
+    db = duckdb.connect(db_file)
+    keep_staging = staging_dir is not None
+    staging_dir = staging_dir or tempfile.mkdtemp(prefix='wca_staging_', dir=os.path.dirname(os.path.abspath(db_file)))
+    os.makedirs(staging_dir, exist_ok=True)
+    loads = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as loaders:
+            staging_table, staging_file, staging_path = None, None, None
+            staged_tables = set()
+            def finish_staging():
+                # all of a table's rows are in one run of the dump, so once another table starts it can be loaded
+                nonlocal staging_table, staging_file
+                if staging_file is not None:
+                    staging_file.close()
+                    print(f'Loading {staging_table} ...')
+                    loads.append(loaders.submit(copy_into, db, staging_table, staging_path))
+                staging_table, staging_file = None, None
+
+            for path in paths:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for event, table, text in DumpScanner(f).events():
+                        if event == 'ddl':
+                            finish_staging()
+                            print(f'\nCreating {table} ...')
+                            db.execute(f'DROP TABLE IF EXISTS "{table}"')
+                            for query in transpile_ddl(text):
+                                db.execute(query)
                         else:
-                            print(f'\nTranspiling {line[:200]} ...')
-                            duckdb_queries = sqlglot.transpile(mysql_query,read='mysql',write='duckdb')
-                        for query in duckdb_queries:
-                            #print(query[:5000])
-                            print(f'\nExecuting {query[:200]} ...')
-                            query = query.replace('COLLATE utf8mb4_unicode_ci','') # don't need to specify collation                            
-                            query = query.replace('COLLATE utf8mb3_general_ci','') # don't need to specify collation
-                            query = query.replace('CHARACTER SET utf8mb3','')
-                            query = query.replace('TINYINT(1)','INT')
-                            db.sql(query)
-                    mysql_query = ''
-                    in_query = False
-                elif in_query: # we're in the query but haven't hit the end
-                    mysql_query += '\n' + line
-    print('Successfully built WCA tables:')
-    db.sql("SHOW TABLES").show()
-except Exception as e:
-    print('Error creating WCA')
-    raise e
\ No newline at end of file
+                            if table != staging_table:
+                                finish_staging()
+                                staging_table = table
+                                staging_path = os.path.join(staging_dir, f'{table}.csv')
+                                # a staging file left by an earlier run with the same --staging-dir is overwritten
+                                staging_file = open(staging_path, 'a' if table in staged_tables else 'w', encoding='utf-8')
+                                staged_tables.add(table)
+                            staging_file.write(text)
+            finish_staging()
+            row_counts = dict(load.result() for load in loads)
+    finally:
+        db.close()
+        if not keep_staging:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    return row_counts
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('dumps', nargs='*', help='MySQL dump files. Defaults to every .sql file in the current directory')
+parser.add_argument('--db', default='wca.duckdb', help='DuckDB file to create the tables in')
+parser.add_argument('--workers', default=4, type=int, help='Tables loaded at the same time')
+parser.add_argument('--staging-dir', default=None, help='Keep the CSV staging files here, rather than in a temporary directory')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    files = args.dumps or sorted(f for f in os.listdir() if f.endswith('.sql'))
+    print(files)
+    start = time.perf_counter()
+    try:
+        row_counts = import_dump(files, args.db, args.workers, args.staging_dir)
+    except Exception as e:
+        print('Error creating WCA')
+        raise e
+    print(f'\nSuccessfully built WCA tables in {time.perf_counter() - start:.1f} s, '
+          f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB:')
+    for table, n_rows in sorted(row_counts.items()):
+        print(f'  {table:<32} {n_rows:>12,} rows')
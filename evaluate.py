@@ -0,0 +1,217 @@
+"""
+Batch evaluation of the models, without the UI.
+
+    python evaluate.py --questions ./evaluation/questions.jsonl --models 70b sqlcoder --workers 8
+
+Each question is asked in a fresh session of the same agent loop the app uses (AgentEngine): the same prompt
+building, context fitting, stop detection, choose_next_action and query_manager. Questions are answered
+concurrently, up to --workers at a time, for each model given.
+
+The questions file has one JSON object per line:
+    {"id": "tpch-1", "db": "tpch", "question": "...", "expected_sql": "SELECT ...", "expected_result": [[...], ...]}
+db is tpch, lfu, wca or the path of a DuckDB file. expected_sql and expected_result are optional: with one of
+them, the rows returned by the last query of the answer that ran without an error are compared with the
+expected rows, ignoring their order. Numbers are compared to RESULT_DECIMALS decimal places. The answer's
+query is run again the way the app ran it - routed to the summary tables, through admission control and under
+QUERY_TIMEOUT - so it is graded on the rows the model was shown (in full, rather than their head and tail).
+expected_sql is routed and run under the same deadline, but isn't admitted: sampled rows would make it an
+estimate, so it is always run in full.
+
+Every result is appended to --results as soon as its question is done, and a re-run skips the questions
+already answered by each model, so an interrupted evaluation picks up where it stopped. At the end, a
+summary per model is printed: accuracy, how many questions got an answer, LLM calls per question,
+tokens and latency.
+
+--backend replay plays back the responses in the interaction log instead of calling Replicate, to try out
+the evaluation itself offline. The evaluation's own LLM calls are logged to --interaction-log, not to the
+app's log.
+"""
+import os
+import json
+import time
+import argparse
+import statistics
+from collections import Counter
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+load_dotenv()
+from utils import choose_next_action, is_query_error, configure_interaction_log, LOG_FILE
+from db_manager import run_with_deadline
+from query_rewriter import route_query
+from query_admission import admit_query
+from llm_backends import make_backend
+from agent_engine import AgentEngine, AgentSession
+from prompt_tools import generate_preprompt
+from context_window import count_tokens
+
+DATABASES = {'tpch':'./db_files/tpch/tpch.duckdb', 'lfu':'./db_files/lfu/lfu.duckdb', 'wca':'./db_files/wca/wca.duckdb'}
+# short names for the endpoints in the .env file
+MODELS = {
+    '70b':'REPLICATE_MODEL_ENDPOINT70B',
+    '13b':'REPLICATE_MODEL_ENDPOINT13B',
+    '7b':'REPLICATE_MODEL_ENDPOINT7B',
+    'sqlcoder':'REPLICATE_MODEL_ENDPOINT_SQLCODER',
+    'cl34b':'REPLICATE_MODEL_ENDPOINT_CL34B',
+    'cl13b':'REPLICATE_MODEL_ENDPOINT_CL13B',
+}
+RESULT_DECIMALS = 2
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--questions', default='./evaluation/questions.jsonl', help='Questions to ask, one JSON object per line')
+parser.add_argument('--models', nargs='+', default=['70b'], help=f'Models to evaluate: {", ".join(MODELS)}, or endpoint strings')
+parser.add_argument('--results', default='./log/evaluation_results.jsonl', help='Where to append the result of each question')
+parser.add_argument('--workers', default=8, type=int, help='Questions answered at the same time')
+parser.add_argument('--max-steps', default=10, type=int, help='LLM calls allowed per question')
+parser.add_argument('--temperature', default=0.1, type=float)
+parser.add_argument('--top-p', default=0.9, type=float)
+parser.add_argument('--max-seq-len', default=2048, type=int)
+parser.add_argument('--backend', default=os.environ.get('LLM_BACKEND', 'replicate'), help='"replicate", or "replay" to play back the interaction log')
+parser.add_argument('--replay-log', default=LOG_FILE, help='Interaction log for the replay backend')
+parser.add_argument('--replay-tokens-per-second', default=0, type=float, help='Replay rate, 0 for as fast as possible')
+parser.add_argument('--interaction-log', default='./log/evaluation_log.log', help="Where to log the evaluation's LLM calls")
+
+
+def read_questions(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def read_results(path):
+    """Results of an earlier run, as {(model, question id): result}"""
+    results = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[(result['model'], result['id'])] = result
+    return results
+
+def resolve_model(name):
+    return (os.environ.get(MODELS[name]) or name) if name in MODELS else name
+
+
+def normalize_rows(rows):
+    """Rows as a multiset, with numbers rounded so float noise doesn't count as a difference"""
+    def normalize(value):
+        if isinstance(value, (float, Decimal)):
+            return round(float(value), RESULT_DECIMALS)
+        return value
+    return Counter(tuple(normalize(value) for value in row) for row in rows)
+
+def fetch_rows(db_file, query, admit=True):
+    """All the rows of a query, run as run_query runs it. Raises QueryTimeout, or the DuckDB error"""
+    query = route_query(db_file, query)
+    if admit:
+        admission = admit_query(db_file, query)
+        if admission.rejected:
+            raise RuntimeError(f'rejected by admission control ({admission.reason})')
+        query = admission.query
+    return run_with_deadline(db_file, lambda db: db.execute(query).fetchall())
+
+def final_query(session):
+    """The last query of the session's latest turn that ran without an error, or None"""
+    query = None
+    for message, next_message in zip(session.conversation.chat_dialogue, session.conversation.chat_dialogue[1:]):
+        if message['role'] == 'assistant' and 'result_id' in next_message:
+            next_action, next_action_input = choose_next_action(message['content'])
+            if next_action == 'query' and not is_query_error(session.conversation.query_results[next_message['result_id']][0]):
+                query = next_action_input
+    return query
+
+
+def evaluate_question(engine, question, model, args):
+    """Ask one question in a new session. Returns its result record"""
+    db_file = DATABASES.get(question['db'], question['db'])
+    pre_prompt, _ = generate_preprompt(db_file)
+    settings = {'llm':model, 'temperature':args.temperature, 'top_p':args.top_p, 'max_seq_len':args.max_seq_len,
+                'max_steps':args.max_steps, 'stream_tokens':False}
+    session = AgentSession(db_file, pre_prompt, settings)
+    start = time.perf_counter()
+    error = None
+    try:
+        steps = engine.run(session, question['question'])
+    except Exception as e:
+        steps, error = None, str(e)
+    latency = time.perf_counter() - start
+
+    dialogue = session.conversation.chat_dialogue
+    prompt_tokens = sum(event['report']['total'] - event['report']['reserved_for_response']
+                        for event in session.drain_events() if event['type'] == 'context_report')
+    completion_tokens = sum(count_tokens(message['content']) for message in dialogue if message['role'] == 'assistant')
+    last_action = choose_next_action(dialogue[-1]['content'])[0] if dialogue[-1]['role'] == 'assistant' else 'query'
+    query = final_query(session)
+    result = {'model':model, 'id':question['id'], 'db':question['db'], 'question':question['question'],
+              'steps':steps, 'answered':error is None and last_action != 'query', 'final_query':query,
+              'prompt_tokens':prompt_tokens, 'completion_tokens':completion_tokens, 'latency':latency,
+              'error':error, 'correct':None, 'session_uuid':str(session.session_uuid)}
+
+    expected_rows = question.get('expected_result')
+    if expected_rows is None and question.get('expected_sql'):
+        try:
+            expected_rows = fetch_rows(db_file, question['expected_sql'], admit=False)
+        except Exception as e: # the question can't be graded, but the answer is still recorded
+            result['error'] = result['error'] or f'expected_sql failed: {e}'
+    if expected_rows is not None:
+        try:
+            result['correct'] = query is not None and normalize_rows(fetch_rows(db_file, query)) == normalize_rows(expected_rows)
+        except Exception as e:
+            result['correct'] = False
+            result['error'] = result['error'] or str(e)
+    return result
+
+
+def summarize(results):
+    """Per model: accuracy, answer rate, LLM calls per question, tokens and latency"""
+    by_model = {}
+    for result in results:
+        by_model.setdefault(result['model'], []).append(result)
+    summary = {}
+    for model, model_results in by_model.items():
+        graded = [result['correct'] for result in model_results if result['correct'] is not None]
+        latencies = sorted(result['latency'] for result in model_results)
+        summary[model] = {
+            'questions':len(model_results),
+            'accuracy':sum(graded) / len(graded) if graded else None,
+            'graded':len(graded),
+            'answered':sum(result['answered'] for result in model_results) / len(model_results),
+            'mean_steps':statistics.mean(result['steps'] or 0 for result in model_results),
+            'mean_prompt_tokens':statistics.mean(result['prompt_tokens'] for result in model_results),
+            'mean_completion_tokens':statistics.mean(result['completion_tokens'] for result in model_results),
+            'median_latency':statistics.median(latencies),
+            'p95_latency':latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        }
+    return summary
+
+def print_summary(summary):
+    for model, s in summary.items():
+        accuracy = f"{100 * s['accuracy']:5.1f}% of {s['graded']}" if s['accuracy'] is not None else 'not graded'
+        print(f"{model}\n"
+              f"  {s['questions']} questions, accuracy {accuracy}, {100 * s['answered']:.0f}% answered\n"
+              f"  {s['mean_steps']:.1f} LLM calls, {s['mean_prompt_tokens']:.0f} prompt + {s['mean_completion_tokens']:.0f} completion tokens per question\n"
+              f"  latency {s['median_latency']:.1f} s median, {s['p95_latency']:.1f} s p95")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    backend = make_backend(args.backend, os.environ.get('REPLICATE_API_TOKEN', ''), args.replay_log, args.replay_tokens_per_second or None)
+    os.makedirs(os.path.dirname(os.path.abspath(args.interaction_log)), exist_ok=True)
+    configure_interaction_log(args.interaction_log) # after the replay backend has read the app's log
+    engine = AgentEngine(backend)
+    questions = read_questions(args.questions)
+    models = [resolve_model(name) for name in args.models]
+    done = read_results(args.results)
+    todo = [(question, model) for model in models for question in questions if (model, question['id']) not in done]
+    print(f'{len(questions)} questions x {len(models)} models: {len(todo)} to ask, {len(questions) * len(models) - len(todo)} already done')
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, 'a', encoding='utf-8') as results_file, ThreadPoolExecutor(max_workers=args.workers) as workers:
+        futures = {workers.submit(evaluate_question, engine, question, model, args):(question, model) for question, model in todo}
+        for future in as_completed(futures):
+            result = future.result()
+            results_file.write(json.dumps(result) + '\n')
+            results_file.flush() # so an interrupted run keeps everything finished so far
+            done[(result['model'], result['id'])] = result
+
+    engine.close()
+    print_summary(summarize([result for result in done.values() if result['model'] in models]))
@@ -14,19 +14,20 @@ Python version: 3.11.4
 """
 #External libraries:
 import streamlit as st
-import replicate
 from dotenv import load_dotenv
 load_dotenv()
 import os
-from utils import debounce_replicate_run, get_llm_model_version, check_for_stop_conditions, \
-    choose_next_action, query_manager, clean_up_response_formatting, \
-    generate_logging_uuid, log_llm_call, log_response, log_action, log_query_result, log_noteworthy
+from utils import debounce_replicate_run, preload_llm_model_versions, log_noteworthy
 from auth0_component import login_button
+from llm_backends import make_backend
+from candidates import PARALLEL_CANDIDATES
+from agent_engine import AgentEngine, AgentSession
 import argparse
-import duckdb
 from prompt_tools import get_table_details, list_table_schemas, set_instructions, \
     generate_preprompt, response_options, generate_system_prompt
 import re
+import time
+import threading
 # parse comamnd line args
 parser = argparse.ArgumentParser()
 parser.add_argument('--noauth', action='store_true', help='turns off auth')
@@ -49,6 +50,10 @@ REPLICATE_MODEL_ENDPOINT70B = os.environ.get('REPLICATE_MODEL_ENDPOINT70B', defa
 REPLICATE_MODEL_ENDPOINT_SQLCODER = os.environ.get('REPLICATE_MODEL_ENDPOINT_SQLCODER', default='')
 REPLICATE_MODEL_ENDPOINT_CL34B = os.environ.get('REPLICATE_MODEL_ENDPOINT_CL34B',default='')
 REPLICATE_MODEL_ENDPOINT_CL13B = os.environ.get('REPLICATE_MODEL_ENDPOINT_CL13B',default='')
+#Where predictions come from: "replicate", or "replay" to play back responses from the interaction log offline
+LLM_BACKEND = os.environ.get('LLM_BACKEND', default='replicate')
+REPLAY_LOG_PATH = os.environ.get('REPLAY_LOG_PATH', default='./log/interaction_log.log')
+REPLAY_TOKENS_PER_SECOND = float(os.environ.get('REPLAY_TOKENS_PER_SECOND', default=0)) or None # 0 streams as fast as possible
 DB_TPCH = r'./db_files/tpch/tpch.duckdb'
 DB_LFU = r'./db_files/lfu/lfu.duckdb'
 DB_WCA = r'./db_files/wca/wca.duckdb'
@@ -58,16 +63,39 @@ AUTH0_CLIENTID = os.environ.get('AUTH0_CLIENTID', default='')
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', default='')
 
 if not (
-        REPLICATE_API_TOKEN and
+        (REPLICATE_API_TOKEN or LLM_BACKEND != 'replicate') and
         REPLICATE_MODEL_ENDPOINT7B and REPLICATE_MODEL_ENDPOINT13B and REPLICATE_MODEL_ENDPOINT70B and
         ((not use_auth) or (AUTH0_CLIENTID and AUTH0_DOMAIN))
     ):
     st.warning("Add a `.env` file to your app directory with the keys specified in `.env_template` to continue.")
     st.stop()
 
+@st.cache_resource(show_spinner=False)
+def start_model_version_preload():
+    """Resolve every model endpoint's version once per process, in the background, so the first
+       prediction for each model doesn't wait on it. Versions are cached in utils and shared by all sessions"""
+    endpoints = [REPLICATE_MODEL_ENDPOINT70B, REPLICATE_MODEL_ENDPOINT13B, REPLICATE_MODEL_ENDPOINT7B,
+                 REPLICATE_MODEL_ENDPOINT_SQLCODER, REPLICATE_MODEL_ENDPOINT_CL34B, REPLICATE_MODEL_ENDPOINT_CL13B]
+    preload_thread = threading.Thread(target=preload_llm_model_versions, args=(endpoints,), daemon=True)
+    preload_thread.start()
+    return preload_thread
+
+@st.cache_resource(show_spinner=False)
+def get_llm_backend():
+    """One backend per process, shared by all sessions"""
+    return make_backend(LLM_BACKEND, REPLICATE_API_TOKEN, REPLAY_LOG_PATH, REPLAY_TOKENS_PER_SECOND)
+
+@st.cache_resource(show_spinner=False)
+def get_agent_engine():
+    """One agent loop per process, shared by all sessions. Turns run on it, not on the script thread, so reruns don't interrupt them"""
+    return AgentEngine(get_llm_backend())
+
 ###Initial UI configuration:###
 st.set_page_config(page_title="Quack to my data", page_icon="🦆", layout="wide")
 
+if LLM_BACKEND == 'replicate':
+    start_model_version_preload()
+
 def render_app():
 
     # reduce font sizes for input text boxes
@@ -96,8 +124,6 @@ def render_app():
     #container for the user's text input
     container = st.container()
     #Set up/Initialize Session State variables:
-    if 'chat_dialogue' not in st.session_state:
-        st.session_state['chat_dialogue'] = []
     if 'llm' not in st.session_state:
         #st.session_state['llm'] = REPLICATE_MODEL_ENDPOINT13B
         st.session_state['llm'] = REPLICATE_MODEL_ENDPOINT70B
@@ -107,29 +133,26 @@ def render_app():
         st.session_state['top_p'] = 0.9
     if 'max_seq_len' not in st.session_state:
         st.session_state['max_seq_len'] = 512
-    if 'string_dialogue' not in st.session_state:
-        st.session_state['string_dialogue'] = ''
-    if 'db' not in st.session_state:
-        st.session_state['db'] = duckdb.connect(DB_TPCH,read_only=True)
+    if 'db_file' not in st.session_state:
+        st.session_state['db_file'] = DB_TPCH # connections are shared across sessions by db_manager, so just keep track of which file
     if 'pre_prompt' not in st.session_state:
-        st.session_state['pre_prompt'], st.session_state['user_pre_prompt'] = generate_preprompt(st.session_state['db'])
+        st.session_state['pre_prompt'], st.session_state['user_pre_prompt'] = generate_preprompt(st.session_state['db_file'])
     if 'system_prompt' not in st.session_state:
         st.session_state['system_prompt'] = generate_system_prompt()
-    if 'query_response_mapper' not in st.session_state:
-        st.session_state['query_response_mapper'] = {} # use this to keep markdown version in chat window, while sending cleaner text to LLM
+    if 'agent_session' not in st.session_state:
+        # the chat history and the prompt built from it, the session uuid its LLM calls are logged under, and the events of the running turn
+        st.session_state['agent_session'] = AgentSession(st.session_state['db_file'], st.session_state['pre_prompt'], system_prompt=st.session_state['system_prompt'])
     if 'query_follow_up' not in st.session_state:
         st.session_state['query_follow_up'] = True # pass the query result back to the LLM to explain it
-    if 'session_uuid' not in st.session_state:
-        st.session_state['session_uuid'] = generate_logging_uuid() # associate a uuid to the chat session. this will be reset each time the chat history is cleared. It will allow sequences of LLM calls to be grouped together from the logs
-    if 'llm_call_uuid' not in st.session_state:
-        st.session_state['llm_call_uuid'] = None
     if 'last_sentiment_clicked' not in st.session_state:
         st.session_state['last_sentiment_clicked'] = None # store whether the user has clicked thumbs up or thumbs down
     if 'feedback_is_expanded' not in st.session_state:
         st.session_state['feedback_is_expanded'] = False
 
     #Dropdown menu to select the model endpoint:
-    selected_option = st.sidebar.selectbox('Choose an LLM:', ['LLaMA2-70B', 'LLaMA2-13B', 'LLaMA2-7B','defog-SQLCoder','CodeLLaMA-34B','CodeLLaMA-13B'], key='model')
+    model_endpoints = {'LLaMA2-70B':REPLICATE_MODEL_ENDPOINT70B, 'LLaMA2-13B':REPLICATE_MODEL_ENDPOINT13B, 'LLaMA2-7B':REPLICATE_MODEL_ENDPOINT7B,
+                       'defog-SQLCoder':REPLICATE_MODEL_ENDPOINT_SQLCODER, 'CodeLLaMA-34B':REPLICATE_MODEL_ENDPOINT_CL34B, 'CodeLLaMA-13B':REPLICATE_MODEL_ENDPOINT_CL13B}
+    selected_option = st.sidebar.selectbox('Choose an LLM:', list(model_endpoints), key='model')
     if selected_option == 'LLaMA2-7B':
         st.session_state['llm'] = REPLICATE_MODEL_ENDPOINT7B
         st.session_state['query_follow_up'] = True
@@ -152,6 +175,21 @@ def render_app():
     st.session_state['temperature'] = st.sidebar.slider('Temperature:', min_value=0.01, max_value=5.0, value=0.1, step=0.01)
     st.session_state['top_p'] = st.sidebar.slider('Top P:', min_value=0.01, max_value=1.0, value=0.9, step=0.01)
     st.session_state['max_seq_len'] = st.sidebar.slider('Max Sequence Length:', min_value=64, max_value=4096, value=2048, step=8)
+    # several responses written at once for each step, keeping the first whose query runs
+    st.session_state['n_candidates'] = st.sidebar.slider('Parallel candidates:', min_value=1, max_value=8, value=PARALLEL_CANDIDATES, step=1)
+    if st.session_state['n_candidates'] > 1:
+        other_models = st.sidebar.multiselect('Also write candidates with:', [name for name in model_endpoints if name != selected_option], key='candidate_models')
+        st.session_state['candidate_llms'] = [st.session_state['llm']] + [model_endpoints[name] for name in other_models]
+    # the running turn reads these at each step
+    st.session_state['agent_session'].settings.update({key:st.session_state.get(key) for key in
+        ['llm', 'temperature', 'top_p', 'max_seq_len', 'query_follow_up', 'n_candidates', 'candidate_llms']})
+    if st.session_state['agent_session'].context_report is not None:
+        report = st.session_state['agent_session'].context_report
+        st.sidebar.caption(f"Last prompt: {report['total']} of {report['window']} tokens in the context window "
+                           f"(schema {report['schema']}, dialogue {report['dialogue']}, query results {report['query_results']}, "
+                           f"instructions {report['system_prompt']}, reserved for the response {report['reserved_for_response']}, "
+                           f"response of up to {report['max_new_tokens']})"
+                           + (f". To fit, {', '.join(report['trimmed'])}." if report['trimmed'] else ''))
 
     # NEW_P = st.sidebar.text_area('Prompt before the chat starts. Edit here if desired:', PRE_PROMPT, height=60)
     # if NEW_P != PRE_PROMPT and NEW_P != "" and NEW_P != None:
@@ -160,21 +198,21 @@ def render_app():
     #     st.session_state['pre_prompt'] = PRE_PROMPT
 
     def clear_history():
-        st.session_state['chat_dialogue'] = []
-        st.session_state['session_uuid'] = generate_logging_uuid()
+        get_agent_engine().cancel(st.session_state['agent_session'])
+        st.session_state['agent_session'] = AgentSession(st.session_state['db_file'], st.session_state['pre_prompt'], system_prompt=st.session_state['system_prompt'])
 
     def change_db():
         selected_db = st.session_state['db_dropdown']
         if selected_db == 'TPC-H':
-            st.session_state['db'] = duckdb.connect(DB_TPCH,read_only=True)
+            st.session_state['db_file'] = DB_TPCH
         elif selected_db == 'World Cube Association':
-            st.session_state['db'] = duckdb.connect(DB_WCA,read_only=True)
+            st.session_state['db_file'] = DB_WCA
         elif selected_db == 'Ladle Furnace':
-            st.session_state['db'] = duckdb.connect(DB_LFU,read_only=True)
+            st.session_state['db_file'] = DB_LFU
         else: #default to TPC-H if nothing else selected
-            st.session_state['db'] = duckdb.connect(DB_TPCH,read_only=True)
+            st.session_state['db_file'] = DB_TPCH
         # update the prompt based on the selected DB:
-        st.session_state['pre_prompt'], st.session_state['user_pre_prompt'] = generate_preprompt(st.session_state['db'])
+        st.session_state['pre_prompt'], st.session_state['user_pre_prompt'] = generate_preprompt(st.session_state['db_file'])
         clear_history()
 
     #Dropdown menu to select a dataset
@@ -227,77 +265,52 @@ def render_app():
         st.markdown(st.session_state['user_pre_prompt'])
     #st.session_state.chat_dialogue.append({"role": "🦆", "content": st.session_state['user_pre_prompt']})
 
+    agent_session = st.session_state['agent_session']
+    # events already shown in the history below. Anything later is drawn as it arrives
+    agent_session.drain_events()
+
     # Display chat messages from history on app rerun
-    for message in st.session_state.chat_dialogue:
+    chat_dialogue = agent_session.chat_dialogue()
+    for message in chat_dialogue:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
     # Accept user input
-    if prompt := st.chat_input("Type your question here to talk to LLaMA2"):
-        # Add user message to chat history
-        st.session_state.chat_dialogue.append({"role": "user", "content": prompt})
+    if prompt := st.chat_input("Type your question here to talk to LLaMA2", disabled=agent_session.busy):
         # Display user message in chat message container
         with st.chat_message("user"):
             st.markdown(prompt)
-        
-        next_action = 'send_user_text_to_assistant'
-        while next_action != None:
-            with st.chat_message("assistant"):
-                message_placeholder = st.empty()
-                full_response = ""
-                string_dialogue = st.session_state['pre_prompt']
-                for dict_message in st.session_state.chat_dialogue:
-                    if dict_message["role"] == '🦆':
-                        role_name = 'Query result:\n'
-                        string_dialogue = string_dialogue + role_name + st.session_state['query_response_mapper'][dict_message["content"]] + "\n\n"
-                    else:
-                        role_name = dict_message["role"][0].upper() + dict_message["role"][1:] # capitalize 1st letter
-                        string_dialogue = string_dialogue + role_name + ": " + dict_message["content"] + "\n\n"
-                print (string_dialogue)
-                #output = debounce_replicate_run(st.session_state['llm'], string_dialogue + "Assistant: ",  st.session_state['max_seq_len'], st.session_state['temperature'], st.session_state['top_p'], st.session_state['system_prompt'], REPLICATE_API_TOKEN)
-                llm_call_uuid = generate_logging_uuid()
-                st.session_state['llm_call_uuid'] = llm_call_uuid
-                llm_call_input_dict = {"prompt": string_dialogue + "Assistant: ", 
-                                       "system_prompt": st.session_state['system_prompt'], 
-                                       "max_length": st.session_state['max_seq_len'],
-                                       "temperature": st.session_state['temperature'], 
-                                       "top_p": st.session_state['top_p'], 
-                                       "max_new_tokens": st.session_state['max_seq_len'], 
-                                       "repetition_penalty": 1}
-                log_llm_call(st.session_state['llm'],llm_call_input_dict,llm_call_uuid,st.session_state['session_uuid'])
-                prediction = replicate.predictions.create(get_llm_model_version(st.session_state['llm']), input=llm_call_input_dict, api_token=REPLICATE_API_TOKEN)
-                output = prediction.output_iterator()
-                for item in output:
-                    
-                    full_response += item
-                    stop_index = check_for_stop_conditions(full_response) #None if not stopping
-                    if stop_index:
-                        prediction.cancel()
-                        full_response = full_response[:stop_index]
-                        full_response = clean_up_response_formatting(full_response)
-                        break # exit the output streaming loop
-                    message_placeholder.markdown(full_response + "▌")
-                log_response(full_response,st.session_state['llm_call_uuid'],st.session_state['session_uuid'])
-                message_placeholder.markdown(full_response)
-                
-            # Add assistant response to chat history
-            st.session_state.chat_dialogue.append({"role": "assistant", "content": full_response})
-
-            next_action, next_action_input = choose_next_action(full_response)
-            log_action(next_action, next_action_input,st.session_state['llm_call_uuid'],st.session_state['session_uuid'])
-            if next_action == 'query':
-                query_result_string,query_result_markdown = query_manager(st.session_state['db'], next_action_input)
-                log_query_result(query_result_string,query_result_markdown,st.session_state['llm_call_uuid'],st.session_state['session_uuid'])
-                st.session_state['query_response_mapper'][query_result_markdown] = query_result_string
-                with st.chat_message("query result",avatar = '🦆'):
-                    message_placeholder = st.empty()
-                    message_placeholder.markdown(query_result_markdown)
-                st.session_state.chat_dialogue.append({"role": '🦆', "content": query_result_markdown})
-                if not st.session_state['query_follow_up']: 
-                    # if we don't want to pass the query result back to the LLM, then set next_action to None so we stop
-                    # unless there was an error in the query
-                    if not query_result_string.startswith('The query returned a DuckDB error message:'):
-                        next_action = None
+        chat_dialogue.append({"role": "user", "content": prompt})
+        get_agent_engine().submit(agent_session, prompt)
+
+    if agent_session.busy:
+        # follow the turn as it runs on the agent engine. A rerun in the meantime only stops this loop, not the turn
+        message_placeholder = None
+        while True:
+            busy = agent_session.busy # checked first, so the events of the end of the turn are drawn before leaving
+            for event in agent_session.drain_events():
+                if event['type'] == 'error':
+                    st.error(event['message'])
+                elif event.get('message_index', len(chat_dialogue)) < len(chat_dialogue):
+                    continue # already in the history
+                elif event['type'] == 'token':
+                    if message_placeholder is None:
+                        message_placeholder = st.chat_message("assistant").empty()
+                    message_placeholder.markdown(event['text'] + "▌")
+                elif event['type'] == 'response':
+                    if message_placeholder is None:
+                        message_placeholder = st.chat_message("assistant").empty()
+                    message_placeholder.markdown(event['text'])
+                    message_placeholder = None
+                    chat_dialogue.append({"role": "assistant", "content": event['text']})
+                elif event['type'] == 'query_result':
+                    with st.chat_message("query result",avatar = '🦆'):
+                        st.markdown(event['markdown'])
+                    chat_dialogue.append({"role": '🦆', "content": event['markdown']})
+            if not busy:
+                break
+            time.sleep(0.05)
+        st.experimental_rerun() # redraw the sidebar, e.g. the context window report, for the finished turn
 
 
     def store_sentiment(sentiment=None):
@@ -307,7 +320,7 @@ def render_app():
     def submit_feedback():
         print(st.session_state['last_sentiment_clicked'])
         print(st.session_state['feedback_text_input'])
-        log_noteworthy(st.session_state['last_sentiment_clicked'],st.session_state['feedback_text_input'],st.session_state['llm_call_uuid'],st.session_state['session_uuid'])
+        log_noteworthy(st.session_state['last_sentiment_clicked'],st.session_state['feedback_text_input'],st.session_state['agent_session'].llm_call_uuid,st.session_state['agent_session'].session_uuid)
         st.session_state['feedback_is_expanded'] = False
         st.session_state['last_sentiment_clicked'] = None #reset after submitting
         st.session_state['feedback_text_input'] = '' #reset the field
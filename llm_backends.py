@@ -0,0 +1,161 @@
+"""
+Streaming LLM backends for the chat loop.
+
+A backend starts a prediction with create(llm, input), and the returned prediction streams
+its output with iter_tokens() and can be stopped early with cancel(). The chat loop only talks to
+this interface, so the Replicate API can be swapped for the offline ReplayBackend, which plays back
+responses recorded in the interaction log. That lets the chat loop be load-tested and benchmarked
+without network latency or model cold starts.
+"""
+import re
+import time
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+import replicate
+from utils import get_llm_model_version, read_log_records, StopConditionScanner, clean_up_response_formatting, LOG_FILE
+
+
+class LLMPrediction(ABC):
+    """A running prediction. Iterate over iter_tokens() to stream the output"""
+
+    @abstractmethod
+    def iter_tokens(self):
+        ...
+
+    @abstractmethod
+    def cancel(self):
+        ...
+
+
+class LLMBackend(ABC):
+    """Starts predictions. llm is the "owner/model:version" endpoint string, and input is the
+       dict of model inputs (prompt, system_prompt, temperature, ...) that also gets logged"""
+
+    @abstractmethod
+    def create(self, llm, input):
+        ...
+
+
+class ReplicatePrediction(LLMPrediction):
+
+    def __init__(self, prediction):
+        self.prediction = prediction
+
+    def iter_tokens(self):
+        return self.prediction.output_iterator()
+
+    def cancel(self):
+        self.prediction.cancel()
+
+
+class ReplicateBackend(LLMBackend):
+    """Predictions served by the Replicate API"""
+
+    def __init__(self, api_token):
+        self.api_token = api_token
+
+    def create(self, llm, input):
+        prediction = replicate.predictions.create(get_llm_model_version(llm), input=input, api_token=self.api_token)
+        return ReplicatePrediction(prediction)
+
+
+def stream_response(prediction, on_update=None):
+    """Stream a prediction until it ends or a stop condition is met, cancelling it in that case.
+       on_update(response so far) is called after each token. Returns the response"""
+    stop_scanner = StopConditionScanner() # only scans each new item, rather than the whole response every time
+    full_response = ''
+    for item in prediction.iter_tokens():
+        full_response += item
+        stop_index = stop_scanner.feed(item) #None if not stopping
+        if stop_index:
+            prediction.cancel()
+            return clean_up_response_formatting(full_response[:stop_index])
+        if on_update is not None:
+            on_update(full_response)
+    return full_response
+
+
+# roughly how LLaMA streams: a word at a time, with its leading whitespace
+TOKEN_RE = re.compile(r'\s*\S+|\s+')
+
+def split_into_tokens(text):
+    return TOKEN_RE.findall(text)
+
+
+class ReplayPrediction(LLMPrediction):
+
+    def __init__(self, response, tokens_per_second=None, first_token_latency=0):
+        self.response = response
+        self.tokens_per_second = tokens_per_second
+        self.first_token_latency = first_token_latency
+        self.cancelled = threading.Event()
+
+    def iter_tokens(self):
+        if self.first_token_latency:
+            time.sleep(self.first_token_latency)
+        for token in split_into_tokens(self.response):
+            if self.cancelled.is_set():
+                return
+            if self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            yield token
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class ReplayBackend(LLMBackend):
+    """Offline stand-in for the Replicate API, which replays responses from the interaction log.
+
+       If the log has a response to exactly the same prompt, that one is replayed. Otherwise the
+       logged responses are handed out in the order they were recorded, cycling back to the start,
+       so a run is deterministic for a given log. tokens_per_second=None streams as fast as possible.
+       """
+
+    def __init__(self, log_path=LOG_FILE, tokens_per_second=None, first_token_latency=0):
+        self.tokens_per_second = tokens_per_second
+        self.first_token_latency = first_token_latency
+        self.responses = [] # in the order they were logged
+        self.responses_by_prompt = {} # prompt hash -> response
+        self._next_response = 0
+        self._lock = threading.Lock()
+        self.load_log(log_path)
+
+    @staticmethod
+    def prompt_key(prompt):
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    def load_log(self, log_path):
+        prompts = {} # call uuid -> prompt
+        for record in read_log_records(log_path):
+            if record['key'] == 'input_prompt':
+                prompts[record['call_uuid']] = record['value']
+            elif record['key'] == 'response':
+                self.responses.append(record['value'])
+                if record['call_uuid'] in prompts:
+                    self.responses_by_prompt.setdefault(self.prompt_key(prompts[record['call_uuid']]), record['value'])
+        if not self.responses:
+            raise ValueError(f'No logged responses found in {log_path} to replay')
+
+    def choose_response(self, prompt):
+        response = self.responses_by_prompt.get(self.prompt_key(prompt))
+        if response is not None:
+            return response
+        with self._lock: # sessions can share a backend
+            response = self.responses[self._next_response % len(self.responses)]
+            self._next_response += 1
+        return response
+
+    def create(self, llm, input):
+        return ReplayPrediction(self.choose_response(input['prompt']), self.tokens_per_second, self.first_token_latency)
+
+
+def make_backend(name, api_token='', replay_log_path=LOG_FILE, replay_tokens_per_second=None):
+    """Build a backend from its name in the LLM_BACKEND setting"""
+    if name == 'replicate':
+        return ReplicateBackend(api_token)
+    elif name == 'replay':
+        return ReplayBackend(replay_log_path, replay_tokens_per_second)
+    else:
+        raise ValueError(f'Unknown LLM backend "{name}". Choose "replicate" or "replay"')
@@ -0,0 +1,198 @@
+"""
+Scrape the interaction log into a DuckDB database, so it can be queried like any other data.
+
+    python log_ingest.py --log ./log/interaction_log.log --db ./log/interactions.duckdb
+
+Records are parsed as a stream and inserted in batches, so memory use doesn't grow with the size of the log.
+The database remembers how far into the log it has read, and a re-run only parses what was appended since.
+A record still being written (no end marker yet, or a partly written line) is left for the next run.
+
+Tables, all keyed by the call uuid (and session uuid) that prepend_uuid_on_message puts on every record:
+    sessions       one row per session, with the timestamps of its first and last record
+    llm_calls      one row per LLM call: the model name and version
+    inputs         one row per model input of each call (prompt, system_prompt, temperature, ...)
+    responses      the LLM's response to each call
+    actions        the next action chosen from each response, and its input (e.g. the query)
+    query_results  the string and markdown output of each query
+    noteworthy     examples flagged with the thumbs up / thumbs down buttons, and why
+"""
+import os
+import json
+import argparse
+import duckdb
+from utils import parse_log_records, log_value_may_be_stored, ContentStore, LOG_FILE
+
+INGEST_BATCH_SIZE = 5000 # records per insert and per transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_state (log_path VARCHAR PRIMARY KEY, byte_offset BIGINT, records BIGINT, ingested_at TIMESTAMP);
+CREATE TABLE IF NOT EXISTS sessions (session_uuid VARCHAR PRIMARY KEY, first_timestamp TIMESTAMP, last_timestamp TIMESTAMP);
+CREATE TABLE IF NOT EXISTS llm_calls (call_uuid VARCHAR PRIMARY KEY, session_uuid VARCHAR, timestamp TIMESTAMP, llm_name VARCHAR, llm_version VARCHAR);
+CREATE TABLE IF NOT EXISTS inputs (call_uuid VARCHAR, session_uuid VARCHAR, timestamp TIMESTAMP, name VARCHAR, value VARCHAR, PRIMARY KEY (call_uuid, name));
+CREATE TABLE IF NOT EXISTS responses (call_uuid VARCHAR PRIMARY KEY, session_uuid VARCHAR, timestamp TIMESTAMP, response VARCHAR);
+CREATE TABLE IF NOT EXISTS actions (call_uuid VARCHAR PRIMARY KEY, session_uuid VARCHAR, timestamp TIMESTAMP, next_action VARCHAR, action_input VARCHAR);
+CREATE TABLE IF NOT EXISTS query_results (call_uuid VARCHAR PRIMARY KEY, session_uuid VARCHAR, timestamp TIMESTAMP, result_string VARCHAR, result_markdown VARCHAR);
+CREATE TABLE IF NOT EXISTS noteworthy (call_uuid VARCHAR, session_uuid VARCHAR, timestamp TIMESTAMP, sentiment VARCHAR, reason VARCHAR, PRIMARY KEY (call_uuid, timestamp));
+"""
+
+# log key -> (table, column). Several keys fill in columns of the same row
+KEY_COLUMNS = {
+    'llm_name':('llm_calls', 'llm_name'),
+    'llm_version':('llm_calls', 'llm_version'),
+    'response':('responses', 'response'),
+    'next_action':('actions', 'next_action'),
+    'next_action_input':('actions', 'action_input'),
+    'query_result_string':('query_results', 'result_string'),
+    'query_result_markdown':('query_results', 'result_markdown'),
+    'noteworthy_example_sentiment':('noteworthy', 'sentiment'),
+    'noteworthy_example_reason':('noteworthy', 'reason'),
+}
+TABLE_COLUMNS = {
+    'llm_calls':['llm_name', 'llm_version'],
+    'inputs':['value'],
+    'responses':['response'],
+    'actions':['next_action', 'action_input'],
+    'query_results':['result_string', 'result_markdown'],
+    'noteworthy':['sentiment', 'reason'],
+}
+TABLE_KEYS = {'inputs':['call_uuid', 'name'], 'noteworthy':['call_uuid', 'timestamp']}
+
+
+def upsert_statement(table):
+    """Insert a row, or fill in the given columns of the row that is already there.
+       That way the records making up a row can arrive in different batches, or different runs"""
+    key = TABLE_KEYS.get(table, ['call_uuid'])
+    columns = ['call_uuid', 'session_uuid', 'timestamp'] + [c for c in key if c not in ('call_uuid', 'timestamp')] + TABLE_COLUMNS[table]
+    updates = [f'{column} = COALESCE(excluded.{column}, {table}.{column})' for column in TABLE_COLUMNS[table]]
+    if 'timestamp' not in key:
+        updates.append(f'timestamp = COALESCE({table}.timestamp, excluded.timestamp)') # keep the first record's
+    return (f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT ({", ".join(key)}) DO UPDATE SET {", ".join(updates)}'), columns
+
+SESSION_UPSERT = ('INSERT INTO sessions VALUES (?, ?, ?) ON CONFLICT (session_uuid) DO UPDATE SET '
+                  'first_timestamp = least(sessions.first_timestamp, excluded.first_timestamp), '
+                  'last_timestamp = greatest(sessions.last_timestamp, excluded.last_timestamp)')
+
+
+def iter_complete_lines(f, position):
+    """Lines of a log opened in binary mode, stopping at a line that is still being written.
+       position['offset'] is the byte offset just past the last line handed out"""
+    for raw_line in f:
+        if not raw_line.endswith(b'\n'):
+            return
+        position['offset'] += len(raw_line)
+        yield raw_line.decode('utf-8')
+
+def iter_records_from(path, offset):
+    """Yield (record, offset just past the record) for each complete record after offset"""
+    position = {'offset':offset}
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        lines = iter_complete_lines(f, position)
+        if path.endswith('.jsonl'):
+            records = (json.loads(line) for line in lines if line.strip())
+        else:
+            records = parse_log_records(lines) # yields each record as soon as its last line has been read
+        for record in records:
+            yield record, position['offset']
+
+
+class LogIngester:
+    """Incrementally loads one interaction log into a DuckDB database"""
+
+    def __init__(self, db_path, log_path=LOG_FILE, batch_size=INGEST_BATCH_SIZE):
+        self.db = duckdb.connect(db_path)
+        self.db.execute(SCHEMA)
+        self.log_path = os.path.abspath(log_path)
+        self.blob_store = ContentStore(os.path.join(os.path.dirname(self.log_path), 'blobs'))
+        self.batch_size = batch_size
+        self.statements = {table:upsert_statement(table) for table in TABLE_COLUMNS}
+
+    def saved_offset(self):
+        row = self.db.execute('SELECT byte_offset FROM ingest_state WHERE log_path = ?', [self.log_path]).fetchone()
+        offset = row[0] if row else 0
+        if offset > os.path.getsize(self.log_path): # the log was cleared since the last run, so start over
+            offset = 0
+        return offset
+
+    def rows_for_batch(self, batch):
+        """Merge the records of a batch into one row per table and key"""
+        rows = {table:{} for table in TABLE_COLUMNS}
+        sessions = {}
+        for record in batch:
+            timestamp = record['timestamp'].replace(',', '.')
+            session_uuid, call_uuid, key = record['session_uuid'], record['call_uuid'], record['key']
+            first, last = sessions.get(session_uuid, (timestamp, timestamp))
+            sessions[session_uuid] = (min(first, timestamp), max(last, timestamp))
+            value = self.blob_store.expand(record['value']) if log_value_may_be_stored(key) else record['value']
+            if key.startswith('input_'):
+                table, column, row_key = 'inputs', 'value', (call_uuid, key[len('input_'):])
+            elif key in KEY_COLUMNS:
+                table, column = KEY_COLUMNS[key]
+                row_key = call_uuid
+            else:
+                continue # a key from a newer version of the app; its session is still recorded
+            if table == 'noteworthy': # a call can be flagged more than once. The reason follows its sentiment
+                if column == 'sentiment':
+                    self.last_sentiment[call_uuid] = timestamp
+                row_key = (call_uuid, self.last_sentiment.pop(call_uuid, timestamp) if column == 'reason' else timestamp)
+            row = rows[table].setdefault(row_key, {'call_uuid':call_uuid, 'session_uuid':session_uuid, 'timestamp':timestamp})
+            if table == 'inputs':
+                row['name'] = row_key[1]
+            if table == 'noteworthy':
+                row['timestamp'] = row_key[1]
+            row[column] = value
+        return rows, sessions
+
+    def insert_batch(self, batch, offset, n_records):
+        rows, sessions = self.rows_for_batch(batch)
+        self.db.execute('BEGIN TRANSACTION')
+        try:
+            for table, table_rows in rows.items():
+                if table_rows:
+                    statement, columns = self.statements[table]
+                    self.db.executemany(statement, [[row.get(column) for column in columns] for row in table_rows.values()])
+            self.db.executemany(SESSION_UPSERT, [[session, first, last] for session, (first, last) in sessions.items()])
+            self.db.execute('INSERT OR REPLACE INTO ingest_state VALUES (?, ?, ?, current_timestamp)', [self.log_path, offset, n_records])
+            self.db.execute('COMMIT') # the offset only moves forward together with the rows it covers
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def ingest(self):
+        """Load everything appended to the log since the last run. Returns the number of records loaded"""
+        offset = self.saved_offset()
+        row = self.db.execute('SELECT records FROM ingest_state WHERE log_path = ?', [self.log_path]).fetchone()
+        n_records = row[0] if row and offset > 0 else 0
+        self.last_sentiment = {} # call uuid -> timestamp of its latest sentiment, to pair it with the reason
+        batch = []
+        n_new = 0
+        for record, end_offset in iter_records_from(self.log_path, offset):
+            batch.append(record)
+            offset = end_offset
+            if len(batch) >= self.batch_size:
+                n_new += len(batch)
+                self.insert_batch(batch, offset, n_records + n_new)
+                batch = []
+        if batch:
+            n_new += len(batch)
+            self.insert_batch(batch, offset, n_records + n_new)
+        return n_new
+
+    def close(self):
+        self.db.close()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log', default=LOG_FILE, help='Interaction log to ingest, text or .jsonl')
+parser.add_argument('--db', default='./log/interactions.duckdb', help='DuckDB file to load it into')
+parser.add_argument('--batch-size', default=INGEST_BATCH_SIZE, type=int, help='Records per insert')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    ingester = LogIngester(args.db, args.log, args.batch_size)
+    n_new = ingester.ingest()
+    print(f'Ingested {n_new} new records from {args.log} into {args.db}')
+    for table in ['sessions', 'llm_calls', 'inputs', 'responses', 'actions', 'query_results', 'noteworthy']:
+        print(f'  {table:<14} {ingester.db.execute(f"SELECT count(*) FROM {table}").fetchone()[0]:8d} rows')
+    ingester.close()
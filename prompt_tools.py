@@ -1,6 +1,11 @@
 import duckdb
 import re
+import json
+import functools
+import pandas as pd
 from db_specific_prompts import db_specific_prompts
+from db_manager import checkout, db_file_identity
+from schema_catalog import select_tables, column_hints, cached_column_hints, COLUMN_HINTS
 
 def get_table_details(db):
     """
@@ -12,28 +17,83 @@ def get_table_details(db):
     return df
 
 
-def get_db_specific_prompt(db):
+def get_database_name(db):
     # assumes that only one db is loaded
-    dbname = db.sql("""SELECT database_name FROM duckdb_databases() WHERE not internal""").fetchone()[0]
-    return db_specific_prompts[dbname]
+    return db.sql("""SELECT database_name FROM duckdb_databases() WHERE not internal""").fetchone()[0]
+
+def get_db_specific_prompt(db):
+    return db_specific_prompts[get_database_name(db)]
 
-def list_table_schemas(df,db_specific):
+def list_table_schemas(df,db_specific,column_hints=None):
     """
-    create a string listing out each table in the database and its column schema
+    create a string listing out each table in the database and its column schema.
+    column_hints are notes on the values of each column, as {"schema.table": {column: hint}}
     """
 
-    db_desc = """The database is a DuckDB SQL database and it has the following tables. Each table is listed in the form "schema.name", followed by an indented list of columns and their types:\n\n"""
+    db_desc = ["""The database is a DuckDB SQL database and it has the following tables. Each table is listed in the form "schema.name", followed by an indented list of columns and their types:\n\n"""]
     for row in df.itertuples():
-        db_desc += f"CREATE TABLE {row.schema}.{row.name} (\n"
-        #db_desc += f"CREATE TABLE {row.name} (\n"
+        db_desc.append(f"CREATE TABLE {row.schema}.{row.name} (\n")
+        #db_desc.append(f"CREATE TABLE {row.name} (\n")
+        table_hints = column_hints.get(f"{row.schema}.{row.name}", {}) if column_hints else {}
         for colname,coltype in zip(row.column_names,row.column_types):
-            db_desc += f"  {colname}  {coltype},\n"
-        db_desc += ");\n\n"
+            hint = table_hints.get(colname)
+            db_desc.append(f"  {colname}  {coltype},  -- {hint}\n" if hint else f"  {colname}  {coltype},\n")
+        db_desc.append(");\n\n")
 
-    db_desc += db_specific
+    db_desc.append(db_specific)
+
+    return ''.join(db_desc)
+
+
+#### schema cache
+# The database files are opened read-only, so their schema only changes if the file does.
+# It is cached per file, keyed on the file's modification time and size: in memory, and in a
+# json file next to the database, so new sessions and new processes don't need any catalog queries.
+
+def schema_cache_path(db_file):
+    return db_file + '.schema.json'
+
+def read_schema(db_file):
+    """Query the database catalog for the database name and its tables' details"""
+    with checkout(db_file) as db:
+        df = get_table_details(db)
+        database_name = get_database_name(db)
+    tables = [{'database':row.database, 'schema':row.schema, 'name':row.name,
+               'column_names':list(row.column_names), 'column_types':list(row.column_types)} for row in df.itertuples()]
+    return {'database_name':database_name, 'tables':tables}
+
+def load_schema(db_path,mtime_ns,size):
+    """Return the schema from the on-disk cache if it matches the file, otherwise read it and update the cache"""
+    cache_file = schema_cache_path(db_path)
+    try:
+        with open(cache_file,'r',encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['mtime_ns'] == mtime_ns and cached['size'] == size:
+            return cached['schema']
+    except (OSError, ValueError, KeyError):
+        pass # no usable cache
+
+    schema = read_schema(db_path)
+    try:
+        with open(cache_file,'w',encoding='utf-8') as f:
+            json.dump({'mtime_ns':mtime_ns, 'size':size, 'schema':schema}, f)
+    except OSError as e:
+        print(f'Could not write schema cache {cache_file}: {e}')
+    return schema
+
+@functools.lru_cache(maxsize=32)
+def cached_schema(db_path,mtime_ns,size):
+    return load_schema(db_path,mtime_ns,size)
+
+def get_schema(db_file):
+    """Database name and table details for a database file, from the cache when possible"""
+    return cached_schema(*db_file_identity(db_file))
 
-    return db_desc
 
+if COLUMN_HINTS:
+    SAMPLE_VALUES_NOTE = "Each column in the list of tables is followed by a comment on its values: their range, or the most common values. Use these to write your filters, rather than querying a sample of a table first."
+else:
+    SAMPLE_VALUES_NOTE = "It can be useful to view a sample of output of a table you need for your query to understand the structure of the values."
 
 def set_instructions():
     """The preface to the prompt that tells the LLM what it can do and how to behave"""
@@ -46,13 +106,13 @@ def set_instructions():
     instructions += """
 Here are a couple notes about DuckDB: DuckDB is based on PostreSQL syntax, but has many specialized functions. 
 You can get a list of tables using "PRAGMA show_tables", but remember you are already given a list of tables and their columns at the beginning of the dialog.
-It can be useful to view a sample of output of a table you need for your query to understand the structure of the values.
+{sample_values_note}
 Keys between tables are likely not explicitly declared. You will need to infer columns for JOINs based on column names and sample column contents.
 To do case insensitive comparisons, the use of "ILIKE" is recommended. ALWAYS use ILIKE instead of "=" when comparing strings such as names, countries, business names, etc..
 DO NOT use = in your queries to compare strings. Use ILIKE instead.
 Use a limit statement at the end of each query to keep the number of output rows to 20 or fewer, unless necessary.
 You MUST enclose your SQL queries in \n``` before and after the query.
-"""
+""".format(sample_values_note=SAMPLE_VALUES_NOTE)
     return instructions
 
 
@@ -103,18 +163,98 @@ def make_markdown_table_list(df):
 
     return db_desc
 
-def generate_preprompt(db):
-    df = get_table_details(db)
-    db_spec = get_db_specific_prompt(db)
-    preprompt = list_table_schemas(df,db_spec)
+def generate_preprompt(db_file):
+    return cached_preprompt(*db_file_identity(db_file))
+
+@functools.lru_cache(maxsize=32)
+def cached_preprompt(db_path,mtime_ns,size):
+    schema = cached_schema(db_path,mtime_ns,size)
+    df = pd.DataFrame(schema['tables'])
+    db_spec = db_specific_prompts[schema['database_name']]
+    hints = cached_column_hints(db_path,mtime_ns,size) if COLUMN_HINTS else None
+    preprompt = list_table_schemas(df,db_spec,hints)
     user_prepromt = make_markdown_table_list(df)
     return preprompt, user_prepromt
 
+def generate_relevant_preprompt(db_file,questions):
+    """The preprompt with the columns of only the tables relevant to the conversation's questions so far,
+       plus how to join them. Small databases, or questions no table matches, get the whole schema"""
+    selection = select_tables(db_file,questions)
+    if selection is None:
+        return generate_preprompt(db_file)[0]
+    selected, joins = selection
+    schema = get_schema(db_file)
+    df = pd.DataFrame(schema['tables'])
+    qualified_names = df['schema'] + '.' + df['name']
+    extra = []
+    if joins:
+        extra.append("These tables can be joined on:\n")
+        extra += [f"  {table}.{column} = {other}.{other_column}\n" for table, column, other, other_column in joins]
+        extra.append("\n")
+    others = ', '.join(qualified_names[~qualified_names.isin(selected)])
+    if others:
+        extra.append(f"The database also has the following tables, whose columns are omitted here: {others}\n\n")
+    return list_table_schemas(df[qualified_names.isin(selected)], ''.join(extra) + db_specific_prompts[schema['database_name']], column_hints(db_file))
+
 
 def generate_system_prompt():
     sysprompt = set_instructions() + "\n" + response_options()
     return sysprompt
 
+
+#### the dialogue sent to the LLM
+# Each message is rendered into prompt text once, when it is added, and the joined prompt is extended
+# with only the messages added since it was last built, instead of re-rendering the whole history every step.
+
+def render_message(role,content):
+    """The text a chat message contributes to the prompt"""
+    if role == '🦆':
+        return 'Query result:\n' + content + "\n\n"
+    role_name = role[0].upper() + role[1:] # capitalize 1st letter
+    return role_name + ": " + content + "\n\n"
+
+class Conversation:
+    """A chat session's dialogue: the messages shown in the chat window, and the prompt sent to the LLM.
+
+       chat_dialogue holds {"role", "content"} dicts for display. Query results are displayed as markdown but
+       sent to the LLM as plain text, so their messages also carry a "result_id" into query_results.
+       Appending is O(1), and prompt() only joins on what was appended since the last call.
+       """
+
+    def __init__(self,pre_prompt=''):
+        self.pre_prompt = pre_prompt
+        self.chat_dialogue = []
+        self.query_results = {} # result_id -> (string_out, md_out)
+        self.segments = [pre_prompt] # rendered prompt text: the preprompt, then one per message
+        self._prompt = ''
+        self._joined_segments = 0 # how many segments _prompt covers
+
+    def set_pre_prompt(self,pre_prompt):
+        if pre_prompt != self.pre_prompt:
+            self.pre_prompt = pre_prompt
+            self.segments[0] = pre_prompt
+            self._prompt = ''
+            self._joined_segments = 0
+
+    def add_message(self,role,content):
+        self.chat_dialogue.append({"role": role, "content": content})
+        self.segments.append(render_message(role,content))
+
+    def add_query_result(self,query_result_string,query_result_markdown):
+        """Show the markdown in the chat, but give the LLM the plain text version. Returns the result's id"""
+        result_id = len(self.query_results)
+        self.query_results[result_id] = (query_result_string,query_result_markdown)
+        self.chat_dialogue.append({"role": '🦆', "content": query_result_markdown, "result_id": result_id})
+        self.segments.append(render_message('🦆',query_result_string))
+        return result_id
+
+    def prompt(self):
+        """The preprompt and the whole dialogue so far, ready for "Assistant: " to be appended"""
+        if self._joined_segments < len(self.segments):
+            self._prompt = ''.join([self._prompt] + self.segments[self._joined_segments:])
+            self._joined_segments = len(self.segments)
+        return self._prompt
+
 if __name__ == '__main__':
     # if run directly, test the functions
     db = duckdb.connect('./db_files/tpch/tpch.duckdb')
@@ -0,0 +1,270 @@
+"""
+Cost-based admission control for the queries the LLM writes. Before a query runs, it is planned with EXPLAIN
+on the database itself (the shadow catalog explain_query uses has no rows, so no statistics), and DuckDB's
+cardinality estimates - the EC: in each operator of the plan - are checked against cost limits:
+
+    cross product   a CROSS_PRODUCT or nested loop join comparing more than ADMISSION_MAX_CROSS_PRODUCT_ROWS
+                    pairs of rows: rejected
+    join rows       a join estimated to produce more than ADMISSION_MAX_JOIN_ROWS rows: rejected. Joins on
+                    inequalities are estimated at a third of the pairs of rows they could match
+    rows scanned    a table of more than ADMISSION_MAX_SCAN_ROWS rows read by a query without a LIMIT: if the
+                    query aggregates, it reads a TABLESAMPLE of about that many rows of the table instead,
+                    otherwise it's rejected. Only one table is sampled, so that counts and sums scale by its
+                    sample's fraction: a query reading more than one such table (or the same one twice) is
+                    rejected, as independent samples on both sides of a join would drop most matching pairs
+    result rows     a result estimated at more than ADMISSION_MAX_RESULT_ROWS rows, without a LIMIT or an
+                    aggregate: a LIMIT is added
+
+A rejected query never reaches the query workers. run_query sends the reason back to the LLM in place of a
+result, as key: value lines it can act on, and notes any rewrite under the result of the query that ran.
+
+The plan is made on the query workers, under a deadline of its own (ADMISSION_PLAN_TIMEOUT): a query that
+can't be planned in time, e.g. because every cursor is busy, is admitted as it is, and runs under the usual
+query deadline. DuckDB leaves EC at 0 for a scan that isn't part of a join, so scans are estimated from the
+table's size in duckdb_tables(). Sampling needs sqlglot (in requirements.txt) - without it, a warning is printed and those
+queries are rejected. QUERY_ADMISSION=0 turns all of this off.
+"""
+import os
+import re
+import math
+import functools
+from db_manager import run_with_deadline, QueryTimeout, db_file_identity, explain_query, single_statement, EXPLAINABLE_RE
+
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:
+    sqlglot = None
+    print('sqlglot is not installed (pip install -r requirements.txt): aggregates over tables too large to scan will be rejected rather than sampled')
+
+QUERY_ADMISSION = os.environ.get('QUERY_ADMISSION', default='1') != '0'
+ADMISSION_MAX_CROSS_PRODUCT_ROWS = float(os.environ.get('ADMISSION_MAX_CROSS_PRODUCT_ROWS', default=1e8))
+ADMISSION_MAX_JOIN_ROWS = float(os.environ.get('ADMISSION_MAX_JOIN_ROWS', default=1e9))
+ADMISSION_MAX_SCAN_ROWS = float(os.environ.get('ADMISSION_MAX_SCAN_ROWS', default=1e8))
+ADMISSION_MAX_RESULT_ROWS = int(float(os.environ.get('ADMISSION_MAX_RESULT_ROWS', default=1e6)))
+ADMISSION_PLAN_TIMEOUT = float(os.environ.get('ADMISSION_PLAN_TIMEOUT', default=5)) # seconds to plan a query, or it's admitted unchecked
+
+PLAN_BOX_WIDTH = 29 # EXPLAIN draws each operator in a box this many characters wide, on a grid
+PLAN_SECTION_SEPARATOR = '─ ─ ─'
+EC_RE = re.compile(r'^EC: (\d+)$')
+SCAN_OPERATORS = {'SEQ_SCAN', 'INDEX_SCAN'}
+PAIRWISE_OPERATORS = {'CROSS_PRODUCT', 'NESTED_LOOP_JOIN', 'BLOCKWISE_NL_JOIN'} # compare every row of one side with every row of the other
+# DuckDB estimates a join on inequalities at the size of its larger side, however many pairs match. Those are
+# taken to match a third of the pairs, the usual default selectivity of a range predicate
+RANGE_JOIN_OPERATORS = {'PIECEWISE_MERGE_JOIN', 'IE_JOIN'}
+RANGE_JOIN_SELECTIVITY = 1 / 3
+AGGREGATE_OPERATORS = {'HASH_GROUP_BY', 'PERFECT_HASH_GROUP_BY', 'UNGROUPED_AGGREGATE', 'SIMPLE_AGGREGATE'}
+LIMIT_OPERATORS = {'LIMIT', 'STREAMING_LIMIT', 'TOP_N', 'LIMIT_PERCENT'}
+PASS_THROUGH_OPERATORS = {'PROJECTION', 'ORDER_BY', 'FILTER'} | LIMIT_OPERATORS # between the root and what decides the size of the result
+
+REJECTION_SUGGESTIONS = {
+    'cross_product':'Join the tables on a key, with JOIN ... ON, rather than listing them in FROM without a join condition.',
+    'join_rows':'Filter and aggregate each table before joining them, so fewer rows are joined.',
+    'rows_scanned':'Aggregate the rows, filter them, or add a LIMIT, rather than reading the whole table. '
+                   'Only one large table can be sampled: aggregate each of them in a query of its own, rather than joining them.',
+}
+
+
+class PlanNode:
+    """An operator in a physical plan, with DuckDB's estimate of the rows it produces (0 where it doesn't give one)"""
+
+    def __init__(self, lines):
+        sections = [[]]
+        for line in lines:
+            if line.startswith(PLAN_SECTION_SEPARATOR):
+                sections.append([])
+            elif line:
+                sections[-1].append(line)
+        self.name = sections[0][0] if sections[0] else ''
+        self.table = sections[1][0].lower() if self.name in SCAN_OPERATORS and len(sections) > 1 and sections[1] else None
+        self.estimate = 0
+        for line in sections[-1]:
+            match = EC_RE.match(line)
+            if match:
+                self.estimate = int(match.group(1))
+        self.children = []
+        self.rows = 0 # filled in by estimate_rows
+        self.pairs = 0 # pairs of rows it could match, for joins that don't match on equal keys
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def head(self):
+        """This operator and the ones under it that pass rows straight through, down to what decides the result's size"""
+        node = self
+        yield node
+        while node.name in PASS_THROUGH_OPERATORS and len(node.children) == 1:
+            node = node.children[0]
+            yield node
+
+    def tables(self):
+        return [node.table for node in self.walk() if node.table]
+
+
+def parse_plan(text):
+    """The root PlanNode of a physical plan, as EXPLAIN draws it: a grid of boxes, one row of them per level of
+       the tree, where an operator's children are in the next row, from its own column up to its next sibling's"""
+    levels = [] # [{column: PlanNode}]
+    open_boxes = {} # column -> lines of the box so far
+    for line in text.splitlines():
+        for column in range(0, len(line) // PLAN_BOX_WIDTH + 1):
+            cell = line[column * PLAN_BOX_WIDTH:(column + 1) * PLAN_BOX_WIDTH]
+            if cell.startswith('┌'):
+                if not open_boxes:
+                    levels.append({})
+                open_boxes[column] = []
+            elif cell.startswith('└') and column in open_boxes:
+                levels[-1][column] = PlanNode(open_boxes.pop(column))
+            elif cell.startswith('│') and column in open_boxes:
+                open_boxes[column].append(cell[1:-1].strip())
+    for parents, children in zip(levels, levels[1:]):
+        for column, child in children.items():
+            parents[max(parent for parent in parents if parent <= column)].children.append(child)
+    return levels[0].get(0) if levels else None
+
+def estimate_rows(node, table_rows):
+    """Fill in the rows each operator is estimated to produce, from the leaves up"""
+    for child in node.children:
+        estimate_rows(child, table_rows)
+    child_rows = [child.rows for child in node.children]
+    if node.name in PAIRWISE_OPERATORS or node.name in RANGE_JOIN_OPERATORS:
+        node.pairs = math.prod(child_rows)
+    if node.name in SCAN_OPERATORS:
+        node.rows = node.estimate or table_rows.get(node.table, 0)
+    elif node.name in RANGE_JOIN_OPERATORS:
+        node.rows = max(node.estimate, node.pairs * RANGE_JOIN_SELECTIVITY)
+    elif node.estimate:
+        node.rows = node.estimate
+    elif node.name == 'CROSS_PRODUCT':
+        node.rows = node.pairs
+    elif node.name in ('UNGROUPED_AGGREGATE', 'SIMPLE_AGGREGATE'):
+        node.rows = 1
+    else: # as many as it's given, at most
+        node.rows = max(child_rows, default=0)
+
+
+@functools.lru_cache(maxsize=32)
+def table_sizes(db_path, mtime_ns, size):
+    """{table name: rows}, as estimated in the catalog"""
+    rows = run_with_deadline(db_path, lambda db: db.sql('SELECT table_name, estimated_size FROM duckdb_tables() WHERE NOT internal').fetchall(),
+                             ADMISSION_PLAN_TIMEOUT)
+    sizes = {}
+    for table, estimated_size in rows:
+        sizes[table.lower()] = max(sizes.get(table.lower(), 0), estimated_size or 0)
+    return sizes
+
+
+class Admission:
+    """Whether and how to run a query: query, rewritten if need be, or a reason to reject it with details for the LLM"""
+
+    def __init__(self, query, reason=None, details=None, notices=(), limit=None, estimated_rows=0):
+        self.query = query
+        self.reason = reason
+        self.details = details or {}
+        self.notices = list(notices)
+        self.limit = limit # added to the query, in which case estimated_rows is what it was estimated to return without it
+        self.estimated_rows = estimated_rows
+
+    @property
+    def rejected(self):
+        return self.reason is not None
+
+    def result_notices(self, row_count):
+        """Notes on how the query was rewritten, to go under its result"""
+        notices = list(self.notices)
+        if self.limit is not None and row_count >= self.limit:
+            notices.append(f'Note: the query was estimated to return about {self.estimated_rows:,.0f} rows, so it was run with LIMIT '
+                           f'{self.limit} added, and there may be more rows. Aggregate or filter the rows to see the ones that matter.')
+        return notices
+
+def rejection(reason, query, **details):
+    print(f'Query rejected by admission control ({reason}):\n{query}\n')
+    return Admission(query, reason, {'reason':reason, **details, 'suggestion':REJECTION_SUGGESTIONS[reason]})
+
+def describe(node):
+    tables = node.tables()
+    return f"{' x '.join(tables) if tables else node.name} ({node.rows:,.0f} rows)"
+
+
+def sampled(db_path, statement, name, rows):
+    """The statement, reading table name (of about rows rows) through a TABLESAMPLE of about ADMISSION_MAX_SCAN_ROWS
+       rows, and a note for the result. None if the table isn't read exactly once in it, or the rewrite doesn't plan"""
+    try:
+        tree = sqlglot.parse_one(statement, read='duckdb')
+    except Exception: # sqlglot can't parse everything DuckDB can
+        return None
+    tables = [table for table in tree.find_all(exp.Table) if table.name.lower() == name]
+    if len(tables) != 1 or tables[0].args.get('sample') is not None: # e.g. read through a view, or joined with itself
+        return None
+    percent = float(f'{100 * ADMISSION_MAX_SCAN_ROWS / rows:.3g}')
+    tables[0].set('sample', exp.TableSample(method=exp.var('SYSTEM'), percent=exp.Literal.number(percent)))
+    rewritten = tree.sql(dialect='duckdb')
+    try:
+        explain_query(db_path, rewritten)
+    except Exception as e:
+        print(f'Sampled query failed its check:\n{rewritten}\n{e}\n')
+        return None
+    notices = [f'Note: {name} has about {rows:,.0f} rows, so this result was computed on a {percent:g}% sample of them '
+               f'(TABLESAMPLE SYSTEM), and all the rows of any other table. Counts and sums are about {percent:g}% of their '
+               f'full values, and averages, minimums and maximums are estimates.']
+    return rewritten, notices
+
+@functools.lru_cache(maxsize=1024)
+def admission(db_path, mtime_ns, size, query):
+    statement = single_statement(query)
+    if statement is None or not EXPLAINABLE_RE.match(statement):
+        return Admission(query) # not something EXPLAIN can plan
+    # planned on the query workers, under a deadline, like the query itself. A QueryTimeout isn't cached
+    plans = dict(run_with_deadline(db_path, lambda db: db.execute('EXPLAIN ' + statement).fetchall(), ADMISSION_PLAN_TIMEOUT))
+    root = parse_plan(plans.get('physical_plan', ''))
+    if root is None:
+        return Admission(query)
+    table_rows = table_sizes(db_path, mtime_ns, size)
+    estimate_rows(root, table_rows)
+
+    for node in root.walk():
+        if node.name in PAIRWISE_OPERATORS and node.pairs > ADMISSION_MAX_CROSS_PRODUCT_ROWS:
+            return rejection('cross_product', query, operator=node.name, inputs=' x '.join(describe(child) for child in node.children),
+                             estimated_pairs=f'{node.pairs:,.0f}', limit=f'{ADMISSION_MAX_CROSS_PRODUCT_ROWS:,.0f}')
+    for node in root.walk():
+        if ('JOIN' in node.name or node.name == 'CROSS_PRODUCT') and node.rows > ADMISSION_MAX_JOIN_ROWS:
+            return rejection('join_rows', query, operator=node.name, inputs=' x '.join(describe(child) for child in node.children),
+                             estimated_rows=f'{node.rows:,.0f}', limit=f'{ADMISSION_MAX_JOIN_ROWS:,.0f}')
+
+    head = list(root.head())
+    limited = any(node.name in LIMIT_OPERATORS for node in head)
+    aggregated = any(node.name in AGGREGATE_OPERATORS for node in head)
+    large_tables = {node.table:table_rows[node.table] for node in root.walk()
+                    if node.table and table_rows.get(node.table, 0) > ADMISSION_MAX_SCAN_ROWS}
+    notices = []
+    if large_tables and not limited:
+        rewrite = None
+        if aggregated and sqlglot is not None and len(large_tables) == 1: # only one table is ever sampled, see above
+            (table, rows), = large_tables.items()
+            rewrite = sampled(db_path, statement, table, rows)
+        if rewrite is None:
+            return rejection('rows_scanned', query, tables='; '.join(f'{table} ({rows:,.0f} rows)' for table, rows in large_tables.items()),
+                             limit=f'{ADMISSION_MAX_SCAN_ROWS:,.0f}')
+        statement, notices = rewrite
+
+    limit = None
+    if not limited and not aggregated and root.rows > ADMISSION_MAX_RESULT_ROWS: # an aggregate reads everything anyway
+        limit = ADMISSION_MAX_RESULT_ROWS
+        statement = f'SELECT * FROM (\n{statement}\n) LIMIT {limit}'
+    if not notices and limit is None:
+        return Admission(query)
+    print(f"Query rewritten by admission control: {', '.join(['tables sampled'] * bool(notices) + [f'LIMIT {limit} added'] * bool(limit))}\n")
+    return Admission(statement, notices=notices, limit=limit, estimated_rows=root.rows)
+
+def admit_query(db_file, query):
+    """An Admission for the query: what to run, or why not to run it. Raises the DuckDB error if it can't be planned.
+       If it can't be planned within ADMISSION_PLAN_TIMEOUT, e.g. because every cursor is busy, it's admitted as it is"""
+    if not QUERY_ADMISSION:
+        return Admission(query)
+    try:
+        return admission(*db_file_identity(db_file), query)
+    except QueryTimeout as e:
+        print(f'Query admitted without a cost check, as it could not be planned in time ({e}):\n{query}\n')
+        return Admission(query)
@@ -0,0 +1,107 @@
+"""
+Cache of formatted query results, shared by all Streamlit sessions.
+
+The agent loop often re-issues the same query, differing only in whitespace, keyword case or a trailing ;.
+Results are cached under a canonical form of the SQL plus the identity of the database file. The files are
+only ever opened read-only, so a cached result stays valid until the file itself changes.
+
+The canonical form comes from parsing the query with sqlglot (in requirements.txt). If it isn't installed, a
+warning is printed, and only the query's whitespace, case outside of quotes, and trailing semicolons are normalized.
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from db_manager import db_file_identity
+
+try:
+    import sqlglot
+except ImportError:
+    sqlglot = None
+    print('sqlglot is not installed (pip install -r requirements.txt): query cache keys only normalize whitespace and case')
+
+QUERY_CACHE_MAX_BYTES = int(os.environ.get('QUERY_CACHE_MAX_BYTES', default=64 * 1024 * 1024))
+
+# results of queries using these can change from one run to the next, so they aren't cached
+NONDETERMINISTIC_RE = re.compile(r'\b(random|setseed|gen_random_uuid|uuid|now|current_date|current_time|current_timestamp|get_current_time|today)\b|\b(using\s+sample|tablesample)\b',
+                                 re.IGNORECASE)
+# single-quoted strings, double-quoted identifiers, whitespace, or anything else
+SQL_PIECES_RE = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|(\s+)|([^'\"\s]+)")
+
+
+def simple_normalize_sql(query):
+    """Collapse whitespace and lower-case everything outside of quotes"""
+    pieces = []
+    for quoted, space, other in SQL_PIECES_RE.findall(query.strip()):
+        if quoted:
+            pieces.append(quoted)
+        elif space:
+            pieces.append(' ')
+        else:
+            pieces.append(other.lower())
+    return ''.join(pieces).strip().rstrip(';').strip()
+
+def normalize_sql(query):
+    """Canonical form of a query, so trivially different versions of it share a cache entry"""
+    if sqlglot is not None:
+        try:
+            statements = sqlglot.transpile(query, read='duckdb', write='duckdb', normalize=True)
+            return ';\n'.join(statement for statement in statements if statement)
+        except Exception: # sqlglot can't parse everything DuckDB can
+            pass
+    return simple_normalize_sql(query)
+
+
+class QueryResultCache:
+    """Size-bounded LRU cache of (string_out, md_out) query results"""
+
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (result, size in bytes), least recently used first
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(db_file, query):
+        """Return the cache key for a query, or None if its result shouldn't be cached"""
+        normalized = normalize_sql(query)
+        if NONDETERMINISTIC_RE.search(normalized):
+            return None
+        return db_file_identity(db_file), normalized
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        size = sum(len(part) for part in result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            return {'entries':len(self._entries), 'bytes':self.current_bytes, 'hits':self.hits, 'misses':self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+query_result_cache = QueryResultCache()
@@ -0,0 +1,295 @@
+"""
+Routes aggregate queries on the LFU tables to the summary tables its builder precomputes (db_utils/make_lfu.py):
+
+    per melt   SELECT _key, <aggregates> FROM arc ... GROUP BY _key
+               reads the matching columns of melt_features instead
+    per time   SELECT date_trunc('<hour, day, ...>', <time column>), <aggregates> FROM arc ... GROUP BY 1
+               re-aggregates the hourly rollups, temp_hourly or arc_hourly, instead
+
+The LLM writes per-melt CTEs like these on nearly every LFU question (see the examples in db_specific_prompts).
+Any SELECT in a query can be routed, CTEs and subqueries included, but only when all of it has an exact
+counterpart in a summary table: a single source table, grouped by melt or by a time bucket no finer than an
+hour, aggregates that were precomputed and given an alias, and (per melt) filters on the melt key only.
+Anything else - joins, other filters, HAVING, DISTINCT, window functions - leaves the SELECT as it is.
+A rewritten query is checked against the database's shadow catalog before it's used, and the query runs as
+written if the check fails.
+
+Needs sqlglot, which is in requirements.txt. Without it (a warning is printed), or with PRECOMPUTED_ROUTING=0,
+queries run as written.
+"""
+import os
+import re
+import functools
+from db_manager import checkout, db_file_identity, explain_query
+
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:
+    sqlglot = None
+    print('sqlglot is not installed (pip install -r requirements.txt): queries will not be routed to precomputed tables')
+
+PRECOMPUTED_ROUTING = os.environ.get('PRECOMPUTED_ROUTING', default='1') != '0'
+
+MELT_TABLE = 'melt_features'
+MELT_KEY = '_key'
+# per-melt aggregates of each source table, and the melt_features column holding each. present is a column that
+# is NULL for the melts with no rows in the source table, which GROUP BY on the source table wouldn't return
+MELT_ROUTES = {
+    'arc': {'present':'arc_rows', 'aggregates':{
+        'count(*)':'arc_rows',
+        'count(1)':'arc_rows',
+        'count(distinct heating_start)':'arc_cycles',
+        "sum(date_diff('second', heating_start, heating_end))":'arc_heating_seconds',
+        'sum(active_power)':'arc_active_power',
+        'avg(active_power)':'arc_avg_active_power',
+        'sum(reactive_power)':'arc_reactive_power',
+        'avg(reactive_power)':'arc_avg_reactive_power',
+        'min(heating_start)':'first_heating_start',
+        'max(heating_end)':'last_heating_end',
+    }},
+    'temp_full_with_test': {'present':'temp_rows', 'aggregates':{
+        'count(*)':'temp_rows',
+        'count(1)':'temp_rows',
+        'count(temperature)':'temp_measurements',
+        'min(_time)':'first_temp_time',
+        'max(_time)':'last_temp_time',
+        'min(temperature)':'min_temperature',
+        'max(temperature)':'max_temperature',
+        'avg(temperature)':'avg_temperature',
+        'regr_slope(temperature, epoch(_time))':'temp_slope_c_per_second',
+    }},
+}
+# hourly rollups of each source table: the time column they're bucketed by, and each aggregate re-aggregated from them
+ROLLUP_ROUTES = {
+    'arc': {'table':'arc_hourly', 'time':'heating_start', 'aggregates':{
+        'count(*)':'CAST(sum(arc_rows) AS BIGINT)',
+        'count(1)':'CAST(sum(arc_rows) AS BIGINT)',
+        "sum(date_diff('second', heating_start, heating_end))":'CAST(sum(arc_heating_seconds) AS BIGINT)',
+        'sum(active_power)':'sum(arc_active_power)',
+        'sum(reactive_power)':'sum(arc_reactive_power)',
+    }},
+    'temp_full_with_test': {'table':'temp_hourly', 'time':'_time', 'aggregates':{
+        'count(*)':'CAST(sum(n_rows) AS BIGINT)',
+        'count(1)':'CAST(sum(n_rows) AS BIGINT)',
+        'count(temperature)':'CAST(sum(temp_measurements) AS BIGINT)',
+        'sum(temperature)':'sum(sum_temperature)',
+        'avg(temperature)':'sum(sum_temperature) / sum(temp_measurements)',
+        'min(temperature)':'min(min_temperature)',
+        'max(temperature)':'max(max_temperature)',
+    }},
+}
+ROLLUP_BUCKET = 'hour_start'
+ROLLUP_UNITS = {'hour', 'day', 'week', 'month', 'quarter', 'year'} # no finer than the rollups
+DATE_TRUNC_RE = re.compile(r"^date_trunc\('(\w+)', (\w+)\)$")
+
+
+def canonical(expression):
+    """An expression's SQL without table qualifiers or identifier quotes, lower-cased, for matching"""
+    expression = expression.copy()
+    for column in expression.find_all(exp.Column):
+        column.set('table', None)
+    for identifier in expression.find_all(exp.Identifier):
+        identifier.set('quoted', False)
+    return expression.sql(dialect='duckdb').lower()
+
+@functools.lru_cache(maxsize=None)
+def canonical_aggregates(route_table, rollup):
+    """A route's aggregates, keyed by their canonical form"""
+    routes = ROLLUP_ROUTES if rollup else MELT_ROUTES
+    return {canonical(sqlglot.parse_one(aggregate, read='duckdb')):target for aggregate, target in routes[route_table]['aggregates'].items()}
+
+@functools.lru_cache(maxsize=32)
+def precomputed_tables(db_path, mtime_ns, size):
+    """{lower-cased table name: its lower-cased column names}, for the tables in the database's main schema"""
+    with checkout(db_path) as db:
+        rows = db.sql("""SELECT table_name, column_name FROM duckdb_columns() WHERE schema_name = 'main'""").fetchall()
+    tables = {}
+    for table, column in rows:
+        tables.setdefault(table.lower(), set()).add(column.lower())
+    return {table:frozenset(columns) for table, columns in tables.items()}
+
+
+def from_table(select):
+    """The one table a SELECT reads, or None if it reads anything else: joins, subqueries, functions, other schemas"""
+    from_ = select.args.get('from_') or select.args.get('from')
+    if from_ is None or select.args.get('joins') or select.args.get('laterals'):
+        return None
+    table = from_.this
+    if not isinstance(table, exp.Table) or not isinstance(table.this, exp.Identifier) or table.args.get('catalog'):
+        return None
+    if table.args.get('db') and table.db.lower() != 'main':
+        return None
+    return table
+
+def unaliased(projection):
+    return projection.this if isinstance(projection, exp.Alias) else projection
+
+def group_expression(select, columns):
+    """The one expression a SELECT is grouped by, resolving GROUP BY 1 and GROUP BY <alias>. None if it isn't,
+       or if it's ambiguous: DuckDB binds GROUP BY <name> to a column of the table before an alias of that name"""
+    group = select.args.get('group')
+    if group is None or len(group.expressions) != 1 or any(value for key, value in group.args.items() if key != 'expressions'):
+        return None
+    expression = group.expressions[0]
+    projections = select.expressions
+    if isinstance(expression, exp.Literal) and expression.is_int:
+        index = int(expression.this) - 1
+        return unaliased(projections[index]) if 0 <= index < len(projections) else None
+    if isinstance(expression, exp.Column) and not expression.table:
+        for projection in projections:
+            if isinstance(projection, exp.Alias) and projection.alias.lower() == expression.name.lower():
+                return None if expression.name.lower() in columns else projection.this
+    return expression
+
+def simple_aggregate_select(select):
+    """Whether a SELECT is free of everything routing can't carry over"""
+    if any(select.args.get(key) for key in ['having', 'distinct', 'qualify', 'windows', 'with_', 'with']):
+        return False
+    if select.find(exp.Window) or any(node is not select for node in select.find_all(exp.Select)):
+        return False
+    return True
+
+def replace_aggregates(expression, replacement):
+    """The expression with each aggregate replaced by replacement(its canonical form), or None if one can't be"""
+    failed = []
+    def replace(node):
+        if isinstance(node, exp.AggFunc):
+            new = replacement(canonical(node))
+            if new is None:
+                failed.append(node)
+                return node
+            return new
+        return node
+    expression = expression.transform(replace)
+    return None if failed else expression
+
+
+def route_to_melt_features(select, table, alias):
+    """SELECT _key, <aggregates> FROM <table> [WHERE <on _key>] GROUP BY _key, from melt_features"""
+    route = MELT_ROUTES[table.name.lower()]
+    aggregates = canonical_aggregates(table.name.lower(), False)
+    where = select.args.get('where')
+    if where is not None and (any(canonical(column) != MELT_KEY for column in where.find_all(exp.Column)) or where.find(exp.Select)):
+        return None
+
+    projections = []
+    for projection in select.expressions:
+        expression = canonical(unaliased(projection))
+        if expression == MELT_KEY:
+            projections.append(projection.copy())
+        elif expression in aggregates and isinstance(projection, exp.Alias):
+            projections.append(exp.alias_(exp.column(aggregates[expression], table=alias), projection.alias))
+        else:
+            return None
+    order = select.args.get('order')
+    if order is not None:
+        order = replace_aggregates(order.copy(), lambda aggregate: exp.column(aggregates[aggregate], table=alias) if aggregate in aggregates else None)
+        if order is None:
+            return None
+
+    present = exp.column(route['present'], table=alias).is_(exp.null()).not_()
+    routed = select.copy()
+    routed.set('expressions', projections)
+    routed.set('from_' if 'from_' in select.args else 'from', exp.From(this=exp.to_table(MELT_TABLE).as_(alias)))
+    routed.set('where', exp.Where(this=exp.and_(where.this.copy(), present) if where is not None else present))
+    routed.set('group', None)
+    routed.set('order', order)
+    return routed
+
+def route_to_rollup(select, table, alias, unit, group):
+    """SELECT date_trunc(<unit>, <time>), <aggregates> FROM <table> GROUP BY 1, from the table's hourly rollup"""
+    route = ROLLUP_ROUTES[table.name.lower()]
+    aggregates = canonical_aggregates(table.name.lower(), True)
+    if select.args.get('where') is not None:
+        return None
+    bucket = canonical(group)
+    routed_bucket = lambda: sqlglot.parse_one(f"date_trunc('{unit}', {alias}.{ROLLUP_BUCKET})", read='duckdb')
+    reaggregate = lambda aggregate: sqlglot.parse_one(aggregates[aggregate], read='duckdb') if aggregate in aggregates else None
+
+    projections = []
+    for projection in select.expressions:
+        if not isinstance(projection, exp.Alias): # the name DuckDB would give it depends on the expression
+            return None
+        expression = canonical(projection.this)
+        if expression == bucket:
+            projections.append(exp.alias_(routed_bucket(), projection.alias))
+        elif expression in aggregates:
+            projections.append(exp.alias_(reaggregate(expression), projection.alias))
+        else:
+            return None
+    group = select.args['group'].copy()
+    if canonical(group.expressions[0]) == bucket:
+        group.set('expressions', [routed_bucket()])
+    order = select.args.get('order')
+    if order is not None:
+        order = replace_aggregates(order.copy(), reaggregate)
+        if order is None:
+            return None
+        order = order.transform(lambda node: routed_bucket() if isinstance(node, (exp.TimestampTrunc, exp.DateTrunc)) and canonical(node) == bucket else node)
+
+    routed = select.copy()
+    routed.set('expressions', projections)
+    routed.set('from_' if 'from_' in select.args else 'from', exp.From(this=exp.to_table(route['table']).as_(alias)))
+    routed.set('group', group)
+    routed.set('order', order)
+    return routed
+
+def route_select(select, tables):
+    """A SELECT reading a summary table instead of its source table, or None if it can't be routed"""
+    table = from_table(select)
+    if table is None or not simple_aggregate_select(select):
+        return None
+    name = table.name.lower()
+    if name not in tables:
+        return None
+    group = group_expression(select, tables[name])
+    if group is None:
+        return None
+    alias = table.alias or table.name
+    bucket = DATE_TRUNC_RE.match(canonical(group))
+    if name in MELT_ROUTES and MELT_TABLE in tables and canonical(group) == MELT_KEY:
+        return route_to_melt_features(select, table, alias)
+    if name in ROLLUP_ROUTES and ROLLUP_ROUTES[name]['table'] in tables and bucket \
+            and bucket.group(1) in ROLLUP_UNITS and bucket.group(2) == ROLLUP_ROUTES[name]['time']:
+        return route_to_rollup(select, table, alias, bucket.group(1), group)
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def routed_query(db_path, mtime_ns, size, query):
+    tables = precomputed_tables(db_path, mtime_ns, size)
+    if MELT_TABLE not in tables and not any(route['table'] in tables for route in ROLLUP_ROUTES.values()):
+        return query # not a database with summary tables
+    try:
+        statements = sqlglot.parse(query, read='duckdb')
+    except Exception: # sqlglot can't parse everything DuckDB can
+        return query
+    statements = [statement for statement in statements if statement is not None]
+    if len(statements) != 1:
+        return query
+    routes = []
+    def route(node):
+        if isinstance(node, exp.Select):
+            routed = route_select(node, tables)
+            if routed is not None:
+                routes.append(routed)
+                return routed
+        return node
+    tree = statements[0].transform(route)
+    if not routes:
+        return query
+    rewritten = tree.sql(dialect='duckdb')
+    try:
+        explain_query(db_path, rewritten)
+    except Exception as e:
+        print(f'Routed query failed its check, running it as written:\n{rewritten}\n{e}\n')
+        return query
+    print(f'Routed {len(routes)} aggregate(s) to precomputed tables:\n{rewritten}\n')
+    return rewritten
+
+def route_query(db_file, query):
+    """The query, reading summary tables wherever they hold exactly what it aggregates"""
+    if sqlglot is None or not PRECOMPUTED_ROUTING:
+        return query
+    return routed_query(*db_file_identity(db_file), query)
@@ -0,0 +1,324 @@
+"""
+Relevance index over a database's tables, to send the LLM only the part of a wide schema a question needs.
+
+The index is built once per database file, and saved next to it as <db file>.catalog.json. For each table
+it holds the words of the table and column names, the db_specific_prompts paragraphs mentioning the table,
+and a sample of the distinct values of its text columns. It also holds the joins between tables, inferred
+from the column names: the same key column in two tables (_key), the TPC-H style prefixed keys
+(o_custkey = c_custkey), and <table>Id columns referencing a table's id column (competitionId = Competitions.id).
+
+select_tables ranks the tables for a conversation's questions, takes the top few for each question, and
+adds the tables needed to join them together.
+
+The column statistics are also built once per database file, and saved as <db file>.stats.json: each column's
+range, approximate number of distinct values, null fraction, and its most common values if it has only a few.
+column_hints turns them into short notes that the schema prompt puts next to each column, so the LLM knows
+what the values look like without spending a turn on querying a sample of the table.
+"""
+import os
+import re
+import json
+import math
+import functools
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from db_manager import checkout, db_file_identity, MAX_CURSORS_PER_DB
+from db_specific_prompts import db_specific_prompts
+
+SCHEMA_TOP_K = int(os.environ.get('SCHEMA_TOP_K', default=4)) # most relevant tables kept for each question
+SCHEMA_RETRIEVAL_MIN_TABLES = int(os.environ.get('SCHEMA_RETRIEVAL_MIN_TABLES', default=10)) # smaller databases always get the whole schema
+SAMPLE_ROWS = 10000 # rows sampled from each table for its text values
+SAMPLE_VALUES = 50 # distinct values kept per column
+MAX_VALUE_LENGTH = 40 # longer values are free text, not worth indexing
+COLUMN_HINTS = os.environ.get('COLUMN_HINTS', default='1') != '0' # annotate the schema prompt with column statistics
+TOP_VALUES = 5 # most common values listed for a column
+TOP_VALUES_MAX_DISTINCT = 25 # only for columns with at most this many distinct values
+HINT_VALUE_LENGTH = 24 # values in hints are cut to this length
+
+# weight of a question word found in each part of a table's entry
+FIELD_WEIGHTS = {'name':3.0, 'columns':2.0, 'values':1.5, 'description':1.0}
+
+WORD_RE = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+')
+STOP_WORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'did', 'do', 'does', 'for', 'from', 'had', 'has', 'have', 'how',
+              'i', 'in', 'is', 'it', 'many', 'me', 'most', 'much', 'of', 'on', 'or', 'per', 'show', 'that', 'the', 'there', 'this',
+              'to', 'was', 'were', 'what', 'when', 'where', 'which', 'who', 'with', 'you', 'all', 'each', 'list', 'give', 'find'}
+IRREGULAR_WORDS = {'people':'person', 'children':'child', 'men':'man', 'women':'woman'}
+
+
+def words(text):
+    """Lower-cased words of some text, split on camelCase and underscores, with plurals stripped"""
+    result = []
+    for word in WORD_RE.findall(text):
+        word = word.lower()
+        if word in STOP_WORDS:
+            continue
+        word = IRREGULAR_WORDS.get(word, word)
+        if len(word) > 3 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        result.append(word)
+    return result
+
+
+def catalog_path(db_file):
+    return db_file + '.catalog.json'
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def infer_joins(tables):
+    """Join conditions between tables, as [table, column, other table, other column] lists"""
+    joins = []
+    names = list(tables)
+    for i, table in enumerate(names):
+        for other in names[i + 1:]:
+            for column in tables[table]['columns']:
+                for other_column in tables[other]['columns']:
+                    if is_join(table, column, other, other_column) or is_join(other, other_column, table, column):
+                        joins.append([table, column, other, other_column])
+    return joins
+
+def is_join(table, column, other, other_column):
+    column, other_column = column.lower(), other_column.lower()
+    if column == other_column and (column.endswith('key') or column.endswith('_id')):
+        return True
+    unprefixed = re.sub(r'^[a-z]{1,2}_', '', column)
+    if unprefixed.endswith('key') and unprefixed == re.sub(r'^[a-z]{1,2}_', '', other_column) and unprefixed != column:
+        return True
+    if other_column == 'id' and column.endswith('id') and len(column) > 2: # competitionId -> Competitions.id
+        referenced = column[:-2].rstrip('_')
+        other_name = other.split('.')[-1].lower()
+        return other_name in (referenced, referenced + 's', referenced + 'es', referenced[:-1] + 'ies')
+    return False
+
+
+def build_catalog(db_file):
+    """Read the tables, columns and sample values of a database and index them"""
+    with checkout(db_file) as db:
+        database_name = db.sql("""SELECT database_name FROM duckdb_databases() WHERE not internal""").fetchone()[0]
+        rows = db.sql("""SELECT schema_name, table_name, column_name, data_type FROM duckdb_columns() WHERE NOT internal
+                         ORDER BY schema_name, table_name, column_index""").fetchall()
+        tables = {}
+        for schema_name, table_name, column_name, data_type in rows:
+            table = tables.setdefault(f'{schema_name}.{table_name}', {'columns':[], 'types':[]})
+            table['columns'].append(column_name)
+            table['types'].append(data_type)
+
+        description = db_specific_prompts.get(database_name, '')
+        paragraphs = [p for p in re.split(r'\n\s*\n', description) if p.strip()]
+        for name, table in tables.items():
+            table_name = name.split('.')[-1]
+            text_columns = [c for c, t in zip(table['columns'], table['types']) if t == 'VARCHAR']
+            values = []
+            for column in text_columns:
+                values += [v for (v,) in db.execute(f"""SELECT DISTINCT v FROM (SELECT {quote(column)} AS v FROM {quote(name.split('.')[0])}.{quote(table_name)}
+                                                         USING SAMPLE {SAMPLE_ROWS} ROWS) WHERE length(v) <= {MAX_VALUE_LENGTH} LIMIT {SAMPLE_VALUES}""").fetchall()]
+            mentioned_in = [p for p in paragraphs if re.search(r'\b' + re.escape(table_name) + r'\b', p, re.IGNORECASE)]
+            table['fields'] = {'name':sorted(set(words(table_name))),
+                               'columns':sorted(set(w for column in table['columns'] for w in words(column))),
+                               'values':sorted(set(w for value in values for w in words(value))),
+                               'description':dict(Counter(w for p in mentioned_in for w in words(p)))}
+    return {'database_name':database_name, 'tables':tables, 'joins':infer_joins(tables)}
+
+def load_or_build(path, mtime_ns, size, build):
+    """Return what was saved at path if it was built from this version of the database file,
+       otherwise build(), save it and return it"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['mtime_ns'] == mtime_ns and cached['size'] == size:
+            return cached['catalog']
+    except (OSError, ValueError, KeyError):
+        pass # nothing usable saved
+
+    catalog = build()
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'mtime_ns':mtime_ns, 'size':size, 'catalog':catalog}, f)
+    except OSError as e:
+        print(f'Could not write {path}: {e}')
+    return catalog
+
+def load_catalog(db_path, mtime_ns, size):
+    return load_or_build(catalog_path(db_path), mtime_ns, size, lambda: build_catalog(db_path))
+
+@functools.lru_cache(maxsize=32)
+def cached_catalog(db_path, mtime_ns, size):
+    return load_catalog(db_path, mtime_ns, size)
+
+def get_catalog(db_file):
+    return cached_catalog(*db_file_identity(db_file))
+
+
+def rank_tables(catalog, question):
+    """[(score, table)] for the tables matching any word of the question, best first.
+       Words found in fewer tables count for more, like in tf-idf"""
+    tables = catalog['tables']
+    document_frequency = Counter()
+    for table in tables.values():
+        document_frequency.update(set(w for field in table['fields'].values() for w in field))
+    scores = []
+    for name, table in tables.items():
+        fields = table['fields']
+        score = 0.0
+        for word in set(words(question)):
+            if not document_frequency[word]:
+                continue
+            idf = math.log(1 + len(tables) / document_frequency[word])
+            matched = sum(weight for field, weight in FIELD_WEIGHTS.items() if field != 'description' and word in fields[field])
+            matched += FIELD_WEIGHTS['description'] * min(fields['description'].get(word, 0), 3) / 3
+            score += idf * matched
+        if score > 0:
+            scores.append((score, name))
+    scores.sort(key=lambda s: -s[0])
+    return scores
+
+def join_path(catalog, start, end):
+    """Shortest chain of joins from one table to another, as a list of joins, or None"""
+    neighbours = {}
+    for join in catalog['joins']:
+        neighbours.setdefault(join[0], []).append((join[2], join))
+        neighbours.setdefault(join[2], []).append((join[0], join))
+    previous = {start:None}
+    to_visit = deque([start])
+    while to_visit:
+        table = to_visit.popleft()
+        if table == end:
+            path = []
+            while previous[table] is not None:
+                table, join = previous[table]
+                path.append(join)
+            return path[::-1]
+        for neighbour, join in neighbours.get(table, []):
+            if neighbour not in previous:
+                previous[neighbour] = (table, join)
+                to_visit.append(neighbour)
+    return None
+
+@functools.lru_cache(maxsize=1024)
+def relevant_tables(db_path, mtime_ns, size, question, top_k):
+    return tuple(name for _, name in rank_tables(cached_catalog(db_path, mtime_ns, size), question)[:top_k])
+
+def select_tables(db_file, questions, top_k=SCHEMA_TOP_K):
+    """The tables to show the LLM for a conversation's questions, and the joins between them.
+       Returns (tables in catalog order, joins), or None when the whole schema should be used:
+       the database is small, or none of its tables match the questions"""
+    catalog = get_catalog(db_file)
+    if len(catalog['tables']) < SCHEMA_RETRIEVAL_MIN_TABLES:
+        return None
+    selected = []
+    for question in questions: # tables stay selected for the rest of the conversation, so earlier queries keep making sense
+        for name in relevant_tables(*db_file_identity(db_file), question, top_k):
+            if name not in selected:
+                selected.append(name)
+    if not selected:
+        return None
+    joins = []
+    for name in selected[1:]: # connect every table to the best match, through other tables if needed
+        for join in join_path(catalog, selected[0], name) or []:
+            if join not in joins:
+                joins.append(join)
+    included = set(selected) | set(j[0] for j in joins) | set(j[2] for j in joins)
+    return [name for name in catalog['tables'] if name in included], joins
+
+
+#### column statistics
+
+def stats_path(db_file):
+    return db_file + '.stats.json'
+
+def has_stats(column_type):
+    """Whether min and max make sense for a column type: not for nested types or blobs"""
+    return not any(marker in column_type for marker in ('[', 'STRUCT', 'MAP', 'UNION', 'BLOB'))
+
+def summarize_table(db_file, table, columns, types):
+    """Statistics of each column of a table, from one pass of approximate aggregates,
+       plus the most common values of text columns with only a few distinct ones"""
+    columns = [(c, t) for c, t in zip(columns, types) if has_stats(t)]
+    aggregates = ['count(*)'] + [f'min({quote(c)})::VARCHAR, max({quote(c)})::VARCHAR, approx_count_distinct({quote(c)}), count({quote(c)})'
+                                 for c, _ in columns]
+    table_sql = '.'.join(quote(part) for part in table.split('.'))
+    with checkout(db_file) as db:
+        row = db.execute(f'SELECT {", ".join(aggregates)} FROM {table_sql}').fetchone()
+        n_rows = row[0]
+        stats = {}
+        for i, (column, column_type) in enumerate(columns):
+            minimum, maximum, distinct, non_null = row[1 + 4 * i: 5 + 4 * i]
+            stats[column] = {'type':column_type, 'min':minimum, 'max':maximum, 'distinct':distinct,
+                             'null_fraction':1 - non_null / n_rows if n_rows else 0, 'top_values':None}
+            if column_type == 'VARCHAR' and 0 < distinct <= TOP_VALUES_MAX_DISTINCT:
+                stats[column]['top_values'] = [v for (v, _) in db.execute(
+                    f'SELECT {quote(column)}, count(*) AS n FROM {table_sql} WHERE {quote(column)} IS NOT NULL '
+                    f'GROUP BY 1 ORDER BY n DESC, 1 LIMIT {TOP_VALUES}').fetchall()]
+    return {'rows':n_rows, 'columns':stats}
+
+def build_column_stats(db_file):
+    """Summarize every table, several at once on the database's pooled cursors"""
+    with checkout(db_file) as db:
+        rows = db.sql("""SELECT schema_name, table_name, column_name, data_type FROM duckdb_columns() WHERE NOT internal
+                         ORDER BY schema_name, table_name, column_index""").fetchall()
+    tables = {}
+    for schema_name, table_name, column_name, data_type in rows:
+        table = tables.setdefault(f'{schema_name}.{table_name}', ([], []))
+        table[0].append(column_name)
+        table[1].append(data_type)
+    with ThreadPoolExecutor(max_workers=MAX_CURSORS_PER_DB) as executor:
+        summaries = executor.map(lambda item: summarize_table(db_file, item[0], *item[1]), tables.items())
+        return {'tables':dict(zip(tables, summaries))}
+
+def load_column_stats(db_path, mtime_ns, size):
+    return load_or_build(stats_path(db_path), mtime_ns, size, lambda: build_column_stats(db_path))
+
+@functools.lru_cache(maxsize=32)
+def cached_column_stats(db_path, mtime_ns, size):
+    return load_column_stats(db_path, mtime_ns, size)
+
+def get_column_stats(db_file):
+    return cached_column_stats(*db_file_identity(db_file))
+
+
+def short_value(value, column_type='VARCHAR'):
+    """A value as it appears in a hint: numbers to 6 significant digits, timestamps as dates, long text cut short"""
+    if column_type.startswith('TIMESTAMP'):
+        return value[:10]
+    try:
+        number = float(value)
+        if not value.isdigit() and math.isfinite(number):
+            return f'{number:.6g}'
+    except ValueError:
+        pass
+    return value if len(value) <= HINT_VALUE_LENGTH else value[:HINT_VALUE_LENGTH] + '...'
+
+def column_hint(stats):
+    """A few words on what a column's values look like, e.g. "7 values: 'AIR', 'MAIL', ..." or "1 to 50, 3% null" """
+    if stats['min'] is None:
+        return 'always null'
+    parts = []
+    if stats['top_values'] is not None and len(stats['top_values']) == 1 and stats['distinct'] <= 1:
+        parts.append(f"always '{short_value(stats['top_values'][0])}'")
+    elif stats['top_values'] is not None:
+        values = ', '.join("'" + short_value(v) + "'" for v in stats['top_values'])
+        more = ', ...' if stats['distinct'] > len(stats['top_values']) else ''
+        parts.append(f"{len(stats['top_values']) if not more else '~' + str(stats['distinct'])} values: {values}{more}")
+    elif stats['type'] == 'VARCHAR':
+        parts.append(f"~{stats['distinct']} distinct, e.g. '{short_value(stats['min'])}'")
+    elif stats['min'] == stats['max']:
+        parts.append(f"always {short_value(stats['min'], stats['type'])}")
+    else:
+        parts.append(f"{short_value(stats['min'], stats['type'])} to {short_value(stats['max'], stats['type'])}")
+    if stats['null_fraction'] >= 0.005:
+        parts.append(f"{stats['null_fraction']:.0%} null")
+    return ', '.join(parts)
+
+@functools.lru_cache(maxsize=32)
+def cached_column_hints(db_path, mtime_ns, size):
+    stats = cached_column_stats(db_path, mtime_ns, size)
+    return {table:{column:column_hint(column_stats) for column, column_stats in table_stats['columns'].items()}
+            for table, table_stats in stats['tables'].items()}
+
+def column_hints(db_file):
+    """{"schema.table": {column: hint}} for a database file, or None if hints are turned off"""
+    if not COLUMN_HINTS:
+        return None
+    return cached_column_hints(*db_file_identity(db_file))
@@ -0,0 +1,158 @@
+"""
+AgentEngine runs the agent loop of many sessions on one background event loop: each turn asks the LLM, runs the
+query it chose, and hands back the result until the LLM answers. The LLM here is a scripted backend that asks one
+query per question and then answers it.
+"""
+import os
+import re
+import time
+import threading
+from concurrent.futures import CancelledError
+import pytest
+import utils
+from agent_engine import AgentEngine, AgentSession
+from llm_backends import LLMBackend, ReplayPrediction
+from prompt_tools import generate_preprompt
+
+LFU_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db_files', 'lfu', 'lfu.duckdb')
+LLM = 'meta/codellama-34b-instruct:1' # a window large enough for the LFU schema
+WAIT = 10 # seconds, before a test gives up on a thread
+QUERIES = {'How many arcs are there?':'SELECT count(*) AS n FROM arc',
+           'How many melts are there?':'SELECT count(DISTINCT _key) AS n FROM arc',
+           'What is in the bogus table?':'SELECT * FROM bogus'}
+
+
+class ScriptedPrediction(ReplayPrediction):
+    """A replayed response that starts after latency seconds, unless it is cancelled first"""
+
+    def __init__(self, response, latency):
+        super().__init__(response)
+        self.latency = latency
+
+    def iter_tokens(self):
+        if not self.cancelled.wait(self.latency):
+            yield from super().iter_tokens()
+
+
+class ScriptedBackend(LLMBackend):
+    """Answers the latest question with its query from QUERIES, and once the query has run, with its result"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = []
+        self.predictions = []
+        self.lock = threading.Lock()
+
+    def create(self, llm, input):
+        with self.lock:
+            self.calls.append(input)
+        latest_turn = input['prompt'].rsplit('User: ', 1)[1]
+        question = latest_turn.split('\n\n', 1)[0]
+        if 'Query result:' in latest_turn:
+            result = latest_turn.rsplit('Query result:\n', 1)[1].strip()
+            response = f'The answer is {re.findall(r"[0-9]+", result)[-1] if re.search("[0-9]", result) else "unknown"}.'
+        else:
+            response = 'Query: ' + QUERIES[question]
+        prediction = ScriptedPrediction(response, self.latency)
+        with self.lock:
+            self.predictions.append(prediction)
+        return prediction
+
+
+@pytest.fixture(autouse=True)
+def log_path(tmp_path):
+    path = str(tmp_path / 'interaction_log.log')
+    utils.configure_interaction_log(path, 'text') # the turns are logged, but not to the app's log
+    yield path
+    utils.configure_interaction_log()
+
+@pytest.fixture
+def engine():
+    engine = AgentEngine(ScriptedBackend())
+    yield engine
+    engine.close()
+
+def new_session(**settings):
+    return AgentSession(LFU_DB, generate_preprompt(LFU_DB)[0], dict({'llm':LLM}, **settings))
+
+
+def test_turn_runs_the_query_and_answers(engine):
+    session = new_session()
+    assert engine.run(session, 'How many arcs are there?') == 2
+    dialogue = session.conversation.chat_dialogue
+    assert [message['role'] for message in dialogue] == ['user', 'assistant', '🦆', 'assistant']
+    assert dialogue[1]['content'] == 'Query: SELECT count(*) AS n FROM arc'
+    assert dialogue[3]['content'] == 'The answer is 14876.'
+    events = session.drain_events()
+    assert [event['type'] for event in events if event['type'] not in ('token', 'context_report')] == \
+        ['response', 'query_result', 'response', 'done']
+    assert [event['message_index'] for event in events if event['type'] in ('response', 'query_result')] == [1, 2, 3]
+    assert sum(event['type'] == 'context_report' for event in events) == 2
+    assert session.context_report['max_new_tokens'] <= 512
+    assert not session.busy
+
+def test_query_error_goes_back_to_the_llm(engine):
+    session = new_session(max_steps=2)
+    engine.run(session, 'What is in the bogus table?')
+    events = session.drain_events()
+    assert [event['is_error'] for event in events if event['type'] == 'query_result'] == [True]
+    assert 'Catalog Error' in engine.backend.calls[-1]['prompt']
+
+def test_without_follow_up_the_turn_stops_at_the_result(engine):
+    session = new_session(query_follow_up=False)
+    assert engine.run(session, 'How many arcs are there?') == 1
+    assert session.conversation.chat_dialogue[-1]['role'] == '🦆'
+
+def test_sessions_take_turns_at_the_same_time():
+    engine = AgentEngine(ScriptedBackend(latency=0.5))
+    try:
+        sessions = [new_session(stream_tokens=False) for _ in range(4)]
+        start = time.monotonic()
+        turns = [engine.submit(session, question) for session, question in zip(sessions, list(QUERIES)[:2] * 2)]
+        assert [turn.result(timeout=WAIT) for turn in turns] == [2] * 4
+        assert time.monotonic() - start < 4 * 2 * 0.5 # not one after the other
+        assert sessions[1].conversation.chat_dialogue[-1]['content'] == 'The answer is 3214.'
+    finally:
+        engine.close()
+
+def test_session_answers_one_question_at_a_time():
+    engine = AgentEngine(ScriptedBackend(latency=0.5))
+    try:
+        session = new_session()
+        turn = engine.submit(session, 'How many arcs are there?')
+        with pytest.raises(RuntimeError, match='still answering'):
+            engine.submit(session, 'How many melts are there?')
+        turn.result(timeout=WAIT)
+    finally:
+        engine.close()
+
+def test_cancelled_turn_stops_its_prediction():
+    engine = AgentEngine(ScriptedBackend(latency=WAIT))
+    try:
+        session = new_session()
+        turn = engine.submit(session, 'How many arcs are there?')
+        deadline = time.monotonic() + WAIT
+        while session.prediction is None: # wait for the prediction to start
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        engine.cancel(session)
+        with pytest.raises(CancelledError):
+            turn.result(timeout=WAIT)
+        assert engine.backend.predictions[0].cancelled.is_set()
+        deadline = time.monotonic() + WAIT
+        while not any(event['type'] == 'done' for event in session.drain_events()):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        engine.close()
+
+def test_failed_turn_reports_its_error(engine, monkeypatch):
+    def create(llm, input):
+        raise ConnectionError('model is down')
+    monkeypatch.setattr(engine.backend, 'create', create)
+    session = new_session()
+    with pytest.raises(ConnectionError):
+        engine.run(session, 'How many arcs are there?')
+    events = session.drain_events()
+    assert {'type':'error', 'message':'model is down'} in events
+    assert events[-1]['type'] == 'done' and not events[-1]['cancelled']
@@ -0,0 +1,130 @@
+"""
+generate_candidates races several predictions for an agent step and keeps the first whose query runs, cancelling
+the rest. The predictions come from a scripted backend, each candidate's by its temperature.
+"""
+import time
+import threading
+import duckdb
+import pytest
+import db_manager
+import utils
+from candidates import generate_candidates, candidate_inputs, MAX_TEMPERATURE
+from llm_backends import LLMBackend, ReplayPrediction
+
+GOOD = 'Query: SELECT count(*) AS n FROM orders'
+BAD = 'Query: SELECT count(*) FROM order_lines'
+ANSWER = 'There are 1000 orders.'
+INPUT = {'prompt':'User: How many orders are there?\n\n', 'temperature':0.1}
+WAIT = 10 # seconds, before a test gives up on a thread
+
+
+class ScriptedPrediction(ReplayPrediction):
+    """A replayed response that starts after latency seconds, unless it is cancelled first"""
+
+    def __init__(self, response, latency):
+        super().__init__(response)
+        self.latency = latency
+        self.finished = threading.Event()
+
+    def iter_tokens(self):
+        try:
+            if not self.cancelled.wait(self.latency):
+                yield from super().iter_tokens()
+        finally:
+            self.finished.set()
+
+
+backends = []
+
+class ScriptedBackend(LLMBackend):
+    """Streams the response scripted for each temperature, after its latency in seconds"""
+
+    def __init__(self, script, fail=()):
+        self.script = {round(temperature, 2):response for temperature, response in script.items()}
+        self.fail = {round(temperature, 2) for temperature in fail}
+        self.predictions = {} # by temperature
+        self.started = [] # every prediction, including those of models sharing a temperature
+        backends.append(self)
+
+    def create(self, llm, input):
+        temperature = round(input['temperature'], 2)
+        if temperature in self.fail:
+            raise ConnectionError(f'{llm} is unavailable')
+        response, latency = self.script[temperature]
+        prediction = self.predictions[temperature] = ScriptedPrediction(response, latency)
+        self.started.append(prediction)
+        return prediction
+
+
+@pytest.fixture(scope='module')
+def db_file(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp('candidates') / 'shop.duckdb')
+    db = duckdb.connect(db_file)
+    db.execute('CREATE TABLE orders AS SELECT range AS o_id FROM range(1000)')
+    db.close()
+    yield db_file
+    db_manager.close_all()
+
+@pytest.fixture(autouse=True)
+def log_path(tmp_path):
+    path = str(tmp_path / 'interaction_log.log')
+    utils.configure_interaction_log(path, 'text') # candidates are logged, but not to the app's log
+    yield path
+    for backend in backends: # the losing candidates log their responses once they stop
+        for prediction in backend.started:
+            assert prediction.finished.wait(WAIT)
+    backends.clear()
+    time.sleep(0.1)
+    utils.configure_interaction_log()
+
+def race(backend, db_file, n_candidates, llms=('a/llama:1',)):
+    return generate_candidates(backend, list(llms), INPUT, db_file, n_candidates, 'session')
+
+
+def test_models_take_turns_and_the_temperature_goes_up_each_round():
+    inputs = candidate_inputs(['a/llama:1', 'b/sqlcoder:1'], {'prompt':'', 'temperature':0.1}, 5)
+    assert [llm for llm, _ in inputs] == ['a/llama:1', 'b/sqlcoder:1'] * 2 + ['a/llama:1']
+    assert [input['temperature'] for _, input in inputs] == pytest.approx([0.1, 0.1, 0.4, 0.4, 0.7])
+    assert candidate_inputs(['a/llama:1'], {'prompt':'', 'temperature':4.9}, 2)[1][1]['temperature'] == MAX_TEMPERATURE
+
+def test_first_candidate_that_runs_wins_and_the_rest_are_cancelled(db_file):
+    backend = ScriptedBackend({0.1:(BAD, 0), 0.4:(GOOD, 0.3), 0.7:(GOOD, 5)})
+    start = time.monotonic()
+    winner, metrics = race(backend, db_file, 3)
+    assert time.monotonic() - start < 5 # didn't wait for the slowest one
+    assert winner.index == 1 and winner.response == GOOD
+    assert winner.query_result is not None and '1000' in winner.query_result[0] # already run, so the step can use it
+    assert metrics['finished'] == 2 and metrics['valid'] == 1 and metrics['winner_temperature'] == pytest.approx(0.4)
+    assert backend.predictions[0.7].cancelled.is_set()
+    assert not backend.predictions[0.4].cancelled.is_set()
+
+def test_answer_without_a_query_wins(db_file):
+    winner, _ = race(ScriptedBackend({0.1:(ANSWER, 0), 0.4:(GOOD, 2)}), db_file, 2)
+    assert winner.next_action is None and winner.query_result is None
+
+def test_first_error_is_used_when_every_query_fails(db_file):
+    winner, metrics = race(ScriptedBackend({0.1:(BAD, 0.2), 0.4:(BAD + ' WHERE 1', 0)}), db_file, 2)
+    assert winner.index == 1 # finished first
+    assert utils.is_query_error(winner.query_result[0])
+    assert metrics['valid'] == 0 and metrics['finished'] == 2
+
+def test_failed_prediction_doesnt_stop_the_others(db_file, capsys):
+    winner, metrics = race(ScriptedBackend({0.4:(GOOD, 0)}, fail=[0.1]), db_file, 2)
+    assert winner.index == 1 and metrics['failed'] == 1
+    assert 'Candidate failed: a/llama:1 is unavailable' in capsys.readouterr().out
+
+def test_error_is_raised_when_every_prediction_fails(db_file):
+    with pytest.raises(ConnectionError):
+        race(ScriptedBackend({}, fail=[0.1, 0.4]), db_file, 2)
+
+def test_each_candidate_is_logged_as_a_call_of_its_own(db_file, log_path):
+    backend = ScriptedBackend({0.1:(GOOD, 0)}) # both models write at the first temperature
+    race(backend, db_file, 2, llms=('a/llama:1', 'b/sqlcoder:1'))
+    for prediction in backend.started:
+        assert prediction.finished.wait(WAIT)
+    time.sleep(0.1) # the losing candidate may still be logging its response
+    utils.log_writer.stop()
+    records = list(utils.read_log_records(log_path))
+    calls = {record['call_uuid']:record['value'] for record in records if record['key'] == 'llm_name'}
+    assert sorted(calls.values()) == ['a/llama', 'b/sqlcoder']
+    assert len([record for record in records if record['key'] == 'response']) == 2
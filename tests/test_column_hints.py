@@ -0,0 +1,70 @@
+"""
+column_hints summarizes each column from statistics computed once per database file, for the schema prompt to put
+next to the column.
+"""
+import os
+import duckdb
+import pytest
+import pandas as pd
+import db_manager
+import schema_catalog
+from schema_catalog import column_hints, column_hint, short_value, stats_path
+from prompt_tools import list_table_schemas
+
+
+@pytest.fixture(scope='module')
+def db_file(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp('hints') / 'shop.duckdb')
+    db = duckdb.connect(db_file)
+    db.execute("""CREATE TABLE orders AS SELECT
+                      range + 1 AS o_orderkey,
+                      (['F', 'O', 'P'])[range % 3 + 1] AS o_orderstatus,
+                      'Clerk#' || range AS o_clerk,
+                      CASE WHEN range % 10 = 0 THEN NULL ELSE range * 1.5 END AS o_totalprice,
+                      TIMESTAMP '2019-05-03 10:00:00' + INTERVAL (range) HOUR AS o_orderdate,
+                      'EUR' AS o_currency,
+                      NULL::INTEGER AS o_discount,
+                      [range] AS o_lines
+                  FROM range(1000)""")
+    db.close()
+    yield db_file
+    db_manager.close_all()
+
+
+def test_hints_describe_each_column(db_file):
+    hints = column_hints(db_file)['main.orders']
+    assert hints['o_orderkey'] == '1 to 1000'
+    assert hints['o_orderstatus'] == "3 values: 'F', 'O', 'P'"
+    assert hints['o_clerk'].startswith('~') and "distinct, e.g. 'Clerk#" in hints['o_clerk']
+    assert hints['o_totalprice'] == '1.5 to 1498.5, 10% null'
+    assert hints['o_orderdate'] == '2019-05-03 to 2019-06-14'
+    assert hints['o_currency'] == "always 'EUR'"
+    assert hints['o_discount'] == 'always null'
+    assert 'o_lines' not in hints # no range for a list
+
+def test_hints_go_next_to_their_columns_in_the_schema(db_file):
+    schema = [{'schema':'main', 'name':'orders', 'column_names':['o_orderkey', 'o_lines'], 'column_types':['BIGINT', 'BIGINT[]']}]
+    prompt = list_table_schemas(pd.DataFrame(schema), '', column_hints(db_file))
+    assert '  o_orderkey  BIGINT,  -- 1 to 1000\n' in prompt
+    assert '  o_lines  BIGINT[],\n' in prompt
+
+def test_stats_are_saved_next_to_the_database(db_file):
+    column_hints(db_file)
+    assert os.path.exists(stats_path(db_file))
+
+def test_hints_can_be_turned_off(db_file, monkeypatch):
+    monkeypatch.setattr(schema_catalog, 'COLUMN_HINTS', False)
+    assert column_hints(db_file) is None
+
+@pytest.mark.parametrize('value, column_type, short', [
+    ('0.123456789', 'DOUBLE', '0.123457'),
+    ('12345', 'BIGINT', '12345'),
+    ('2019-05-03 10:00:00', 'TIMESTAMP', '2019-05-03'),
+    ('A very long piece of free text, cut', 'VARCHAR', 'A very long piece of fre...'),
+])
+def test_values_are_shortened(value, column_type, short):
+    assert short_value(value, column_type) == short
+
+def test_many_common_values_are_listed_as_a_sample():
+    stats = {'type':'VARCHAR', 'min':'A', 'max':'Z', 'distinct':12, 'null_fraction':0, 'top_values':['A', 'B', 'C', 'D', 'E']}
+    assert column_hint(stats) == "~12 values: 'A', 'B', 'C', 'D', 'E', ..."
@@ -0,0 +1,103 @@
+"""
+fit_prompt sends the whole conversation while it fits the context window, and otherwise trims it one step at a time,
+stopping as soon as it fits, and never dropping the latest question.
+"""
+import os
+import pytest
+import context_window
+from context_window import fit_prompt, count_tokens, ContextView, collapse_errors, drop_oldest_message, PromptTooLong, TRIM_STEPS
+from prompt_tools import Conversation, generate_preprompt
+from utils import QUERY_ERROR_PREFIX
+
+LFU_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db_files', 'lfu', 'lfu.duckdb')
+SYSTEM_PROMPT = 'You write DuckDB SQL queries to answer questions about the database.'
+MAX_NEW_TOKENS = 512
+ERROR = QUERY_ERROR_PREFIX + '\nCatalog Error: Table with name arcs does not exist!\nDid you mean "arc"?\nLINE 1: SELECT count(*) FROM arcs\n'
+LONG_RESULT = ' _key  n\n' + ''.join(f'{key:5d} {key % 7 + 1:3d}\n' for key in range(1, 301))
+
+
+def conversation():
+    conversation = Conversation(generate_preprompt(LFU_DB)[0])
+    conversation.add_message('user', 'How many arc heatings are there per melt?')
+    for _ in range(3): # the same mistake, again and again
+        conversation.add_message('assistant', '```sql\nSELECT count(*) FROM arcs\n```')
+        conversation.add_query_result(ERROR, ERROR)
+    conversation.add_message('assistant', '```sql\nSELECT _key, count(*) AS n FROM arc GROUP BY _key\n```')
+    conversation.add_query_result(LONG_RESULT, LONG_RESULT)
+    conversation.add_message('assistant', 'Melts have between 1 and 7 arc heatings.')
+    conversation.add_message('user', 'Which melt ran the longest?')
+    conversation.add_message('assistant', '```sql\nSELECT _key FROM arc GROUP BY _key ORDER BY max(heating_end) - min(heating_start) DESC LIMIT 1\n```')
+    conversation.add_query_result(' _key\n 2108', ' _key\n 2108')
+    return conversation
+
+def fixed_tokens():
+    return count_tokens(SYSTEM_PROMPT) + count_tokens('Assistant: ')
+
+def untrimmed_tokens(conversation):
+    return fixed_tokens() + sum(count_tokens(segment) for segment in conversation.segments)
+
+def fit(conversation, window, monkeypatch):
+    monkeypatch.setattr(context_window, 'CONTEXT_WINDOW_TOKENS', window)
+    return fit_prompt(conversation, LFU_DB, 'meta/llama-2-70b-chat', SYSTEM_PROMPT, MAX_NEW_TOKENS)
+
+
+def test_prompt_that_fits_is_sent_whole(monkeypatch):
+    c = conversation()
+    prompt, report = fit(c, untrimmed_tokens(c) + MAX_NEW_TOKENS, monkeypatch)
+    assert prompt == c.prompt()
+    assert report['trimmed'] == []
+    assert report['total'] == report['system_prompt'] + report['schema'] + report['dialogue'] + report['query_results'] + MAX_NEW_TOKENS
+    assert report['max_new_tokens'] == MAX_NEW_TOKENS
+
+def test_trimming_stops_once_it_fits(monkeypatch):
+    c = conversation()
+    view = ContextView(c, LFU_DB)
+    collapse_errors(view)
+    window = fixed_tokens() + sum(view.segment_tokens().values()) + MAX_NEW_TOKENS
+    prompt, report = fit(c, window, monkeypatch)
+    assert report['trimmed'] == ['collapsed earlier errors']
+    assert prompt.count('(The same error again.)') == 2
+    assert prompt.count('Catalog Error') == 1 and 'Did you mean' not in prompt # cut to its first line
+    assert LONG_RESULT in prompt
+    assert report['total'] <= window
+
+def test_tight_window_trims_old_results_and_schema(monkeypatch):
+    c = conversation()
+    window = untrimmed_tokens(c) + MAX_NEW_TOKENS - count_tokens(LONG_RESULT) - 500 # more than the long result has to go
+    prompt, report = fit(c, window, monkeypatch)
+    assert report['trimmed'][:3] == ['collapsed earlier errors', 'truncated earlier results', 'dropped unused tables from the schema']
+    assert 'more lines of this earlier result omitted' in prompt or 'Earlier result omitted' in prompt
+    assert 'CREATE TABLE main.arc (' in prompt and 'CREATE TABLE main.bulk (' not in prompt
+    assert 'whose columns are omitted here to save space: ' in prompt and 'main.bulk' in prompt
+    assert report['total'] <= window
+    assert c.prompt() != prompt and LONG_RESULT in c.prompt() # the conversation itself is untouched
+
+def test_oldest_messages_go_last_and_the_latest_question_stays(monkeypatch):
+    c = conversation()
+    view = ContextView(c, LFU_DB)
+    for trim in [step for _, step in TRIM_STEPS if step is not drop_oldest_message]:
+        trim(view)
+    tokens = view.segment_tokens()
+    latest_turn = sum(count_tokens(view.render_part(message)) for message in view.messages[-4:])
+    window = fixed_tokens() + tokens['schema'] + latest_turn + 20 + MAX_NEW_TOKENS # and the note on what was omitted
+    prompt, report = fit(c, window, monkeypatch)
+    assert report['trimmed'][-1] == 'dropped oldest messages'
+    assert 'earlier messages of this conversation are omitted to save space' in prompt
+    assert 'How many arc heatings' not in prompt
+    assert prompt.endswith('User: Which melt ran the longest?\n\n'
+                           'Assistant: ```sql\nSELECT _key FROM arc GROUP BY _key ORDER BY max(heating_end) - min(heating_start) DESC LIMIT 1\n```\n\n'
+                           'Query result:\n _key\n 2108\n\n')
+    assert report['total'] <= window
+
+def test_prompt_that_cant_fit_raises(monkeypatch):
+    c = conversation()
+    with pytest.raises(PromptTooLong, match="schema alone doesn't fit"):
+        fit(c, 2048, monkeypatch)
+
+def test_question_too_long_to_fit_raises(monkeypatch):
+    c = Conversation(generate_preprompt(LFU_DB)[0])
+    c.add_message('user', 'Which of these melts ran the longest? ' + ', '.join(str(key) for key in range(1, 3000)))
+    window = untrimmed_tokens(c) + MAX_NEW_TOKENS - 1000
+    with pytest.raises(PromptTooLong, match='Ask a shorter question') as e:
+        fit(c, window, monkeypatch)
+    assert e.value.prompt_tokens > e.value.budget
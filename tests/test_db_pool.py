@@ -0,0 +1,104 @@
+"""
+Sessions share one read-only connection per database file, and run their queries on a bounded number of its
+cursors at the same time. Queries past their deadline are interrupted and give their cursor back.
+"""
+import os
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import duckdb
+import pytest
+import db_manager
+from db_manager import run_with_deadline, get_pool, checkout, QueryTimeout
+
+SLOW_QUERY = 'SELECT sum(a.range * b.range) FROM range(100000000) a, range(100000) b' # minutes, unless interrupted
+
+
+@pytest.fixture(scope='module')
+def db_file(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp('pool') / 'shop.duckdb')
+    db = duckdb.connect(db_file)
+    db.execute('CREATE TABLE orders AS SELECT range AS o_id, range % 10 AS c_id FROM range(10000)')
+    db.close()
+    yield db_file
+    db_manager.close_all()
+
+class CursorCounter:
+    """Calls a query and counts how many calls are running at the same time"""
+
+    def __init__(self):
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def query(self, db, c_id):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            time.sleep(0.05) # long enough for the calls to overlap
+            return db.execute('SELECT count(*) FROM orders WHERE c_id = ?', [c_id]).fetchone()[0]
+        finally:
+            with self.lock:
+                self.running -= 1
+
+def sessions(n):
+    return ThreadPoolExecutor(max_workers=n, thread_name_prefix='session')
+
+
+def test_sessions_share_one_connection(db_file):
+    assert get_pool(db_file) is get_pool(os.path.relpath(db_file))
+
+def test_concurrent_queries_all_complete_on_a_bounded_number_of_cursors(db_file):
+    pool = get_pool(db_file)
+    counter = CursorCounter()
+    n = 3 * pool.max_cursors
+    with sessions(n) as executor:
+        results = list(executor.map(lambda i: run_with_deadline(db_file, lambda db: counter.query(db, i % 10), 10), range(n)))
+    assert results == [1000] * n
+    assert 1 < counter.most_running <= pool.max_cursors
+    assert pool._slots._value == pool.max_cursors
+    assert len(pool._idle_cursors) <= pool.max_cursors # cursors are reused, not opened per query
+
+def test_concurrent_slow_queries_are_all_interrupted(db_file):
+    pool = get_pool(db_file)
+    n = pool.max_cursors
+    timeout = 1
+    def slow_query(_):
+        start = time.monotonic()
+        with pytest.raises(QueryTimeout):
+            run_with_deadline(db_file, lambda db: db.execute(SLOW_QUERY).fetchall(), timeout)
+        return time.monotonic() - start
+    with sessions(n) as executor:
+        elapsed = list(executor.map(slow_query, range(n)))
+    assert max(elapsed) < timeout + 2 # interrupted at the deadline, not left running
+    assert pool._slots._value == pool.max_cursors
+    assert run_with_deadline(db_file, lambda db: db.execute('SELECT count(*) FROM orders').fetchone()[0], timeout) == 10000
+
+def test_fast_queries_finish_while_slow_ones_run(db_file):
+    timeout = 2
+    with sessions(4) as executor:
+        slow = [executor.submit(run_with_deadline, db_file, lambda db: db.execute(SLOW_QUERY).fetchall(), timeout) for _ in range(2)]
+        time.sleep(0.2)
+        start = time.monotonic()
+        assert run_with_deadline(db_file, lambda db: db.execute('SELECT count(*) FROM orders').fetchone()[0], timeout) == 10000
+        assert time.monotonic() - start < timeout
+        for future in slow:
+            with pytest.raises(QueryTimeout):
+                future.result()
+
+def test_query_waiting_for_a_cursor_times_out_and_never_runs(db_file):
+    pool = get_pool(db_file)
+    ran = threading.Event()
+    with contextlib.ExitStack() as cursors: # every cursor busy
+        for _ in range(pool.max_cursors):
+            cursors.enter_context(checkout(db_file))
+        with pytest.raises(TimeoutError, match='waiting for a free connection'):
+            with checkout(db_file, timeout=0.1):
+                pass
+        with pytest.raises(QueryTimeout):
+            run_with_deadline(db_file, lambda db: ran.set(), 0.2)
+    time.sleep(0.2) # the abandoned call gets the cursor now, and must give it straight back
+    assert not ran.is_set()
+    assert pool._slots._value == pool.max_cursors
@@ -0,0 +1,99 @@
+"""
+The interaction log's background writer keeps going when a record can't be written.
+"""
+import time
+import queue
+import logging
+import pytest
+import utils
+from utils import BatchingLogWriter
+
+
+class FailingFormatter(logging.Formatter):
+    """Fails on any record whose message contains 'bad'"""
+
+    def format(self, record):
+        if 'bad' in record.getMessage():
+            raise ValueError('cannot format this one')
+        return record.getMessage()
+
+
+class FailingFile:
+    """A log file whose first write fails, as on a full disk"""
+
+    def __init__(self, f):
+        self.f = f
+        self.failed = False
+
+    def write(self, text):
+        if not self.failed:
+            self.failed = True
+            raise OSError(28, 'No space left on device')
+        return self.f.write(text)
+
+    def flush(self):
+        self.f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.f.close()
+
+
+def make_record(message):
+    return logging.LogRecord('test', logging.INFO, __file__, 0, message, None, None)
+
+def start_writer(path, formatter):
+    record_queue = queue.SimpleQueue()
+    writer = BatchingLogWriter(record_queue, str(path), formatter)
+    writer.start()
+    return record_queue, writer
+
+
+def test_unformattable_record_is_skipped(tmp_path, capsys):
+    record_queue, writer = start_writer(tmp_path / 'log.log', FailingFormatter())
+    for message in ['first', 'bad', 'second']:
+        record_queue.put(make_record(message))
+    writer.stop()
+    assert (tmp_path / 'log.log').read_text(encoding='utf-8') == 'first\nsecond\n'
+    assert "Could not format interaction log record 'bad'" in capsys.readouterr().out
+
+def test_writer_keeps_draining_after_a_failed_write(tmp_path, capsys, monkeypatch):
+    failing = None
+    def open_failing(path, mode, encoding):
+        nonlocal failing
+        failing = FailingFile(open(path, mode, encoding=encoding))
+        return failing
+    monkeypatch.setattr(utils, 'open', open_failing, raising=False)
+    record_queue, writer = start_writer(tmp_path / 'log.log', FailingFormatter())
+    record_queue.put(make_record('lost'))
+    deadline = time.monotonic() + 5
+    while failing is None or not failing.failed:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    record_queue.put(make_record('kept'))
+    writer.stop()
+    assert (tmp_path / 'log.log').read_text(encoding='utf-8') == 'kept\n'
+    assert 'Could not write 1 interaction log records' in capsys.readouterr().out
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    path = str(tmp_path / 'interaction_log.log')
+    utils.configure_interaction_log(path, 'text')
+    yield path
+    utils.configure_interaction_log() # back to the app's log
+
+def test_values_like_blob_references_read_back_as_logged(log_path):
+    question = '@blobs:0123456789abcdef0123456789abcdef is what I typed'
+    prompt = 'You are a data analyst.\n\n' * 100 # long enough to be stored in the blob store
+    utils.log_llm_call('owner/model:version', {'prompt':prompt, 'system_prompt':question}, 'call', 'session')
+    utils.log_response(question, 'call', 'session')
+    utils.log_noteworthy('bad', question, 'call', 'session')
+    utils.log_writer.stop()
+    values = {record['key']:record['value'] for record in utils.read_log_records(log_path)}
+    assert values['input_prompt'] == prompt
+    assert values['input_system_prompt'] == question
+    assert values['response'] == question
+    assert values['noteworthy_example_reason'] == question
@@ -0,0 +1,109 @@
+"""
+utils.get_llm_model_version resolves each endpoint once, however many sessions ask for it at the same time,
+and a slow endpoint doesn't hold up the others.
+"""
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import utils
+from utils import get_llm_model_version
+
+WAIT = 5 # seconds, before a test gives up on a thread
+
+
+class FakeReplicate:
+    """Stands in for the replicate module: models.get(name).versions.get(id). Counts the lookups, and holds
+       them until release is set (already set by default)"""
+
+    def __init__(self, fail=()):
+        self.resolves = Counter()
+        self.started = Counter()
+        self.release = threading.Event()
+        self.release.set()
+        self.fail = set(fail)
+        self.models = self
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        client = self
+
+        class Versions:
+            def get(self, version_id):
+                endpoint = f'{name}:{version_id}'
+                with client.lock:
+                    client.started[endpoint] += 1
+                assert client.release.wait(WAIT)
+                with client.lock:
+                    client.resolves[endpoint] += 1
+                if endpoint in client.fail:
+                    raise ConnectionError(f'could not reach {endpoint}')
+                return ('version', endpoint)
+
+        model = Versions()
+        model.versions = model
+        return model
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + WAIT
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    utils.llm_model_versions.clear()
+    yield
+    utils.llm_model_versions.clear()
+
+
+def test_concurrent_sessions_resolve_once():
+    client = FakeReplicate()
+    client.release.clear()
+    with ThreadPoolExecutor(max_workers=8) as sessions:
+        futures = [sessions.submit(get_llm_model_version, 'a/llama:1', client) for _ in range(8)]
+        wait_for(lambda: client.started['a/llama:1'])
+        time.sleep(0.2) # the other sessions ask for it while it's being resolved
+        client.release.set()
+        versions = [future.result(timeout=WAIT) for future in futures]
+    assert versions == [('version', 'a/llama:1')] * 8
+    assert client.started == client.resolves == {'a/llama:1': 1}
+    assert get_llm_model_version('a/llama:1', client) == ('version', 'a/llama:1')
+    assert client.resolves == {'a/llama:1': 1}
+
+def test_each_endpoint_resolves_once():
+    client = FakeReplicate()
+    endpoints = ['a/llama:1', 'a/llama:2', 'b/codellama:1'] * 4
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as sessions:
+        versions = list(sessions.map(lambda llm: get_llm_model_version(llm, client), endpoints))
+    assert versions == [('version', llm) for llm in endpoints]
+    assert client.resolves == {'a/llama:1': 1, 'a/llama:2': 1, 'b/codellama:1': 1}
+
+def test_slow_endpoint_doesnt_hold_up_others():
+    slow = FakeReplicate()
+    slow.release.clear()
+    with ThreadPoolExecutor(max_workers=1) as session:
+        waiting = session.submit(get_llm_model_version, 'a/slow:1', slow)
+        wait_for(lambda: slow.started['a/slow:1'])
+        assert get_llm_model_version('a/fast:1', FakeReplicate()) == ('version', 'a/fast:1') # while a/slow:1 is resolving
+        assert not waiting.done()
+        slow.release.set()
+        assert waiting.result(timeout=WAIT) == ('version', 'a/slow:1')
+
+def test_expired_entry_is_resolved_again():
+    client = FakeReplicate()
+    get_llm_model_version('a/llama:1', client)
+    get_llm_model_version('a/llama:1', client, ttl=0)
+    assert client.resolves == {'a/llama:1': 2}
+
+def test_failed_resolve_is_tried_again():
+    client = FakeReplicate(fail={'a/llama:1'})
+    with pytest.raises(ConnectionError):
+        get_llm_model_version('a/llama:1', client)
+    client.fail.clear()
+    assert get_llm_model_version('a/llama:1', client) == ('version', 'a/llama:1')
+    assert client.resolves == {'a/llama:1': 2}
+    assert not utils.llm_model_version_resolves
@@ -0,0 +1,91 @@
+"""
+LogIngester loads what was appended to the interaction log since its last run, leaves a record that is still being
+written for the next one, and starts over when the log is cleared.
+"""
+import os
+import pytest
+from utils import ContentStore, prepend_uuid_on_message, log_value_is_terminated
+from log_ingest import LogIngester
+
+PROMPT = 'The database has the following tables:\n\n' + 'CREATE TABLE arc (_key BIGINT, active_power DOUBLE);\n\n' * 40
+
+
+def log_line(session_uuid, call_uuid, key, value, second=0):
+    if log_value_is_terminated(key):
+        value += f'|||end {key}|||'
+    return f'2024-01-01 12:00:{second:02d},000|INFO|' + prepend_uuid_on_message(session_uuid, call_uuid, f'{key}|{value}') + '\n'
+
+def call_lines(session_uuid, call_uuid, prompt, second=0):
+    """The records of one LLM call and the query it ran"""
+    return [log_line(session_uuid, call_uuid, key, value, second) for key, value in [
+        ('llm_name', 'meta/llama-2-70b-chat'),
+        ('llm_version', 'abc123'),
+        ('input_prompt', prompt),
+        ('input_temperature', '0.1'),
+        ('response', "Let's count them.\n```sql\nSELECT count(*) FROM arc\n```"),
+        ('next_action', 'query'),
+        ('next_action_input', 'SELECT count(*) FROM arc'),
+        ('query_result_string', ' count_star()\n 14876'),
+        ('query_result_markdown', '|   count_star() |\n|---------------:|\n|          14876 |'),
+    ]]
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / 'interaction_log.log')
+
+@pytest.fixture
+def ingester(tmp_path, log_path):
+    open(log_path, 'w').close()
+    ingester = LogIngester(str(tmp_path / 'interactions.duckdb'), log_path, batch_size=4)
+    yield ingester
+    ingester.close()
+
+def append(log_path, lines):
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(''.join(lines))
+
+def count(ingester, table):
+    return ingester.db.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+
+
+def test_rerun_only_loads_what_was_appended(ingester, log_path):
+    append(log_path, call_lines('s1', 'c1', 'Question one'))
+    assert ingester.ingest() == 9
+    assert ingester.ingest() == 0
+    append(log_path, call_lines('s1', 'c2', 'Question two', second=5))
+    assert ingester.ingest() == 9
+    assert count(ingester, 'llm_calls') == 2 and count(ingester, 'inputs') == 4 and count(ingester, 'query_results') == 2
+    assert ingester.db.execute('SELECT first_timestamp, last_timestamp FROM sessions').fetchone()[1].second == 5
+    assert ingester.db.execute("SELECT records FROM ingest_state").fetchone()[0] == 18
+
+def test_record_still_being_written_is_left_for_the_next_run(ingester, log_path):
+    lines = call_lines('s1', 'c1', 'Question one')
+    response = lines[4].split('\n')
+    append(log_path, lines[:4] + [response[0] + '\n' + response[1][:5]]) # the response has been written up to the middle of a line
+    assert ingester.ingest() == 4
+    assert count(ingester, 'responses') == 0
+    append(log_path, [response[1][5:] + '\n' + '\n'.join(response[2:])] + lines[5:])
+    assert ingester.ingest() == 5
+    assert ingester.db.execute('SELECT response FROM responses').fetchone()[0] == "Let's count them.\n```sql\nSELECT count(*) FROM arc\n```"
+
+def test_row_split_across_runs_is_merged(ingester, log_path):
+    lines = call_lines('s1', 'c1', 'Question one')
+    append(log_path, lines[:1])
+    ingester.ingest()
+    append(log_path, lines[1:])
+    ingester.ingest()
+    assert ingester.db.execute('SELECT llm_name, llm_version FROM llm_calls').fetchall() == [('meta/llama-2-70b-chat', 'abc123')]
+
+def test_cleared_log_is_loaded_from_the_start(ingester, log_path):
+    append(log_path, call_lines('s1', 'c1', 'Question one') + call_lines('s1', 'c2', 'Question two'))
+    assert ingester.ingest() == 18
+    os.remove(log_path)
+    append(log_path, call_lines('s2', 'c3', 'Question three'))
+    assert ingester.ingest() == 9
+    assert count(ingester, 'sessions') == 2 and count(ingester, 'llm_calls') == 3
+
+def test_stored_prompts_are_loaded_in_full(ingester, log_path):
+    reference = ContentStore(os.path.join(os.path.dirname(log_path), 'blobs')).store(PROMPT)
+    append(log_path, call_lines('s1', 'c1', reference))
+    ingester.ingest()
+    assert ingester.db.execute("SELECT value FROM inputs WHERE name = 'prompt'").fetchone()[0] == PROMPT
@@ -0,0 +1,94 @@
+"""
+preflight_query checks a query against a catalog-only shadow of the database, so a query that wouldn't bind is
+turned back in about a millisecond without ever reaching the query workers.
+"""
+import time
+import contextlib
+import duckdb
+import pytest
+import db_manager
+from db_manager import shadow_database, explain_query, db_file_identity
+from utils import preflight_query, start_query, QUERY_ERROR_PREFIX
+
+
+@pytest.fixture(scope='module')
+def db_file(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp('preflight') / 'shop.duckdb')
+    db = duckdb.connect(db_file)
+    db.execute('CREATE TABLE orders AS SELECT range AS o_id, (range % 97)::DOUBLE AS amount FROM range(1000)')
+    db.execute('CREATE SCHEMA archive')
+    db.execute("CREATE TABLE archive.orders AS SELECT range AS o_id, 'old' AS note FROM range(10)")
+    db.execute('CREATE VIEW big_orders AS SELECT * FROM orders WHERE amount > 50')
+    db.close()
+    yield db_file
+    db_manager.close_all()
+
+
+def test_shadow_has_the_catalog_but_no_rows(db_file):
+    shadow, database_name = shadow_database(*db_file_identity(db_file))
+    assert database_name == 'shop'
+    cursor = shadow.cursor()
+    cursor.execute('USE shop')
+    assert cursor.execute('SELECT count(*) FROM orders').fetchone() == (0,)
+    assert cursor.execute('SELECT count(*) FROM archive.orders').fetchone() == (0,)
+    assert cursor.execute('SELECT count(*) FROM big_orders').fetchone() == (0,)
+    cursor.close()
+
+@pytest.mark.parametrize('query', [
+    'SELECT o_id, amount FROM orders WHERE amount > 10',
+    'SELECT note FROM archive.orders;',
+    "WITH o AS (SELECT * FROM big_orders) SELECT count(*) FROM o WHERE ';' <> ''",
+])
+def test_query_that_binds_passes(db_file, query):
+    assert explain_query(db_file, query) is True
+    assert preflight_query(db_file, query) is None
+
+@pytest.mark.parametrize('query, error', [
+    ('SELECT o_id, price FROM orders', 'Binder Error'),
+    ('SELECT * FROM customers', 'Catalog Error'),
+    ('SELECT * FROM orders WHERE', 'Parser Error'),
+    ('SELECT note FROM orders', 'Binder Error'), # note is a column of archive.orders
+])
+def test_query_that_wouldnt_run_fails(db_file, query, error):
+    with pytest.raises(duckdb.Error, match=error):
+        explain_query(db_file, query)
+    string_out, md_out = preflight_query(db_file, query)
+    assert string_out.startswith(QUERY_ERROR_PREFIX) and error in string_out
+
+@pytest.mark.parametrize('query', ["PRAGMA table_info('orders')", 'SHOW TABLES', 'SELECT 1; SELECT 2'])
+def test_statement_explain_cant_plan_isnt_checked(db_file, query):
+    assert explain_query(db_file, query) is False
+    assert preflight_query(db_file, query) is None
+
+def test_check_doesnt_wait_for_a_cursor(db_file):
+    shadow_database(*db_file_identity(db_file)) # built once, on a cursor of the real database
+    with contextlib.ExitStack() as cursors: # every cursor busy running queries
+        for _ in range(db_manager.get_pool(db_file).max_cursors):
+            cursors.enter_context(db_manager.checkout(db_file))
+        start = time.monotonic()
+        assert preflight_query(db_file, 'SELECT price FROM orders') is not None
+        assert time.monotonic() - start < 1
+
+def test_failing_query_is_never_started(db_file, monkeypatch):
+    started = []
+    monkeypatch.setattr('utils.query_manager', lambda *args: started.append(args))
+    future = start_query(db_file, 'SELECT price FROM orders')
+    assert future.done() and future.result()[0].startswith(QUERY_ERROR_PREFIX)
+    assert started == []
+
+def test_passing_query_is_run(db_file):
+    string_out, _ = start_query(db_file, 'SELECT count(*) AS n FROM big_orders').result(timeout=10)
+    assert '460' in string_out
+
+def test_shadow_follows_changes_to_the_file(tmp_path):
+    db_file = str(tmp_path / 'growing.duckdb')
+    db = duckdb.connect(db_file)
+    db.execute('CREATE TABLE a AS SELECT 1 AS x')
+    db.close()
+    assert preflight_query(db_file, 'SELECT * FROM b') is not None
+    db_manager.close_all()
+    db = duckdb.connect(db_file)
+    db.execute('CREATE TABLE b AS SELECT 2 AS y')
+    db.close()
+    assert preflight_query(db_file, 'SELECT y FROM b') is None
+    db_manager.close_all()
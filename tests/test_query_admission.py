@@ -0,0 +1,106 @@
+"""
+query_admission checks the plan of each query against the cost limits, lowered here to fit a small database.
+"""
+import time
+import contextlib
+import duckdb
+import pytest
+import db_manager
+from db_manager import run_with_deadline
+import query_admission
+from query_admission import admit_query
+
+MAX_SCAN_ROWS = 10000
+
+
+@pytest.fixture(scope='module')
+def db_file(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp('admission') / 'shop.duckdb')
+    db = duckdb.connect(db_file)
+    db.execute("CREATE TABLE customers AS SELECT range AS c_id, 'customer ' || range AS name FROM range(1000)")
+    db.execute('CREATE TABLE orders AS SELECT range AS o_id, range % 1000 AS c_id, (range % 97)::DOUBLE AS amount FROM range(200000)')
+    db.execute('CREATE TABLE payments AS SELECT range AS p_id, range % 200000 AS o_id, 1.0 AS paid FROM range(150000)')
+    db.close()
+    return db_file
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(query_admission, 'ADMISSION_MAX_SCAN_ROWS', MAX_SCAN_ROWS)
+    monkeypatch.setattr(query_admission, 'ADMISSION_MAX_RESULT_ROWS', 50000)
+    monkeypatch.setattr(query_admission, 'ADMISSION_MAX_CROSS_PRODUCT_ROWS', 1e8)
+    query_admission.admission.cache_clear() # admissions are cached under the limits they were made with
+    yield
+    query_admission.admission.cache_clear()
+
+
+def test_join_samples_only_the_large_table(db_file):
+    admission = admit_query(db_file, 'SELECT c.name, sum(o.amount) FROM orders o JOIN customers c ON o.c_id = c.c_id GROUP BY 1')
+    assert not admission.rejected
+    assert admission.query.count('TABLESAMPLE') == 1
+    assert 'orders AS o TABLESAMPLE SYSTEM (5.0 PERCENT)' in admission.query
+    assert len(admission.notices) == 1 # one scale-up factor for the whole result
+    assert 'orders has about 200,000 rows' in admission.notices[0] and 'about 5% of their full values' in admission.notices[0]
+
+def test_join_of_two_large_tables_is_rejected(db_file):
+    # independent samples of both sides would keep about 5% x 6.7% of the matching pairs, not what either notice would say
+    admission = admit_query(db_file, 'SELECT count(*) FROM orders o JOIN payments p ON o.o_id = p.o_id')
+    assert admission.reason == 'rows_scanned'
+    assert admission.details['tables'] == 'orders (200,000 rows); payments (150,000 rows)'
+
+def test_self_join_of_a_large_table_is_rejected(db_file):
+    admission = admit_query(db_file, 'SELECT count(*) FROM orders a JOIN orders b ON a.o_id = b.o_id')
+    assert admission.reason == 'rows_scanned'
+
+def test_query_is_admitted_unchecked_when_it_cant_be_planned_in_time(db_file, monkeypatch):
+    monkeypatch.setattr(query_admission, 'ADMISSION_PLAN_TIMEOUT', 0.2)
+    pool = db_manager.get_pool(db_file)
+    with contextlib.ExitStack() as cursors: # every cursor busy, so EXPLAIN can't get one
+        for _ in range(pool.max_cursors):
+            cursors.enter_context(db_manager.checkout(db_file))
+        start = time.monotonic()
+        admission = admit_query(db_file, 'SELECT * FROM orders')
+        assert time.monotonic() - start < 1
+    assert not admission.rejected and admission.query == 'SELECT * FROM orders'
+    assert admit_query(db_file, 'SELECT * FROM orders').reason == 'rows_scanned' # the timeout wasn't cached
+
+def test_aggregate_over_a_large_table_reads_a_sample(db_file):
+    admission = admit_query(db_file, 'SELECT c_id, sum(amount) AS total FROM orders GROUP BY c_id')
+    assert not admission.rejected
+    assert admission.query == 'SELECT c_id, SUM(amount) AS total FROM orders TABLESAMPLE SYSTEM (5.0 PERCENT) GROUP BY c_id'
+    assert admission.notices == ['Note: orders has about 200,000 rows, so this result was computed on a 5% sample of them '
+                                 '(TABLESAMPLE SYSTEM), and all the rows of any other table. Counts and sums are about 5% of their '
+                                 'full values, and averages, minimums and maximums are estimates.']
+    assert run_with_deadline(db_file, lambda db: db.execute(admission.query).fetchall()) # and it runs
+
+def test_large_result_gets_a_limit(db_file):
+    admission = admit_query(db_file, 'SELECT * FROM customers a, customers b') # a million rows
+    assert not admission.rejected
+    assert admission.limit == 50000 and admission.query.endswith('LIMIT 50000')
+    assert admission.result_notices(50000)[0].startswith('Note: the query was estimated to return about 1,000,000 rows')
+    assert admission.result_notices(10) == [] # the LIMIT wasn't reached, so there's nothing missing
+
+def test_query_within_the_limits_is_unchanged(db_file):
+    query = 'SELECT c.name, count(*) AS n FROM customers c JOIN customers d ON c.c_id = d.c_id GROUP BY 1'
+    admission = admit_query(db_file, query)
+    assert admission.query is query and not admission.notices and admission.limit is None
+
+@pytest.mark.parametrize('query, reason', [
+    ('SELECT count(*) FROM orders, payments', 'cross_product'),
+    ('SELECT count(*) FROM orders o JOIN payments p ON o.amount < p.paid', 'join_rows'),
+    ('SELECT * FROM orders', 'rows_scanned'), # too large to read whole, and can't be sampled as it doesn't aggregate
+], ids=['cross product', 'range join', 'whole large table'])
+def test_over_budget_query_is_rejected(db_file, query, reason):
+    admission = admit_query(db_file, query)
+    assert admission.reason == reason
+    assert admission.query is query
+    assert admission.details['reason'] == reason and admission.details['suggestion']
+
+@pytest.mark.parametrize('query', [
+    "PRAGMA table_info('orders')",
+    'SHOW TABLES',
+    'DESCRIBE orders',
+    'SELECT * FROM orders; SELECT * FROM payments',
+])
+def test_statement_explain_cant_plan_is_admitted_as_it_is(db_file, query):
+    admission = admit_query(db_file, query)
+    assert not admission.rejected and admission.query is query
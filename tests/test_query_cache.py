@@ -0,0 +1,65 @@
+"""
+query_result_cache shares query results between sessions under the query's canonical SQL and the identity of the
+database file, so a result is reused for trivially different SQL but never outlives a change to the file.
+"""
+import duckdb
+import pytest
+import db_manager
+from query_cache import QueryResultCache, query_result_cache
+from utils import query_manager
+
+
+def write_database(db_file, rows):
+    db_manager.close_all() # the pool holds the file open read-only
+    db = duckdb.connect(db_file)
+    db.execute('CREATE OR REPLACE TABLE items AS SELECT range AS id FROM range(?)', [rows])
+    db.close()
+
+@pytest.fixture
+def db_file(tmp_path):
+    db_file = str(tmp_path / 'items.duckdb')
+    write_database(db_file, 3)
+    query_result_cache.clear()
+    yield db_file
+    query_result_cache.clear()
+    db_manager.close_all()
+
+
+def test_trivially_different_queries_share_a_key(db_file):
+    key = QueryResultCache.key(db_file, 'SELECT count(*) FROM items')
+    assert QueryResultCache.key(db_file, '  select COUNT(*)\n  from items;') == key
+    assert QueryResultCache.key(db_file, 'SELECT count(*) FROM items WHERE id > 1') != key
+
+@pytest.mark.parametrize('query', ['SELECT random() FROM items', 'SELECT now()', 'SELECT * FROM items USING SAMPLE 1'])
+def test_nondeterministic_query_isnt_cached(db_file, query):
+    assert QueryResultCache.key(db_file, query) is None
+
+def test_key_changes_when_the_database_file_does(db_file):
+    key = QueryResultCache.key(db_file, 'SELECT count(*) FROM items')
+    write_database(db_file, 5)
+    assert QueryResultCache.key(db_file, 'SELECT count(*) FROM items') != key
+
+def test_result_is_reused_until_the_database_file_changes(db_file):
+    hits = query_result_cache.stats()['hits']
+    first = query_manager(db_file, 'SELECT count(*) AS n FROM items')
+    assert '3' in first[0]
+    assert query_manager(db_file, 'select count(*) as n from items;') == first
+    assert query_result_cache.stats()['hits'] == hits + 1
+    write_database(db_file, 5)
+    assert '5' in query_manager(db_file, 'SELECT count(*) AS n FROM items')[0]
+    assert query_result_cache.stats()['hits'] == hits + 1
+
+def test_errors_arent_cached(db_file):
+    query_manager(db_file, 'SELECT * FROM no_such_table')
+    assert query_result_cache.stats()['entries'] == 0
+
+def test_least_recently_used_results_are_evicted_first():
+    cache = QueryResultCache(max_bytes=10)
+    cache.put('a', ('aaa', 'a'))
+    cache.put('b', ('bbb', 'b'))
+    assert cache.get('a') == ('aaa', 'a') # now b is the least recently used
+    cache.put('c', ('ccc', 'c'))
+    assert cache.get('b') is None and cache.get('a') is not None and cache.get('c') is not None
+    assert cache.stats()['bytes'] == 8
+    cache.put('d', ('x' * 11, '')) # larger than the whole cache
+    assert cache.get('d') is None
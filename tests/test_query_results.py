@@ -0,0 +1,50 @@
+"""
+Query results are streamed, keeping only the rows that get displayed: the first QUERY_RESULT_MAX_ROWS and the last
+QUERY_RESULT_END_ROWS. However many rows a query returns, the memory it takes stays bounded.
+"""
+import tracemalloc
+import duckdb
+import pytest
+from utils import fetch_head_and_tail, format_query_result, QUERY_RESULT_MAX_ROWS, QUERY_RESULT_END_ROWS
+
+WIDE_ROWS = "SELECT range AS id, repeat('x', 100) || range AS text FROM range({rows})" # about 150 bytes a row in pandas
+
+
+@pytest.fixture
+def db():
+    db = duckdb.connect()
+    yield db
+    db.close()
+
+
+@pytest.mark.parametrize('rows', [0, 1, QUERY_RESULT_MAX_ROWS])
+def test_small_result_is_kept_whole(db, rows):
+    df, row_count = fetch_head_and_tail(db, f'SELECT range AS id FROM range({rows})')
+    assert row_count == rows
+    assert list(df['id']) == list(range(rows))
+    assert list(df.columns) == ['id'] # even without any rows
+
+@pytest.mark.parametrize('rows', [QUERY_RESULT_MAX_ROWS + 1, 2048 * 8 + 5, 100000])
+def test_large_result_keeps_its_head_and_tail(db, rows):
+    df, row_count = fetch_head_and_tail(db, f'SELECT range AS id FROM range({rows})')
+    assert row_count == rows
+    assert df.shape[0] == QUERY_RESULT_MAX_ROWS + 1 + QUERY_RESULT_END_ROWS
+    assert list(df['id']) == list(range(QUERY_RESULT_MAX_ROWS + 1)) + list(range(rows - QUERY_RESULT_END_ROWS, rows))
+
+def test_memory_stays_bounded_by_what_is_displayed(db):
+    tracemalloc.start()
+    try:
+        df, row_count = fetch_head_and_tail(db, WIDE_ROWS.format(rows=1000000))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert row_count == 1000000 and df.shape[0] == QUERY_RESULT_MAX_ROWS + 1 + QUERY_RESULT_END_ROWS
+    assert peak < 50 * 1024 * 1024 # all of it would take about 200 MB, a few fetched vectors under 10 MB
+
+def test_truncated_result_is_shown_with_its_row_count(db):
+    string_out, md_out = format_query_result(*fetch_head_and_tail(db, 'SELECT range AS id FROM range(1000)'))
+    assert '(1000 rows)' in string_out and '(1000 rows)' in md_out
+    assert '| ... |' in md_out
+    lines = md_out.splitlines()
+    assert lines[2].strip('| ') == '0' and '999' in md_out
+    assert sum(line.startswith('|') for line in lines) == 2 + QUERY_RESULT_END_ROWS * 2 + 1 # header, separator, rows and the gap
@@ -0,0 +1,66 @@
+"""
+query_rewriter routes aggregates on the LFU tables to the summary tables built with them, giving the same rows as
+the query as written, and leaves every query it can't route exactly as it was.
+"""
+import os
+import math
+import duckdb
+import pytest
+from db_manager import run_with_deadline
+from query_rewriter import route_query
+
+LFU_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db_files', 'lfu', 'lfu.duckdb') # small, and has the summary tables
+
+ROUTABLE = {
+    'per melt': 'SELECT _key, count(*) AS n, sum(active_power) AS power, count(DISTINCT heating_start) AS cycles '
+                'FROM arc GROUP BY _key ORDER BY _key',
+    'per melt, filtered on the key': 'SELECT _key, avg(temperature) AS t, max(_time) AS last FROM temp_FULL_with_test '
+                                     'WHERE _key < 100 GROUP BY _key ORDER BY _key',
+    'per day': "SELECT date_trunc('day', _time) AS day, avg(temperature) AS t, count(*) AS n FROM temp_FULL_with_test GROUP BY 1 ORDER BY 1",
+    'per month, ordered by an aggregate': "SELECT date_trunc('month', heating_start) AS month, sum(active_power) AS power FROM arc "
+                                          'GROUP BY 1 ORDER BY sum(active_power) DESC',
+    'in a CTE': 'WITH per_melt AS (SELECT _key, count(*) AS n FROM arc GROUP BY _key) SELECT avg(n) AS mean_arcs FROM per_melt',
+}
+
+UNROUTABLE = {
+    'join': 'SELECT a._key, count(*) AS n FROM arc a JOIN temp_FULL_with_test t ON a._key = t._key GROUP BY a._key',
+    'filter on another column': 'SELECT _key, count(*) AS n FROM arc WHERE active_power > 1 GROUP BY _key',
+    'having': 'SELECT _key, count(*) AS n FROM arc GROUP BY _key HAVING count(*) > 3',
+    'finer than an hour': "SELECT date_trunc('minute', _time) AS minute, count(*) AS n FROM temp_FULL_with_test GROUP BY 1",
+    'aggregate not precomputed': 'SELECT _key, median(active_power) AS p FROM arc GROUP BY _key',
+    'aggregate without an alias': 'SELECT _key, count(*) FROM arc GROUP BY _key',
+    'alias shadowing a column': "SELECT date_trunc('day', _time) AS _time, count(*) AS n FROM temp_FULL_with_test GROUP BY _time",
+    'no aggregate': 'SELECT * FROM arc LIMIT 5',
+    'not a SELECT': "PRAGMA table_info('arc')",
+    'several statements': 'SELECT _key, count(*) AS n FROM arc GROUP BY _key; SELECT 1',
+    'not valid SQL': 'SELEKT _key FROM arc',
+}
+
+
+def fetch(query):
+    return run_with_deadline(LFU_DB, lambda db: db.execute(query).fetchall())
+
+def same_rows(a, b):
+    return len(a) == len(b) and all(len(x) == len(y) and all(
+        math.isclose(u, v, rel_tol=1e-9) if isinstance(u, float) and isinstance(v, float) else u == v for u, v in zip(x, y))
+        for x, y in zip(a, b))
+
+
+@pytest.mark.parametrize('query', ROUTABLE.values(), ids=ROUTABLE.keys())
+def test_routed_query_returns_the_same_rows(query):
+    routed = route_query(LFU_DB, query)
+    assert routed != query
+    assert 'melt_features' in routed or '_hourly' in routed
+    assert same_rows(fetch(routed), fetch(query))
+
+@pytest.mark.parametrize('query', UNROUTABLE.values(), ids=UNROUTABLE.keys())
+def test_unroutable_query_is_untouched(query):
+    assert route_query(LFU_DB, query) is query
+
+def test_database_without_summary_tables_is_untouched(tmp_path):
+    db_file = str(tmp_path / 'other.duckdb')
+    db = duckdb.connect(db_file)
+    db.execute('CREATE TABLE arc AS SELECT range % 10 AS _key, 1.0 AS active_power FROM range(100)')
+    db.close()
+    query = 'SELECT _key, count(*) AS n FROM arc GROUP BY _key'
+    assert route_query(db_file, query) is query
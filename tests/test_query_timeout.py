@@ -0,0 +1,41 @@
+"""
+Pathological queries run through db_manager.run_with_deadline are cancelled at the deadline, and give their
+cursor back to the pool.
+"""
+import time
+import duckdb
+import pytest
+import db_manager
+from db_manager import run_with_deadline, get_pool, QueryTimeout
+
+TIMEOUT = 1 # seconds
+CARTESIAN_QUERY = 'SELECT sum(a.l_extendedprice * b.l_quantity) FROM lineitem a, lineitem b' # 60k x 60k rows at SF 0.01
+
+
+@pytest.fixture(scope='module')
+def tpch_file(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp('tpch') / 'tpch.duckdb')
+    db = duckdb.connect(db_file)
+    db.sql('LOAD tpch') # built into the Python package, so nothing is downloaded
+    db.sql('CALL dbgen(sf=0.01)')
+    db.close()
+    yield db_file
+    db_manager.close_all()
+
+
+def test_cartesian_join_is_cancelled(tpch_file):
+    start = time.monotonic()
+    with pytest.raises(QueryTimeout):
+        run_with_deadline(tpch_file, lambda db: db.execute(CARTESIAN_QUERY).fetchall(), TIMEOUT)
+    assert time.monotonic() - start < TIMEOUT + 1 # interrupted, not left to finish
+    pool = get_pool(tpch_file)
+    assert pool._slots._value == pool.max_cursors # the cursor was checked back in
+    assert run_with_deadline(tpch_file, lambda db: db.execute('SELECT count(*) FROM nation').fetchall(), TIMEOUT) == [(25,)]
+
+def test_cancelled_queries_dont_use_up_the_pool(tpch_file):
+    pool = get_pool(tpch_file)
+    for _ in range(pool.max_cursors + 1): # more than would fit, if each one kept its cursor
+        with pytest.raises(QueryTimeout):
+            run_with_deadline(tpch_file, lambda db: db.execute(CARTESIAN_QUERY).fetchall(), TIMEOUT / 4)
+    assert pool._slots._value == pool.max_cursors
+    assert len(pool._idle_cursors) <= pool.max_cursors
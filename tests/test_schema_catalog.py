@@ -0,0 +1,94 @@
+"""
+select_tables picks the tables of a wide database that a conversation's questions are about, and the joins that
+connect them. The catalog it ranks them with is built once per database file.
+"""
+import os
+import duckdb
+import pytest
+import db_manager
+import schema_catalog
+from schema_catalog import words, infer_joins, select_tables, get_catalog, catalog_path
+
+TABLES = {
+    'region':"SELECT range AS r_regionkey, (['EUROPE', 'ASIA', 'AMERICA'])[range + 1] AS r_name FROM range(3)",
+    'nation':"SELECT range AS n_nationkey, 'nation ' || range AS n_name, range % 3 AS n_regionkey FROM range(25)",
+    'customer':"SELECT range AS c_custkey, 'Customer#' || range AS c_name, range % 25 AS c_nationkey, "
+               "(['BUILDING', 'MACHINERY', 'AUTOMOBILE'])[range % 3 + 1] AS c_mktsegment FROM range(300)",
+    'orders':"SELECT range AS o_orderkey, range % 300 AS o_custkey, (range % 1000)::DOUBLE AS o_totalprice FROM range(3000)",
+    'lineitem':"SELECT range % 3000 AS l_orderkey, range % 200 AS l_partkey, range % 50 + 1 AS l_quantity FROM range(12000)",
+    'part':"SELECT range AS p_partkey, 'part ' || range AS p_name, (['brass', 'steel', 'tin'])[range % 3 + 1] AS p_type FROM range(200)",
+    'supplier':"SELECT range AS s_suppkey, 'Supplier#' || range AS s_name, range % 25 AS s_nationkey FROM range(20)",
+    'Competitions':"SELECT 'Comp' || range AS id, 'Open ' || range AS cityName FROM range(10)",
+    'Persons':"SELECT '2010ABCD' || range AS id, 'Person ' || range AS name FROM range(10)",
+    'Results':"SELECT 'Comp' || (range % 10) AS competitionId, '2010ABCD' || (range % 10) AS personId, range AS best FROM range(100)",
+    'Events':"SELECT (['333', '444'])[range + 1] AS id, (['3x3x3 Cube', '4x4x4 Cube'])[range + 1] AS name FROM range(2)",
+}
+
+
+@pytest.fixture(scope='module')
+def db_file(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp('catalog') / 'shop.duckdb')
+    db = duckdb.connect(db_file)
+    for name, query in TABLES.items():
+        db.execute(f'CREATE TABLE "{name}" AS {query}')
+    db.close()
+    yield db_file
+    db_manager.close_all()
+
+
+def test_words_are_split_and_stemmed():
+    assert words('Which countries had the most competitionResults?') == ['country', 'competition', 'result']
+    assert words('c_mktsegment of the people') == ['c', 'mktsegment', 'person']
+
+def test_joins_are_inferred_from_column_names():
+    tables = {name:{'columns':columns} for name, columns in [
+        ('main.orders', ['o_orderkey', 'o_custkey']), ('main.customer', ['c_custkey', 'c_name']),
+        ('main.Results', ['competitionId', 'best']), ('main.Competitions', ['id', 'cityName']),
+        ('main.arc', ['_key', 'active_power']), ('main.temp', ['_key', 'temperature'])]}
+    assert infer_joins(tables) == [['main.orders', 'o_custkey', 'main.customer', 'c_custkey'],
+                                   ['main.Results', 'competitionId', 'main.Competitions', 'id'],
+                                   ['main.arc', '_key', 'main.temp', '_key']]
+
+def test_tables_matching_the_question_are_selected_with_their_joins(db_file):
+    tables, joins = select_tables(db_file, ['What is the total price of the orders of each customer?'])
+    assert 'main.orders' in tables and 'main.customer' in tables
+    assert ['main.customer', 'c_custkey', 'main.orders', 'o_custkey'] in joins
+    assert tables == [name for name in get_catalog(db_file)['tables'] if name in tables] # in catalog order
+    assert 'main.Competitions' not in tables
+
+def test_tables_are_joined_through_other_tables(db_file):
+    tables, joins = select_tables(db_file, ['Which customer segment bought the most brass parts?'], top_k=2)
+    assert {'main.customer', 'main.part'} <= set(tables)
+    assert {'main.orders', 'main.lineitem'} <= set(tables) # the only way from a customer to a part
+    assert len(joins) == 3
+
+def test_sample_values_match_questions(db_file):
+    tables, _ = select_tables(db_file, ['How many MACHINERY customers are there?'], top_k=1)
+    assert tables == ['main.customer']
+
+def test_tables_stay_selected_for_the_rest_of_the_conversation(db_file):
+    first, _ = select_tables(db_file, ['Which suppliers are there?'], top_k=1)
+    tables, _ = select_tables(db_file, ['Which suppliers are there?', 'List the competitions and their city names'], top_k=1)
+    assert first == ['main.supplier']
+    assert set(tables) == {'main.supplier', 'main.Competitions'}
+
+def test_unmatched_question_gets_the_whole_schema(db_file):
+    assert select_tables(db_file, ['Hello there!']) is None
+
+def test_small_database_gets_the_whole_schema(db_file, monkeypatch):
+    monkeypatch.setattr(schema_catalog, 'SCHEMA_RETRIEVAL_MIN_TABLES', len(TABLES) + 1)
+    assert select_tables(db_file, ['What is the total price of the orders of each customer?']) is None
+
+def test_catalog_is_saved_and_rebuilt_when_the_file_changes(tmp_path):
+    db_file = str(tmp_path / 'small.duckdb')
+    db = duckdb.connect(db_file)
+    db.execute("CREATE TABLE persons AS SELECT 1 AS id, 'Ann' AS name")
+    db.close()
+    assert list(get_catalog(db_file)['tables']) == ['main.persons']
+    assert os.path.exists(catalog_path(db_file))
+    db_manager.close_all()
+    db = duckdb.connect(db_file)
+    db.execute("CREATE TABLE events AS SELECT '333' AS id")
+    db.close()
+    assert list(get_catalog(db_file)['tables']) == ['main.events', 'main.persons']
+    db_manager.close_all()
@@ -1,7 +1,15 @@
 import replicate
 import time
 import re
+import os
+import threading
 from traceback import format_exc
+from db_manager import run_with_deadline, explain_query, QueryTimeout, QUERY_TIMEOUT
+from concurrent.futures import Future, ThreadPoolExecutor
+from query_cache import query_result_cache
+from query_rewriter import route_query
+from query_admission import admit_query
+import pandas as pd
 
 # Initialize debounce variables
 last_call_time = 0
@@ -29,12 +37,70 @@ def debounce_replicate_run(llm, prompt, max_len, temperature, top_p, system_prom
     output = replicate.run(llm, input={"prompt": prompt, "system_prompt":system_prompt, "max_length": max_len, "temperature": temperature, "top_p": top_p, "repetition_penalty": 1}, api_token=API_TOKEN)
     return output
 
-def get_llm_model_version(llm):
+# Resolved model versions, shared by every Streamlit session in this process.
+# Keyed by the "owner/model:version" endpoint string, each entry is (version object, time resolved)
+llm_model_versions = {}
+llm_model_version_resolves = {} # endpoint: Future of the version, while it's being resolved
+llm_model_versions_lock = threading.Lock() # guards both dicts, never held over a network call
+LLM_MODEL_VERSION_TTL = float(os.environ.get('LLM_MODEL_VERSION_TTL', default=3600)) # seconds
+
+def resolve_llm_model_version(llm,client=replicate):
+    """Look up the version object for an endpoint string. This is a network round trip to Replicate"""
     llm_parts = llm.split(':')
-    model = replicate.models.get(llm_parts[0])
+    model = client.models.get(llm_parts[0])
     version = model.versions.get(llm_parts[1])
     return version
 
+def get_llm_model_version(llm,client=replicate,ttl=None):
+    """Return the version object for an endpoint string, only going to Replicate the first time
+       a given endpoint is asked for (or once its cache entry is older than ttl seconds).
+       Sessions asking for an endpoint that's being resolved wait for that, rather than resolving it again.
+       Other endpoints aren't held up"""
+    ttl = LLM_MODEL_VERSION_TTL if ttl is None else ttl
+    cached = llm_model_versions.get(llm)
+    if cached is not None and time.time() - cached[1] < ttl:
+        return cached[0]
+    with llm_model_versions_lock:
+        cached = llm_model_versions.get(llm) # in case a resolve finished since
+        if cached is not None and time.time() - cached[1] < ttl:
+            return cached[0]
+        future = llm_model_version_resolves.get(llm)
+        resolving = future is None
+        if resolving:
+            future = Future()
+            llm_model_version_resolves[llm] = future
+    if not resolving:
+        return future.result()
+    try:
+        version = resolve_llm_model_version(llm,client)
+    except Exception as e:
+        with llm_model_versions_lock:
+            del llm_model_version_resolves[llm] # the next call tries again
+        future.set_exception(e)
+        raise
+    with llm_model_versions_lock:
+        llm_model_versions[llm] = (version, time.time())
+        del llm_model_version_resolves[llm]
+    future.set_result(version)
+    return version
+
+def preload_llm_model_versions(llms,client=replicate):
+    """Resolve a list of endpoints up front, so the first prediction for each doesn't pay for it.
+       Failures are printed and skipped - get_llm_model_version will try again when the model is used"""
+    for llm in llms:
+        if not llm:
+            continue
+        try:
+            get_llm_model_version(llm,client)
+        except Exception as e:
+            print(f'Could not resolve model version for {llm}: {e}')
+
+# compiled once at import, rather than on every streamed token
+QUERY_SEMICOLON_RE = re.compile('Query:(.+);',re.IGNORECASE | re.DOTALL) #dotall needed in case query is multiline
+QUERY_BACKTICKS_RE = re.compile(r'Query:\n?```(.*)```',re.IGNORECASE | re.DOTALL)
+HALLUCINATED_USER_RE = re.compile('(?<!Ask )User:',re.IGNORECASE)
+END_FLAG_RE = re.compile('/End',re.IGNORECASE)
+
 def check_for_stop_conditions(output):
     """Check for conditions that mean we got the output we wanted, and
        we can stop the model run. 
@@ -42,6 +108,9 @@ def check_for_stop_conditions(output):
        If stop condition found, return the index at which to cutoff the output text.
 
        If no stop condition met, return None
+
+       This re-scans the whole output on every call. While streaming, use StopConditionScanner,
+       which gives the same answer but only looks at each new chunk.
        """
     
     stop_index = None
@@ -50,22 +119,25 @@ def check_for_stop_conditions(output):
     # check if we have created a complete SQL query
     # Llama2-70B appears to always put a ; at the end
     # TODO - handle case where valid semicolon is part of query
-    if re.search('Query:(.+);',output,re.IGNORECASE | re.DOTALL): #dotall needed in case query is multiline
+    match = QUERY_SEMICOLON_RE.search(output)
+    if match:
         print('Complete SQL query detected. Stopping prediction...')
-        stop_index = re.search('Query:(.+);',output,re.IGNORECASE | re.DOTALL).end()
+        stop_index = match.end()
         return stop_index
     # check for query where the LLM does not use a semicolon to end the query.
     # the system prompt calls for triple backticks, so fall back on that
     # We expect to see Query: then maybe a newline, an opening set of 3 backticks, then a closing set
-    if re.search(r'Query:\n?```(.*)```',output,re.IGNORECASE | re.DOTALL): #dotall needed in case query is multiline
+    match = QUERY_BACKTICKS_RE.search(output)
+    if match:
         print('Complete SQL query detected. Stopping prediction...')
-        stop_index = re.search(r'Query:\n?```(.*)```',output,re.IGNORECASE | re.DOTALL).end()
+        stop_index = match.end()
         return stop_index
 
     # if the llm starts hallucinating, it may print "User:" as the beginning of the hallucinated phase of conversation
-    if re.search(r'(?<!Ask )User:',output,re.IGNORECASE):
+    match = HALLUCINATED_USER_RE.search(output)
+    if match:
         print('Hallucination detected. Stopping prediction...')
-        stop_index = re.search('(?<!Ask )User:',output,re.IGNORECASE).start()
+        stop_index = match.start()
         return stop_index
 
     
@@ -73,13 +145,128 @@ def check_for_stop_conditions(output):
     # keep this one last so that one of the more specialized conditions above can be triggered if
     # there is small additional output between one of those conditions ocurring and the final /End,
     # such that they both are satisfied within the same batch of tokens
-    if re.search('/End',output,re.IGNORECASE):
+    match = END_FLAG_RE.search(output)
+    if match:
         print('"/End" detected. Stopping prediction...')
-        stop_index = re.search('/End',output,re.IGNORECASE).start()
+        stop_index = match.start()
         return stop_index
     
     return stop_index
 
+class StopConditionScanner:
+    """Incremental version of check_for_stop_conditions, for use inside the streaming loop.
+
+       Call feed() with each new chunk of model output. It returns the same stop index that
+       check_for_stop_conditions would return for all of the text fed so far (or None), but it only
+       scans the new chunk plus a few carried-over characters, so the cost per token stays flat
+       instead of growing with the length of the response.
+
+       Only the scan state is kept - positions of the keywords, semicolons and backticks that the
+       stop conditions depend on - not the text itself.
+       """
+
+    # enough trailing characters to catch a keyword split across chunks, plus the 4 characters
+    # of lookbehind needed for "Ask User:" and the 4 characters of lookahead needed after "Query:"
+    tail_length = 16
+
+    def __init__(self):
+        self.length = 0 # number of characters fed so far
+        self._tail = '' # lower-cased end of the text fed so far
+        self._first_query_end = None # end of the first "Query:"
+        self._pending_query_ends = [] # ends of "Query:" where we can't yet tell if a ``` block follows
+        self._block_open_end = None # end of the opening ``` of the first "Query:\n?```"
+        self._last_semicolon = None
+        self._last_backticks = None # start of the last ```
+        self._user_start = None # start of the first "User:" not preceded by "Ask "
+        self._end_flag_start = None # start of the first "/End"
+
+    @staticmethod
+    def _lower(chunk):
+        lowered = chunk.lower()
+        if len(lowered) != len(chunk):
+            # a few unicode characters change length when lower-cased, which would throw off our offsets.
+            # none of them are part of the keywords, so just leave those ones alone
+            lowered = ''.join(c if len(c.lower()) != 1 else c.lower() for c in chunk)
+        return lowered
+
+    @staticmethod
+    def _find_all(window, keyword, start):
+        i = window.find(keyword, start)
+        while i != -1:
+            yield i
+            i = window.find(keyword, i + 1)
+
+    def feed(self, chunk):
+        """Scan the next chunk of output. Return the stop index, or None if no stop condition is met"""
+        window = self._tail + self._lower(chunk)
+        offset = self.length - len(self._tail) # position of window[0] in the full output
+        new_start = len(self._tail) # position in window where the new chunk begins
+        self.length += len(chunk)
+
+        # only look at keyword matches that include at least one new character - the rest were seen last time
+        for i in self._find_all(window, 'query:', max(0, new_start - 5)):
+            if self._first_query_end is None:
+                self._first_query_end = offset + i + 6
+            if self._block_open_end is None:
+                self._pending_query_ends.append(offset + i + 6)
+
+        # "Query:" followed by an opening ```, with or without a newline in between.
+        # The earliest one that qualifies is where the regex in check_for_stop_conditions would match
+        while self._pending_query_ends and self._block_open_end is None:
+            query_end = self._pending_query_ends[0]
+            following = window[query_end - offset:query_end - offset + 4]
+            if following.startswith('```'):
+                self._block_open_end = query_end + 3
+            elif following == '\n```':
+                self._block_open_end = query_end + 4
+            elif len(following) < 4 and ('```'.startswith(following) or '\n```'.startswith(following)):
+                break # could still become an opening block once more output arrives
+            else:
+                self._pending_query_ends.pop(0)
+        if self._block_open_end is not None:
+            self._pending_query_ends = []
+
+        semicolon = chunk.rfind(';')
+        if semicolon != -1:
+            self._last_semicolon = offset + new_start + semicolon
+
+        backticks = window.rfind('```')
+        if backticks != -1 and backticks + 3 > new_start:
+            self._last_backticks = offset + backticks
+
+        if self._user_start is None:
+            for i in self._find_all(window, 'user:', max(0, new_start - 4)):
+                if window[max(0, i - 4):i] != 'ask ':
+                    self._user_start = offset + i
+                    break
+
+        if self._end_flag_start is None:
+            i = window.find('/end', max(0, new_start - 3))
+            if i != -1:
+                self._end_flag_start = offset + i
+
+        self._tail = window[-self.tail_length:]
+
+        return self.stop_index()
+
+    def stop_index(self):
+        """Evaluate the stop conditions, in the same priority order as check_for_stop_conditions"""
+        if self._first_query_end is not None and self._last_semicolon is not None \
+                and self._last_semicolon > self._first_query_end: # (.+) needs at least one character before the ;
+            print('Complete SQL query detected. Stopping prediction...')
+            return self._last_semicolon + 1
+        if self._block_open_end is not None and self._last_backticks is not None \
+                and self._last_backticks >= self._block_open_end:
+            print('Complete SQL query detected. Stopping prediction...')
+            return self._last_backticks + 3
+        if self._user_start is not None:
+            print('Hallucination detected. Stopping prediction...')
+            return self._user_start
+        if self._end_flag_start is not None:
+            print('"/End" detected. Stopping prediction...')
+            return self._end_flag_start
+        return None
+
 def clean_up_response_formatting(response):
 
     # if a query is presented as a code block after ```, but the stop_index cut off the closing ```
@@ -105,43 +292,250 @@ def choose_next_action(output):
     
     return action, action_input
     
-def query_manager(db,query):
-    "Return raw and markdown-formatted query results"
+# how much of a query result is kept for display, to the LLM and in the chat
+QUERY_RESULT_MAX_ROWS = 20 # results up to this size are shown in full
+QUERY_RESULT_END_ROWS = 7 # larger results show this many rows from each end
+QUERY_FETCH_VECTORS = 8 # DuckDB vectors (2048 rows each) to fetch at a time
+
+def fetch_head_and_tail(db,query):
+    """Run a query and stream through its result, keeping only the rows that can be displayed,
+       so a large result is never held in memory all at once.
+
+       Returns (df, row_count). df is the whole result if it has up to QUERY_RESULT_MAX_ROWS rows,
+       otherwise its first QUERY_RESULT_MAX_ROWS + 1 rows followed by its last QUERY_RESULT_END_ROWS rows
+       """
+    db.execute(query)
+    head = None
+    tail = None
+    row_count = 0
+    while True:
+        chunk = db.fetch_df_chunk(QUERY_FETCH_VECTORS)
+        if head is None:
+            head = chunk # keep the first chunk even if it is empty, so we have the column names
+        elif head.shape[0] <= QUERY_RESULT_MAX_ROWS and chunk.shape[0] > 0:
+            head = pd.concat([head, chunk.head(QUERY_RESULT_MAX_ROWS + 1 - head.shape[0])], ignore_index=True)
+        if chunk.shape[0] == 0:
+            break
+        row_count += chunk.shape[0]
+        tail = chunk.tail(QUERY_RESULT_END_ROWS) if tail is None else pd.concat([tail, chunk]).tail(QUERY_RESULT_END_ROWS)
+        head = head.head(QUERY_RESULT_MAX_ROWS + 1)
+
+    if row_count <= QUERY_RESULT_MAX_ROWS:
+        return head, row_count
+    return pd.concat([head, tail], ignore_index=True), row_count
+
+# query results going back to the LLM start with one of these when the query failed
+QUERY_ERROR_PREFIX = 'The query returned a DuckDB error message:'
+QUERY_TIMEOUT_PREFIX = 'The query was cancelled because it ran too long.'
+QUERY_REJECTED_PREFIX = 'The query was not run, because its estimated cost is over the limit.'
+
+def is_query_error(query_result_string):
+    return query_result_string.startswith(QUERY_ERROR_PREFIX) or query_result_string.startswith(QUERY_TIMEOUT_PREFIX) \
+        or query_result_string.startswith(QUERY_REJECTED_PREFIX)
+
+def query_manager(db_file,query,timeout=QUERY_TIMEOUT,use_cache=True):
+    "Return raw and markdown-formatted query results, from the shared result cache if this query has been run before"
+    cache_key = query_result_cache.key(db_file, query) if use_cache else None
+    if cache_key is not None:
+        cached = query_result_cache.get(cache_key)
+        if cached is not None:
+            print(f'Query result cache hit:\n{query}\n')
+            return cached
+    string_out, md_out = run_query(db_file, query, timeout)
+    if cache_key is not None and not is_query_error(string_out): # errors can be down to a timeout or a busy pool, so don't keep them
+        query_result_cache.put(cache_key, (string_out, md_out))
+    return string_out, md_out
+
+def run_query(db_file,query,timeout=QUERY_TIMEOUT):
+    "Run a query against the database. Return raw and markdown-formatted query results"
     try:
+        query = route_query(db_file, query) # aggregates that were precomputed are read from the summary tables
+        admission = admit_query(db_file, query) # checked against the cost limits before it goes anywhere near the query workers
+        if admission.rejected:
+            return format_query_rejection(admission)
+        query = admission.query
         print(f'Running query:\n{query}\n')
-        df = db.sql(query).df()
-    except Exception as e:
-        formatted_exc = str(e) #format_exc()
-        text_out = """The query returned a DuckDB error message:\n\n""" + formatted_exc \
-            + "\n\nCheck the SQL query and see if you can correct the issue and try again."
-        md_out = f""":red[ERROR ENCOUNTERED IN DATABASE QUERY] \n```\n{formatted_exc}\n```\n\n"""
+        # runs on a cursor on the connection shared by all sessions, and is cancelled if it passes the deadline
+        df, row_count = run_with_deadline(db_file, lambda db: fetch_head_and_tail(db, query), timeout)
+    except QueryTimeout as e:
+        text_out = QUERY_TIMEOUT_PREFIX + f" It did not finish within the time limit of {e.timeout:g} seconds." \
+            + "\n\nQueries must be fast. Check for joins without a join condition (which produce a cross join), " \
+            + "filter and aggregate before joining large tables, and LIMIT the output, then try again."
+        md_out = f""":red[QUERY CANCELLED] \n```\n{e}\n```\n\n"""
         return text_out, md_out
+    except Exception as e:
+        return format_query_error(e)
+    string_out, md_out = format_query_result(df, row_count)
+    for notice in admission.result_notices(row_count): # how the query was rewritten to run it
+        string_out += '\n\n' + notice
+        md_out += '\n\n' + notice + '\n'
+    return string_out, md_out
 
+def format_query_result(df,row_count):
+    "Raw and markdown-formatted versions of a query result from fetch_head_and_tail"
     # if df.shape[0] > 20:
     #     string_out = df.head(7).to_string(index=False) + df.tail(7).to_string(index=False,headers=False)
 
-    string_out = df.to_string(index=False,max_rows=20,min_rows=14)
+    # df holds more than QUERY_RESULT_MAX_ROWS rows only if the result was truncated, in which case
+    # to_string shows its first and last QUERY_RESULT_END_ROWS rows
+    string_out = df.to_string(index=False,max_rows=QUERY_RESULT_MAX_ROWS,min_rows=2*QUERY_RESULT_END_ROWS)
 
-    if df.shape[0] > 20:
+    if df.shape[0] > QUERY_RESULT_MAX_ROWS:
         # .astype(str) in the below lets pandas handle the value formatting, rather than the formatting functionality of tabulate, which to_markdown invokes
-        md_out = df.head(7).astype(str).to_markdown(index=False) + '\n| ... |\n' + '\n'.join(df.tail(7).astype(str).to_markdown(index=False).splitlines()[2:]) + '\n' # the splitlines and rejoin removes the headers from the bottom portion
+        md_out = df.head(QUERY_RESULT_END_ROWS).astype(str).to_markdown(index=False) + '\n| ... |\n' + '\n'.join(df.tail(QUERY_RESULT_END_ROWS).astype(str).to_markdown(index=False).splitlines()[2:]) + '\n' # the splitlines and rejoin removes the headers from the bottom portion
+        string_out += f'\n({row_count} rows)'
+        md_out += f'\n({row_count} rows)\n'
     else:
         md_out = df.astype(str).to_markdown(index=False)
 
     return string_out, md_out
 
+def format_query_rejection(admission):
+    "Raw and markdown-formatted versions of why admission control rejected a query, to send back to the LLM and show in the chat"
+    details = '\n'.join(f'{key}: {value}' for key, value in admission.details.items())
+    text_out = QUERY_REJECTED_PREFIX + '\n\n' + details + '\n\nWrite a cheaper query that answers the question and try again.'
+    md_out = f""":red[QUERY REJECTED: ESTIMATED COST TOO HIGH] \n```\n{details}\n```\n\n"""
+    return text_out, md_out
+
+def format_query_error(e):
+    "Raw and markdown-formatted versions of a DuckDB error, to send back to the LLM and show in the chat"
+    formatted_exc = str(e) #format_exc()
+    text_out = QUERY_ERROR_PREFIX + """\n\n""" + formatted_exc \
+        + "\n\nCheck the SQL query and see if you can correct the issue and try again."
+    md_out = f""":red[ERROR ENCOUNTERED IN DATABASE QUERY] \n```\n{formatted_exc}\n```\n\n"""
+    return text_out, md_out
+
+# start running a query as soon as the LLM has finished writing it, while the response is still being logged and displayed
+SPECULATIVE_QUERIES = os.environ.get('SPECULATIVE_QUERIES', default='1') != '0'
+# separate from db_manager's query workers, which query_manager itself waits on
+speculative_query_workers = ThreadPoolExecutor(max_workers=16, thread_name_prefix='speculative-query')
+
+def preflight_query(db_file,query):
+    "Check that a query parses and binds, in about a millisecond and without running it. Returns the error outputs, or None"
+    try:
+        explain_query(db_file, query)
+    except Exception as e:
+        print(f'Query failed pre-flight check:\n{query}\n{e}\n')
+        return format_query_error(e)
+    return None
+
+def start_query(db_file,query,timeout=QUERY_TIMEOUT):
+    """Pre-flight a query, and if it passes, start running it through query_manager in the background.
+       Returns a Future of query_manager's (string_out, md_out). A query that fails pre-flight is never run:
+       the Future already holds its error"""
+    error = preflight_query(db_file, query)
+    if error is not None:
+        future = Future()
+        future.set_result(error)
+        return future
+    return speculative_query_workers.submit(query_manager, db_file, query, timeout)
+
 
 #### logging utilities
 import logging
 import uuid
 import os
+import queue
+import json
+import atexit
+import hashlib
 
 os.makedirs('./log', exist_ok=True) 
+# "text" writes the original pipe-delimited log, "jsonl" writes one JSON object per record to interaction_log.jsonl
+LOG_FORMAT = os.environ.get('LOG_FORMAT', default='text')
+LOG_FILE = './log/interaction_log.jsonl' if LOG_FORMAT == 'jsonl' else './log/interaction_log.log'
+
+class JsonLinesLogFormatter(logging.Formatter):
+    """Format an interaction log record as a JSON object, with the uuids, key and value as separate fields"""
+
+    def format(self, record):
+        session_uuid, call_uuid, key, value = record.getMessage().split('|', 3)
+        end_marker = f'|||end {key}|||'
+        if value.endswith(end_marker):
+            value = value[:-len(end_marker)]
+        return json.dumps({'timestamp':self.formatTime(record), 'level':record.levelname, 'session_uuid':session_uuid,
+                           'call_uuid':call_uuid, 'key':key, 'value':value}, ensure_ascii=False)
+
+class BatchingLogWriter(threading.Thread):
+    """Background thread that takes log records off a queue and appends them to the log file in batches,
+       so the chat loop never waits on the disk. Each batch is one write and one flush"""
+
+    def __init__(self, record_queue, path, formatter, max_batch=1000):
+        super().__init__(name='interaction-log-writer', daemon=True)
+        self.record_queue = record_queue
+        self.path = path
+        self.formatter = formatter
+        self.max_batch = max_batch
+
+    def run(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            stopping = False
+            while not stopping:
+                batch = [self.record_queue.get()] # wait for something to write
+                while len(batch) < self.max_batch: # then take whatever else has piled up in the meantime
+                    try:
+                        batch.append(self.record_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch: # sentinel from stop()
+                    stopping = True
+                    batch = [record for record in batch if record is not None]
+                self.write_batch(f, batch)
+
+    def write_batch(self, f, batch):
+        """Write a batch of records. Errors are printed, not raised, so the thread goes on draining the queue:
+           a record that can't be formatted is skipped, and a batch that can't be written is lost"""
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.formatter.format(record) + '\n')
+            except Exception as e:
+                print(f'Could not format interaction log record {str(record.msg)[:200]!r}: {e!r}')
+        try:
+            f.write(''.join(lines))
+            f.flush()
+        except Exception as e:
+            print(f'Could not write {len(lines)} interaction log records to {self.path}: {e!r}')
+
+    def stop(self):
+        """Write out everything queued so far, then end the thread"""
+        self.record_queue.put(None)
+        self.join()
+
+class EnqueueHandler(logging.Handler):
+    """Hand records straight to the writer's queue. Lighter than logging.handlers.QueueHandler, which
+       formats and copies each record on the calling thread - our messages are already plain strings"""
+
+    def __init__(self, record_queue):
+        super().__init__()
+        self.record_queue = record_queue
+
+    def handle(self, record):
+        self.record_queue.put(record) # SimpleQueue.put is thread-safe, so no handler lock needed
+        return True
+
+    def emit(self, record):
+        self.record_queue.put(record)
+
+interaction_logger = logging.getLogger('quack_to_my_data.interactions')
+interaction_logger.setLevel(logging.INFO)
+interaction_logger.propagate = False
+log_writer = None
+
+def configure_interaction_log(path=LOG_FILE, log_format=LOG_FORMAT):
+    """(Re)start the background writer for the interaction log. Records logged until now are written first"""
+    global log_writer, log_blob_store
+    log_blob_store = ContentStore(os.path.join(os.path.dirname(path), 'blobs')) # large values go next to the log
+    if log_writer is not None:
+        log_writer.stop()
+    for handler in list(interaction_logger.handlers):
+        interaction_logger.removeHandler(handler)
+    formatter = JsonLinesLogFormatter() if log_format == 'jsonl' else logging.Formatter('%(asctime)s|%(levelname)s|%(message)s')
+    record_queue = queue.SimpleQueue()
+    interaction_logger.addHandler(EnqueueHandler(record_queue)) # logging calls just put the record on the queue
+    log_writer = BatchingLogWriter(record_queue, path, formatter)
+    log_writer.start()
 
-logging.basicConfig(filename='./log/interaction_log.log',
-                    format = '%(asctime)s|%(levelname)s|%(message)s',
-                    encoding='utf-8', 
-                    level=logging.INFO)
 
 def generate_logging_uuid():
     """Let's create one uuid that will persist with the LLM call and its associated artifacts"""
@@ -150,30 +544,165 @@ def generate_logging_uuid():
 def prepend_uuid_on_message(session_uuid,call_uuid,message):
     return str(session_uuid) + '|' + str(call_uuid) + '|' + str(message)
 
+#### content-addressed storage for large log values
+# Every LLM call logs the whole prompt: the schema, then the entire dialogue so far. Logged as-is, an N step
+# conversation takes O(N^2) bytes. Instead, large inputs are split into chunks at paragraph breaks, each
+# chunk is stored once in LOG_BLOB_DIR in a file named by its hash, and the log line lists the hashes.
+# Chunk boundaries only depend on the text before them, so a prompt that grows by appending to the previous
+# one reuses all but its last chunks. read_log_records puts the full values back together.
+# The blob store is part of the log: a log copied without its blobs directory can't be read back in full.
+LOG_DEDUPLICATE_INPUTS = os.environ.get('LOG_DEDUPLICATE_INPUTS', default='1') != '0'
+LOG_BLOB_DIR = './log/blobs' # next to the log file, where read_log_records expects it
+LOG_BLOB_MIN_SIZE = 1024 # values shorter than this are logged inline, and chunks are at least this long
+BLOB_REF_PREFIX = '@blobs:'
+PARAGRAPH_RE = re.compile(r'.*?(?:\n\n|$)', re.DOTALL)
+
+def split_into_chunks(text,min_size=LOG_BLOB_MIN_SIZE):
+    """Split text at paragraph breaks into chunks of at least min_size characters (except the last one)"""
+    chunks = []
+    current = []
+    current_size = 0
+    for paragraph in PARAGRAPH_RE.findall(text):
+        current.append(paragraph)
+        current_size += len(paragraph)
+        if current_size >= min_size:
+            chunks.append(''.join(current))
+            current = []
+            current_size = 0
+    if current_size:
+        chunks.append(''.join(current))
+    return chunks
+
+class ContentStore:
+    """Text chunks stored once each, in files named by the hash of their contents"""
+
+    def __init__(self, directory=LOG_BLOB_DIR):
+        self.directory = directory
+        self.known_hashes = set()
+        self._lock = threading.Lock()
+
+    def path(self, content_hash):
+        return os.path.join(self.directory, content_hash[:2], content_hash + '.txt')
+
+    def put(self, chunk):
+        content_hash = hashlib.sha256(chunk.encode('utf-8')).hexdigest()[:32]
+        with self._lock:
+            if content_hash in self.known_hashes:
+                return content_hash
+            self.known_hashes.add(content_hash)
+        path = self.path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                f.write(chunk)
+            os.replace(tmp_path, path) # so a reader never sees a partly written chunk
+        return content_hash
+
+    def get(self, content_hash):
+        with open(self.path(content_hash), 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    def store(self, text):
+        """Store a value, returning the reference to log in its place"""
+        return BLOB_REF_PREFIX + ','.join(self.put(chunk) for chunk in split_into_chunks(text))
+
+    def expand(self, value):
+        """Turn a logged value back into the original, if it is a reference"""
+        if not value.startswith(BLOB_REF_PREFIX):
+            return value
+        return ''.join(self.get(content_hash) for content_hash in value[len(BLOB_REF_PREFIX):].split(','))
+
+log_blob_store = None
+
+configure_interaction_log()
+atexit.register(lambda: log_writer.stop()) # don't lose whatever is still queued when the app shuts down
+
 def log_llm_call(llm,param_dict,call_uuid,session_uuid):
     """"""
     llm_model_name,llm_version = llm.split(':') 
-    logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'llm_name|'+llm_model_name ))
-    logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'llm_version|'+llm_version ))
+    interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'llm_name|'+llm_model_name ))
+    interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'llm_version|'+llm_version ))
     for key in param_dict.keys():
-        logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'input_'+key+'|'+str(param_dict[key])  + f'|||end input_{key}|||' ))
+        value = str(param_dict[key])
+        if (LOG_DEDUPLICATE_INPUTS and len(value) >= LOG_BLOB_MIN_SIZE # i.e. the prompt and system prompt
+                or value.startswith(BLOB_REF_PREFIX)): # stored, so it isn't read back as a reference
+            value = log_blob_store.store(value)
+        interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'input_'+key+'|'+value  + f'|||end input_{key}|||' ))
 
 def log_response(response,call_uuid,session_uuid):
     """"""
-    logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'response|'+response + '|||end response|||' ))
+    interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'response|'+response + '|||end response|||' ))
 
 def log_action(next_action,action_input,call_uuid,session_uuid):
     """"""
-    logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'next_action|'+str(next_action) ))
+    interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'next_action|'+str(next_action) ))
     if action_input: #only log if not None
-        logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'next_action_input|'+str(action_input) + '|||end next_action_input|||' ))
+        interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'next_action_input|'+str(action_input) + '|||end next_action_input|||' ))
 
 def log_query_result(query_result_string,query_result_markdown,call_uuid,session_uuid):
     """"""
-    logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'query_result_string|'+str(query_result_string) + '|||end query_result_string|||' ))
-    logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'query_result_markdown|'+str(query_result_markdown) + '|||end query_result_markdown|||' ))
+    interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'query_result_string|'+str(query_result_string) + '|||end query_result_string|||' ))
+    interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'query_result_markdown|'+str(query_result_markdown) + '|||end query_result_markdown|||' ))
 
 def log_noteworthy(sentiment,explanation,call_uuid,session_uuid):
     """Record a user-identified interaction as noteworthy (could be a good or bad example!)"""
-    logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'noteworthy_example_sentiment|'+sentiment ))
-    logging.info(prepend_uuid_on_message(session_uuid,call_uuid,'noteworthy_example_reason|'+explanation + '|||end noteworthy_example_reason|||' ))
\ No newline at end of file
+    interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'noteworthy_example_sentiment|'+sentiment ))
+    interaction_logger.info(prepend_uuid_on_message(session_uuid,call_uuid,'noteworthy_example_reason|'+explanation + '|||end noteworthy_example_reason|||' ))
+
+
+#### reading the log back
+# Each log line is timestamp|level|session_uuid|call_uuid|key|value
+# Values that may span multiple lines are terminated with |||end key|||
+LOG_LINE_RE = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})\|(\w+)\|([^|\n]*)\|([^|\n]*)\|([^|\n]*)\|(.*)', re.DOTALL)
+TERMINATED_LOG_KEYS = {'response','next_action_input','query_result_string','query_result_markdown','noteworthy_example_reason'}
+
+def log_value_is_terminated(key):
+    """True for the keys whose values may span lines and end with an |||end key||| marker"""
+    return key.startswith('input_') or key in TERMINATED_LOG_KEYS
+
+def log_value_may_be_stored(key):
+    """True for the keys whose values may be references to the blob store - only LLM inputs are stored there"""
+    return key.startswith('input_')
+
+def read_log_records(path=LOG_FILE,expand=True):
+    """Stream the records of a text or JSON lines interaction log, as dicts like parse_log_records.
+       With expand, values stored in the content-addressed blob store are reconstructed in full"""
+    blob_store = ContentStore(os.path.join(os.path.dirname(path), 'blobs'))
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = parse_log_records(f)
+        for record in records:
+            if expand and log_value_may_be_stored(record['key']):
+                record['value'] = blob_store.expand(record['value'])
+            yield record
+
+def parse_log_records(lines):
+    """Turn the lines of the interaction log into a stream of record dicts with keys
+       timestamp, level, session_uuid, call_uuid, key and value.
+       Lines that aren't part of a record (e.g. from other loggers) are skipped"""
+    record = None
+    value_lines = []
+    for line in lines:
+        if record is None:
+            match = LOG_LINE_RE.match(line)
+            if not match:
+                continue
+            timestamp, level, session_uuid, call_uuid, key, value = match.groups()
+            record = {'timestamp':timestamp, 'level':level, 'session_uuid':session_uuid, 'call_uuid':call_uuid, 'key':key}
+            if not log_value_is_terminated(key):
+                record['value'] = value.rstrip('\n')
+                yield record
+                record = None
+                continue
+            value_lines = [value]
+        else:
+            value_lines.append(line)
+        end_marker = f'|||end {record["key"]}|||'
+        if line.rstrip('\n').endswith(end_marker):
+            value = ''.join(value_lines).rstrip('\n')
+            record['value'] = value[:-len(end_marker)]
+            yield record
+            record = None